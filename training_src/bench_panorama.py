@@ -0,0 +1,150 @@
+''' Latency and peak memory of the panorama step (forward_panorama_per_step)
+    on random inputs, for a range of global map (history) lengths.
+
+    python bench_panorama.py --batch_size 64 --gmap_lens 10 50 100 200
+    python bench_panorama.py --device cpu --batch_size 8 --gmap_lens 10 50 --no_grad
+
+    The weights are randomly initialized, only the shapes matter. On cuda the
+    peak is torch.cuda.max_memory_allocated of each run; on cpu it is the
+    peak RSS of the process (ru_maxrss), which never decreases, so use
+    increasing --gmap_lens.
+'''
+import argparse
+import resource
+import time
+
+import numpy as np
+import torch
+from transformers import BertConfig
+
+from utils.data import get_view_perm_idxs
+from models.vilmodel import GlocalTextPathNavCMT
+
+
+def build_model(args):
+    ''' the model of scripts/final_frt_gd_finetuning_stable.sh, without the
+        heads the panorama step does not use '''
+    config = BertConfig()
+    config.max_action_steps = 100
+    config.image_feat_size = args.image_feat_size
+    config.angle_feat_size = args.angle_feat_size
+    config.obj_feat_size = args.obj_feat_size
+    config.obj_loc_size = 3
+    config.num_l_layers = 9
+    config.num_pano_layers = 2
+    config.num_x_layers = 4
+    config.num_v_layers = 4
+    config.num_layout_layers = 6
+    config.graph_sprels = True
+    config.glocal_fuse = True
+    config.h_graph = False
+    config.rp_embed_dir = None
+    config.features = 'clip'
+    config.update_rp_embed = False
+    config.global_fuse = False
+    config.use_img_room_head = False
+    config.use_gd = False
+    config.fuse_dist_score_to_global = 0.
+    config.const_fuse_gl = False
+    config.const_fuse_gd = False
+    config.fix_lang_embedding = False
+    config.fix_pano_embedding = False
+    config.fix_local_branch = False
+    config.update_lang_bert = True
+    config.output_attentions = True
+    config.pred_head_dropout_prob = 0.1
+    config.use_lang2visn_attn = False
+    return GlocalTextPathNavCMT(config)
+
+
+def random_inputs(args, gmap_len, device):
+    rng = np.random.default_rng(args.seed)
+    batch_size, num_cands = args.batch_size, 4
+    used_cand_ids = [set(rng.choice(36, num_cands, replace=False).tolist()) for _ in range(batch_size)]
+    view_len, obj_len = 36, args.num_objs
+    batch = {
+        'view_img_fts': torch.randn(batch_size, view_len, args.image_feat_size),
+        'rec_view_img_fts': torch.randn(batch_size, view_len, args.image_feat_size),
+        'obj_img_fts': torch.randn(batch_size, obj_len, args.obj_feat_size),
+        'loc_fts': torch.randn(batch_size, view_len + obj_len, args.angle_feat_size + 3),
+        'nav_types': torch.cat([
+            torch.ones(batch_size, num_cands), torch.zeros(batch_size, view_len - num_cands),
+            torch.full((batch_size, obj_len), 2)
+        ], 1).long(),
+        'view_lens': torch.full((batch_size, ), view_len).long(),
+        'obj_lens': torch.full((batch_size, ), obj_len).long(),
+        'instruction_fts': torch.randn(batch_size, args.txt_len, 768),
+        'knowledge_fts': torch.randn(batch_size, 36, 1, 512),
+        'crop_fts': torch.randn(batch_size, 36, 5, 512),
+        'gmap_img_embeds': torch.randn(batch_size, gmap_len, 768),
+        'gmap_step_ids': torch.randint(0, 15, (batch_size, gmap_len)),
+        'gmap_pos_fts': torch.randn(batch_size, gmap_len, args.angle_feat_size + 3),
+        'view_perm_idxs': torch.from_numpy(get_view_perm_idxs(used_cand_ids)),
+    }
+    batch = {k: v.to(device) for k, v in batch.items()}
+    batch['used_cand_ids'] = used_cand_ids
+    return batch
+
+
+def run_step(model, batch, no_grad):
+    with torch.set_grad_enabled(not no_grad):
+        pano_embeds, rec_pano_embeds, _, _ = model('panorama', batch)
+        if not no_grad:
+            (pano_embeds.sum() + rec_pano_embeds.sum()).backward()
+
+
+def benchmark(model, args, gmap_len, device):
+    batch = random_inputs(args, gmap_len, device)
+    for _ in range(args.warmup):
+        run_step(model, batch, args.no_grad)
+        model.zero_grad(set_to_none=True)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    latencies = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        run_step(model, batch, args.no_grad)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        latencies.append(time.perf_counter() - start)
+        model.zero_grad(set_to_none=True)
+    if device.type == 'cuda':
+        peak_mb = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    return np.median(latencies) * 1000, peak_mb
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the panorama step')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--gmap_lens', type=int, nargs='+', default=[10, 50, 100, 200])
+    parser.add_argument('--txt_len', type=int, default=200, help='instruction tokens')
+    parser.add_argument('--num_objs', type=int, default=20)
+    parser.add_argument('--image_feat_size', type=int, default=768)
+    parser.add_argument('--obj_feat_size', type=int, default=768)
+    parser.add_argument('--angle_feat_size', type=int, default=4)
+    parser.add_argument('--no_grad', action='store_true', default=False, help='forward only (inference)')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    model = build_model(args).to(device)
+    model.train(not args.no_grad)
+
+    print('batch_size %d, txt_len %d, %s' % (
+        args.batch_size, args.txt_len, 'forward' if args.no_grad else 'forward + backward'
+    ))
+    print('%10s %14s %14s' % ('gmap_len', 'latency (ms)', 'peak (MB)'))
+    for gmap_len in args.gmap_lens:
+        latency, peak_mb = benchmark(model, args, gmap_len, device)
+        print('%10d %14.1f %14.1f' % (gmap_len, latency, peak_mb))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,14 +9,23 @@ import random
 import networkx as nx 
 from collections import defaultdict
 import copy 
-import MatterSim 
 
-from utils.data import load_nav_graphs, new_simulator
-from utils.data import angle_feature, get_all_point_angle_feature
+from utils.data import angle_feature, batch_angle_feature, get_view_perm_idxs
 from env_bases.reverie.env_base import EnvBatch
+from env_bases.reverie.graph_sim import GraphEnvBatch
+from env_bases.reverie.scene_registry import build_scene_registry
+from env_bases.reverie.nav_metrics import score_predictions, average_metrics
 
 CROP_SIZE = 5
 
+
+class BatchObs(list):
+    '''Observations of a batch, with the struct-of-arrays panorama inputs
+       of ReverNavBatchEnv._get_batch_fts (--batch_obs) attached '''
+    def __init__(self, obs, batch_fts=None):
+        super().__init__(obs)
+        self.batch_fts = batch_fts
+
 class ReverNavBatchEnv(object):
     '''Rever nav env including room label and pretrained visual feats'''
 
@@ -24,12 +33,20 @@ class ReverNavBatchEnv(object):
         self, view_db, rec_view_db, obj_db, instr_data, connectivity_dir, obj2vps,
         vp2room, ins2img_db=None, multi_endpoints = False, multi_startpoints = False,
         batch_size = 64, angle_feat_size = 4, max_objects = None, seed = 0,
-        name = None, sel_data_idxs = None, args=None
+        name = None, sel_data_idxs = None, args=None, feat_bundle=None, cand_table=None,
+        scene_registry=None
     ):
         self.args = args
-        self.env = EnvBatch(connectivity_dir, feat_db=view_db, rec_feat_db=rec_view_db, batch_size=batch_size)
+        # graphs, shortest paths and the helper simulator, shared with the other envs
+        self.scene_registry = scene_registry if scene_registry is not None else build_scene_registry(args)
+        env_batch_class = GraphEnvBatch if args.sim_backend == 'graph' else EnvBatch
+        self.env = env_batch_class(
+            connectivity_dir, feat_db=view_db, rec_feat_db=rec_view_db, batch_size=batch_size,
+            feat_bundle=feat_bundle
+        )
         self.obj_db = obj_db 
         self.ins2img_db = ins2img_db
+        self.cand_table = cand_table
         self.data = instr_data 
         self.scans = set(x['scan'] for x in self.data)
         self.multi_endpoints = multi_endpoints
@@ -67,9 +84,13 @@ class ReverNavBatchEnv(object):
 
         self.ix = 0
         self._load_nav_grpahs()
+        # per scan tables of the goals: {(scan, objid): dists}, {(scan, start, goal, path len): scores}
+        self._goal_dist_tables = {}
+        self._progress_tables = {}
 
-        self.sim = new_simulator(self.connectivity_dir) # one simulator
-        self.angle_feature = get_all_point_angle_feature(self.sim, self.angle_feat_size)
+        self.sim = self.scene_registry.sim # one simulator
+        self.angle_feature = self.scene_registry.get_angle_feature(self.angle_feat_size)
+        self.angle_feature_table = np.stack(self.angle_feature, 0) # (36 base views, 36, angle_feat_size)
 
         self.buffered_state_dict = {}
         print('%s loaded with %d instructions, using splits: %s' % (
@@ -118,6 +139,35 @@ class ReverNavBatchEnv(object):
             self.batch = batch 
     
 
+    def reset_slots(self, slots):
+        '''Continuous batching: start the next instructions of the epoch (without
+           wrapping around) in the given slots of the batch. Returns the data index of
+           the new instruction of each slot, -1 when the data is exhausted, in which
+           case the slot keeps its last episode (or gets the first instruction if it
+           never had one, so that every simulator has an episode).
+        '''
+        data_idxs = []
+        for i in slots:
+            if self.ix < len(self.data):
+                data_idxs.append(self.ix)
+                self.batch[i] = self.data[self.ix]
+                self.ix += 1
+            else:
+                data_idxs.append(-1)
+                if self.batch[i] is not None:
+                    continue
+                self.batch[i] = self.data[0]
+            item = self.batch[i]
+            self.env.sims[i].newEpisode([item['scan']], [item['path'][0]], [item['heading']], [0])
+        return np.array(data_idxs, dtype=np.int64)
+
+    def reset_continuous(self):
+        '''Start a continuous batching pass over the data, see reset_slots '''
+        self.ix = 0
+        self.batch = [None] * self.batch_size
+        data_idxs = self.reset_slots(range(self.batch_size))
+        return data_idxs, self._get_obs()
+
     def reset_epoch(self, shuffle=False):
         '''Reset the data index to begining of epoch. Primarily for testing.
            You must still call reset() for a new episode.
@@ -135,6 +185,17 @@ class ReverNavBatchEnv(object):
         base_heading = (viewId % 12) * math.radians(30)
         base_elevation = (viewId // 12 -1) * math.radians(30)
 
+        if self.cand_table is not None:
+            candidate = self.cand_table.get_candidate(
+                scanId, viewpointId, viewId, features, self.angle_feat_size, rec_features=rec_features
+            )
+            for c in candidate:
+                if 'room_type' not in c:
+                    # tables built without --vp2room_file
+                    c['room_type'] = self.vp2room[scanId+"_"+c['viewpointId']]["id"]
+            self._set_step_scores(candidate, scanId, gt_path)
+            return candidate
+
         adj_dict = {}
         long_id = "%s_%s" % (scanId, viewpointId)
         if long_id not in self.buffered_state_dict:
@@ -149,35 +210,13 @@ class ReverNavBatchEnv(object):
                 state = self.sim.getState()[0]
                 assert state.viewIndex == ix
 
-                # Heading and elevation for the viewpoint center
-                heading = state.heading - base_heading
-                elevation = state.elevation - base_elevation
-
-                visual_feat = features[ix]
-                rec_visual_feat = rec_features[ix]
-            
                 # get adjacent locations
                 for j, loc in enumerate(state.navigableLocations[1:]):
                     # if a loc is visibale from multiple view use the closed
                     # view (in angular distance) as its representation
                     distance = _loc_distance(loc)
-                    # Heading and elevation for the loc
-                    loc_heading = heading + loc.rel_heading
-                    loc_elevation = elevation + loc.rel_elevation
-                    angle_feat = angle_feature(loc_heading, loc_elevation, self.angle_feat_size)
-
-                    if self.args.use_real_dist_norm:
-                        step_score_to_goal = self._cal_score_real(loc.viewpointId, gt_path[-1],
-                                                    gt_path ,self.shortest_distances[state.scanId])
-                    else:
-                        step_score_to_goal = self._cal_score(loc.viewpointId, gt_path[-1],
-                                                    gt_path, self.shortest_paths[state.scanId])
- 
-                    #print(f"from {loc.viewpointId} to {gt_path[-1]} {step_score_to_goal}")
                     if (loc.viewpointId not in adj_dict or distance < adj_dict[loc.viewpointId]['distance'] ) :
                         adj_dict[loc.viewpointId] = {
-                            'heading': loc_heading,
-                            'elevation': loc_elevation,
                             'normalized_heading': state.heading + loc.rel_heading,
                             'normalized_elevation': state.elevation + loc.rel_elevation,
                             'scanId': scanId,
@@ -185,43 +224,49 @@ class ReverNavBatchEnv(object):
                             'pointId': ix, 
                             'distance': distance,
                             'idx': j + 1,
-                            'feature': np.concatenate((visual_feat, angle_feat), - 1),
-                            'rec_feature': np.concatenate((rec_visual_feat, angle_feat), - 1),
                             'position': (loc.x, loc.y, loc.z),
                             'room_type': self.vp2room[scanId+"_"+loc.viewpointId]["id"],
-                            'step_score_to_goal': step_score_to_goal,
                         }
 
-            candidate = list(adj_dict.values())
+            # the sweep only depends on the viewpoint, the features and scores are added per call
             self.buffered_state_dict[long_id] = [
-                {key: c[key] for key in ['normalized_heading', 'normalized_elevation', 'scanId', 'viewpointId', 'pointId', 'idx', 'position', 'room_type', 'step_score_to_goal']}
-                for c in candidate
+                {key: c[key] for key in ['normalized_heading', 'normalized_elevation', 'scanId', 'viewpointId', 'pointId', 'idx', 'position', 'room_type']}
+                for c in adj_dict.values()
             ]
-            return candidate 
-        else:
-            candidate = self.buffered_state_dict[long_id]
-            candidate_new = []
-            for c in candidate:
-                c_new = c.copy()
-                ix = c_new['pointId']
-                visual_feat = features[ix]
-                rec_visual_feat = rec_features[ix]
-                c_new['heading'] = c_new['normalized_heading'] - base_heading
-                c_new['elevation'] = c_new['normalized_elevation'] - base_elevation
-                angle_feat = angle_feature(c_new['heading'], c_new['elevation'], self.angle_feat_size)
-                c_new['feature'] = np.concatenate((visual_feat, angle_feat), -1)
-                c_new['rec_feature'] = np.concatenate((rec_visual_feat, angle_feat), -1)
-                c_new.pop('normalized_heading')
-                c_new.pop('normalized_elevation')
-                candidate_new.append(c_new)
-            return candidate_new
+
+        candidate = []
+        for c in self.buffered_state_dict[long_id]:
+            c_new = c.copy()
+            ix = c_new['pointId']
+            visual_feat = features[ix]
+            rec_visual_feat = rec_features[ix]
+            c_new['heading'] = c_new['normalized_heading'] - base_heading
+            c_new['elevation'] = c_new['normalized_elevation'] - base_elevation
+            angle_feat = angle_feature(c_new['heading'], c_new['elevation'], self.angle_feat_size)
+            c_new['feature'] = np.concatenate((visual_feat, angle_feat), -1)
+            c_new['rec_feature'] = np.concatenate((rec_visual_feat, angle_feat), -1)
+            c_new.pop('normalized_heading')
+            c_new.pop('normalized_elevation')
+            candidate.append(c_new)
+        self._set_step_scores(candidate, scanId, gt_path)
+        return candidate
+
+    def _set_step_scores(self, candidate, scanId, gt_path):
+        ''' step_score_to_goal of the candidates for the current episode (gt_path) '''
+        progress_scores = self._progress_scores(scanId, gt_path)
+        vp2idx = self.scan_shortest_paths[scanId].vp2idx
+        for c in candidate:
+            c['step_score_to_goal'] = progress_scores[vp2idx[c['viewpointId']]]
     
     
     def _get_obs(self):
         obs = []
+        batch_features, batch_rec_features = [], []
         for i, (feature, rec_feature, state) in enumerate(self.env.getStates()):
             item = self.batch[i]
             base_view_id = state.viewIndex
+            batch_features.append(feature)
+            batch_rec_features.append(rec_feature)
 
             scanId = state.scanId
             viewpointId = state.location.viewpointId
@@ -244,22 +289,12 @@ class ReverNavBatchEnv(object):
 
             ins2img_feat = self.ins2img_db.get_ins2image_feature(item['instr_id'])
             #print("Path ", item['path'])
-            if self.args.use_real_dist_norm:
-                step_score_to_goal = self._cal_score_real(state.location.viewpointId, item['path'][-1],
-                                            item['path'],self.shortest_distances[state.scanId])
-            else:
-                step_score_to_goal = self._cal_score(state.location.viewpointId, item['path'][-1],
-                                            item['path'],self.shortest_paths[state.scanId])
-
-            key = "%s_%s" % (state.scanId, state.location.viewpointId)
-            knowledge_feature = []
-            global CROP_SIZE
-            for vp_index in range(36):
-                knowledge_ids = key + '_' + str(vp_index)
-                knowledge_feature.append(self.env.knowledge_db.get_feature(knowledge_ids).reshape(1, 1, 512))
+            vp_idx = self.scan_shortest_paths[scanId].vp2idx[viewpointId]
+            step_score_to_goal = self._progress_scores(scanId, item['path'])[vp_idx]
 
-            knowledge_feature = np.concatenate(knowledge_feature, axis=0)
-            crop_feature = self.env.crop_db.get_feature(key).reshape(36, CROP_SIZE, 512)
+            knowledge_feature, crop_feature = self.env.get_knowledge_crop_features(
+                state.scanId, state.location.viewpointId
+            )
 
             ob = {
                 "instr_id": item['instr_id'],
@@ -294,18 +329,97 @@ class ReverNavBatchEnv(object):
             # There are multiple gt end viewpoints on REVERIE.
             if ob['instr_id'] in self.gt_trajs:
                 gt_objid = self.gt_trajs[ob['instr_id']][-1]
-                min_dist = np.inf
-                for vp in self.obj2vps['%s_%s'%(ob['scan'], str(gt_objid))]:
-                    try:
-                        min_dist = min(min_dist, self.shortest_distances[ob['scan']][ob['viewpoint']][vp])
-                    except:
-                        print(ob['scan'], ob['viewpoint'], vp)
-                        exit(0)
-                ob['distance'] = min_dist
+                ob['distance'] = float(self._goal_dists(scanId, gt_objid)[vp_idx])
             else:
                 ob['distance'] = 0
             obs.append(ob)
+
+        if self.args.batch_obs:
+            # the arrays travel with the obs they were built from
+            return BatchObs(obs, self._get_batch_fts(obs, batch_features, batch_rec_features))
         return obs 
+
+    def _get_batch_fts(self, obs, features, rec_features):
+        '''
+        Struct-of-arrays panorama inputs of the whole batch, in the layout
+        ReverieMapAgent._panorama_feature_variable builds item by item:
+        candidate views, then the remaining views in order, then the objects.
+        '''
+        batch_size = len(obs)
+        batch_idxs = np.arange(batch_size)
+        features = np.stack(features, 0)            # (B, 36, D)
+        rec_features = np.stack(rec_features, 0)
+        view_idxs = np.array([ob['viewIndex'] for ob in obs])
+
+        cand_lens = np.array([len(ob['candidate']) for ob in obs])
+        max_cand_len = max(cand_lens.max(), 1)
+        cand_pointids = np.zeros((batch_size, max_cand_len), dtype=np.int64)
+        cand_angles = np.zeros((batch_size, max_cand_len, 2), dtype=np.float64)
+        for i, ob in enumerate(obs):
+            for j, cc in enumerate(ob['candidate']):
+                cand_pointids[i, j] = cc['pointId']
+                cand_angles[i, j] = (cc['heading'], cc['elevation'])
+        cand_masks = np.arange(max_cand_len)[None, :] < cand_lens[:, None]
+
+        used_views = np.zeros((batch_size, 36), dtype=bool)
+        used_views[np.repeat(batch_idxs, cand_lens), cand_pointids[cand_masks]] = True
+        # unused views first, each group in ascending view order
+        noncand_order = np.argsort(used_views, axis=1, kind='stable')
+        view_lens = cand_lens + 36 - used_views.sum(1)
+
+        max_view_len = view_lens.max()
+        pos = np.arange(max_view_len)[None, :]
+        is_cand = pos < cand_lens[:, None]
+        view_masks = pos < view_lens[:, None]
+        cand_pos = np.minimum(pos, max_cand_len - 1).repeat(batch_size, 0)
+        noncand_pos = np.clip(pos - cand_lens[:, None], 0, 35)
+        view_ids = np.where(
+            is_cand, np.take_along_axis(cand_pointids, cand_pos, 1),
+            np.take_along_axis(noncand_order, noncand_pos, 1)
+        )
+
+        view_img_fts = features[batch_idxs[:, None], view_ids] * view_masks[..., None]
+        rec_view_img_fts = rec_features[batch_idxs[:, None], view_ids] * view_masks[..., None]
+        cand_ang_fts = batch_angle_feature(
+            np.take_along_axis(cand_angles[..., 0], cand_pos, 1),
+            np.take_along_axis(cand_angles[..., 1], cand_pos, 1), self.angle_feat_size
+        )
+        view_ang_fts = np.where(
+            is_cand[..., None], cand_ang_fts, self.angle_feature_table[view_idxs[:, None], view_ids]
+        )
+        view_loc_fts = np.concatenate([view_ang_fts, np.ones(view_ang_fts.shape[:2] + (3, ), dtype=np.float32)], 2)
+        view_loc_fts = view_loc_fts * view_masks[..., None]
+
+        used_cand_ids = [set(cc['pointId'] for cc in ob['candidate']) for ob in obs]
+
+        # objects are packed right after each item's views
+        obj_lens = np.array([len(ob['obj_img_fts']) for ob in obs])
+        obj_rows = np.repeat(batch_idxs, obj_lens)
+        obj_cols = np.arange(obj_lens.sum()) - np.repeat(np.cumsum(obj_lens) - obj_lens, obj_lens)
+        obj_img_fts = np.zeros((batch_size, obj_lens.max(), obs[0]['obj_img_fts'].shape[-1]), dtype=np.float32)
+        loc_fts = np.zeros(
+            (batch_size, (view_lens + obj_lens).max(), view_loc_fts.shape[-1]), dtype=np.float32
+        )
+        nav_types = np.zeros(loc_fts.shape[:2], dtype=np.int64)
+        loc_fts[:, :max_view_len] = view_loc_fts
+        nav_types[:, :max_view_len] = is_cand & view_masks
+        if len(obj_rows) > 0:
+            obj_img_fts[obj_rows, obj_cols] = np.concatenate([ob['obj_img_fts'] for ob in obs], 0)
+            loc_fts[obj_rows, view_lens[obj_rows] + obj_cols] = np.concatenate([
+                np.concatenate([ob['obj_ang_fts'], ob['obj_box_fts']], 1) for ob in obs
+            ], 0)
+            nav_types[obj_rows, view_lens[obj_rows] + obj_cols] = 2
+
+        return {
+            'view_img_fts': view_img_fts, 'rec_view_img_fts': rec_view_img_fts, 'obj_img_fts': obj_img_fts,
+            'loc_fts': loc_fts, 'nav_types': nav_types, 'view_lens': view_lens, 'obj_lens': obj_lens,
+            'cand_vpids': [[cc['viewpointId'] for cc in ob['candidate']] for ob in obs],
+            'obj_ids': [ob['obj_ids'] for ob in obs],
+            'knowledge_fts': np.stack([ob['knowledge_feature'] for ob in obs], 0),
+            'crop_fts': np.stack([ob['crop_feature'] for ob in obs], 0),
+            'used_cand_ids': used_cand_ids,
+            'view_perm_idxs': get_view_perm_idxs(used_cand_ids),
+        }
     
     
     def reset(self, **kwargs):
@@ -335,34 +449,47 @@ class ReverNavBatchEnv(object):
         :return: None
         """
         print("Loading navigation graph for %d scans" % len(self.scans))
-        self.graphs = load_nav_graphs(self.connectivity_dir, self.scans)
-        self.shortest_paths = {}
-        for scan, G in self.graphs.items(): # compute all shortest paths
-            self.shortest_paths[scan] = dict(nx.all_pairs_dijkstra_path(G))
-        self.shortest_distances = {}
-        for scan, G in self.graphs.items():
-            self.shortest_distances[scan] = dict(nx.all_pairs_dijkstra_path_length(G))
+        self.graphs = self.scene_registry.get_graphs(self.scans)
+        # compact all-pairs shortest paths, shared by all envs of the process
+        shortest_paths = self.scene_registry.get_shortest_paths(self.scans)
+        self.scan_shortest_paths = shortest_paths
+        self.shortest_paths = {scan: sp.path_map for scan, sp in shortest_paths.items()}
+        self.shortest_distances = {scan: sp.distance_map for scan, sp in shortest_paths.items()}
          
-    def _cal_score(self, curr_vid, goal_vid, gt_path, st_path, power=5):
-        gt_len = len(gt_path) - 1
-        local_len = len(st_path[curr_vid][goal_vid]) -1
-        if gt_len == 0:
-            if goal_vid == curr_vid:
-                return 1
-            return 0
-        # print(gt_len, local_len)
-        y = max(np.power((gt_len-local_len)/gt_len, power), 0)
-        return y
-
-    def _cal_score_real(self, curr_vid, goal_vid, gt_path, st_path, power=5):
-        dist2goal = st_path[curr_vid][goal_vid]
-        full_len = st_path[gt_path[0]][goal_vid]
-        if full_len == 0:
-            if goal_vid == curr_vid:
-                return 1
-            return 0
-        y = max(np.power((full_len-dist2goal)/full_len, power), 0)
-        return y
+    def _goal_dists(self, scan, objid):
+        ''' distance of every viewpoint of the scan to the closest viewpoint the object is visible from '''
+        key = (scan, str(objid))
+        if key not in self._goal_dist_tables:
+            sp = self.scan_shortest_paths[scan]
+            goal_idxs = [sp.vp2idx[vp] for vp in self.obj2vps['%s_%s' % key]]
+            if len(goal_idxs) > 0:
+                self._goal_dist_tables[key] = sp.distances[:, goal_idxs].min(1)
+            else:
+                self._goal_dist_tables[key] = np.full(len(sp.vp_ids), np.inf, dtype=np.float32)
+        return self._goal_dist_tables[key]
+
+    def _progress_scores(self, scan, gt_path, power=5):
+        ''' step_score_to_goal of every viewpoint of the scan: ((L - l) / L)^power clipped at 0,
+            with L the gt path length and l the one from the viewpoint to the goal, in meters
+            with use_real_dist_norm and in steps otherwise '''
+        key = (scan, gt_path[0], gt_path[-1], len(gt_path))
+        if key not in self._progress_tables:
+            sp = self.scan_shortest_paths[scan]
+            start, goal = sp.vp2idx[gt_path[0]], sp.vp2idx[gt_path[-1]]
+            if self.args.use_real_dist_norm:
+                to_goal = sp.distances[:, goal].astype(np.float64)
+                full_len = to_goal[start]
+            else:
+                to_goal = sp.hops[:, goal].astype(np.float64)
+                to_goal[to_goal < 0] = np.inf
+                full_len = len(gt_path) - 1
+            if full_len == 0:
+                scores = (np.arange(len(sp.vp_ids)) == goal).astype(np.float64)
+            else:
+                scores = np.maximum(np.power((full_len - to_goal) / full_len, power), 0)
+            scores.flags.writeable = False
+            self._progress_tables[key] = scores
+        return self._progress_tables[key]
 
     def _get_gt_trajs(self, data):
         gt_trajs = {
@@ -372,31 +499,6 @@ class ReverNavBatchEnv(object):
         return gt_trajs 
     
     ############## Nav Evaluation ################
-    def _eval_item(self, scan, pred_path, pred_objid, gt_path, gt_objid,instr_id=None):
-        scores = {}
-
-        shortest_distances = self.shortest_distances[scan]
-
-        path = sum(pred_path, [])
-
-        assert gt_path[0] == path[0], 'Result trajectories should include the start position'
-
-        scores['action_steps'] = len(pred_path) - 1
-        scores['trajectory_steps'] = len(path) - 1
-        scores['trajectory_lengths'] = np.sum([shortest_distances[a][b] for a, b in zip(path[:-1], path[1:])])
-        gt_lengths = np.sum([shortest_distances[a][b] for a, b in zip(gt_path[:-1], gt_path[1:])])
-        
-        # navigation: success is to arrive to a viewpoint where the object is visible
-        goal_viewpoints = set(self.obj2vps['%s_%s'%(scan, str(gt_objid))])
-        assert len(goal_viewpoints) > 0, '%s_%s'%(scan, str(gt_objid))
-        scores['success'] = float(path[-1] in goal_viewpoints)
-        scores['oracle_success'] = float(any(x in goal_viewpoints for x in path))
-        scores['spl'] = scores['success'] * gt_lengths / max(scores['trajectory_lengths'], gt_lengths, 0.01)
-
-        scores['rgs'] = str(pred_objid) == str(gt_objid)
-        scores['rgspl'] = scores['rgs'] * gt_lengths / max(scores['trajectory_lengths'], gt_lengths, 0.01)
-        return scores
-
     def eval_metrics(self, preds):
         ''' Evaluate each agent trajectory based on how close it got to the goal location
         the path contains [view_id, angle, vofv]
@@ -404,27 +506,7 @@ class ReverNavBatchEnv(object):
 
         print('eval %d predictions' % (len(preds)))
 
-        metrics = defaultdict(list)
-        for item in preds:
-            instr_id = item['instr_id']
-            traj = item['trajectory']
-            pred_objid = item.get('predObjId', None)
-            scan, gt_traj, gt_objid = self.gt_trajs[instr_id]
-            traj_scores = self._eval_item(scan, traj, pred_objid, gt_traj, gt_objid,instr_id)
-            for k, v in traj_scores.items():
-                metrics[k].append(v)
-            metrics['instr_id'].append(instr_id)
-        
-        avg_metrics = {
-            'action_steps': np.mean(metrics['action_steps']),
-            'steps': np.mean(metrics['trajectory_steps']),
-            'lengths': np.mean(metrics['trajectory_lengths']),
-            'sr': np.mean(metrics['success']) * 100,
-            'oracle_sr': np.mean(metrics['oracle_success']) * 100,
-            'spl': np.mean(metrics['spl']) * 100,
-            'rgs': np.mean(metrics['rgs']) * 100,
-            'rgspl': np.mean(metrics['rgspl']) * 100,
-        }
-        return avg_metrics, metrics
+        metrics = score_predictions(preds, self.gt_trajs, self.scan_shortest_paths, self.obj2vps)
+        return average_metrics(metrics), metrics
 
     
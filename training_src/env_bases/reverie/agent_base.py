@@ -43,10 +43,14 @@ class BaseAgent(object):
     def get_agent(name):
         return globals()[name+"Agent"]
 
-    def test(self, iters=None, **kwargs):
+    def test(self, iters=None, shard=None, **kwargs):
+        ''' shard = (worker, num_workers): the full round only runs the minibatches n with
+            n % num_workers == worker and skips the env over the others, self.results_batch
+            keeps the minibatch index of each result (see merge_shard_results) '''
         self.env.reset_epoch(shuffle=(iters is not None))   # If iters is not none, shuffle the env batch
         self.losses = []
         self.results = {}
+        self.results_batch = {}
         # We rely on env showing the entire batch before repeating anything
         looped = False
         self.loss = 0
@@ -56,6 +60,26 @@ class BaseAgent(object):
                 for traj in self.rollout(**kwargs):
                     self.loss = 0
                     self.results[traj['instr_id']] = traj
+        elif shard is not None:
+            # same minibatches (and random state of the env) as the full round below
+            seen = set()
+            n = 0
+            while not looped:
+                if n % shard[1] == shard[0]:
+                    trajs = self.rollout(**kwargs)
+                else:
+                    self.env._next_minibatch()
+                    trajs = []
+                for i, item in enumerate(self.env.batch):
+                    if item['instr_id'] in seen:
+                        looped = True
+                    else:
+                        seen.add(item['instr_id'])
+                        if len(trajs) > 0:
+                            self.loss = 0
+                            self.results[item['instr_id']] = trajs[i]
+                            self.results_batch[item['instr_id']] = n
+                n += 1
         else:   # Do a full round
             while True:
                 for traj in self.rollout(**kwargs):
@@ -124,6 +148,10 @@ class Seq2SeqAgent(BaseAgent):
 
         self.default_gpu = is_default_gpu(self.args)
         self.rank = rank
+        if self.args.device == 'cuda':
+            self.device = torch.device('cuda:%d'%self.rank)
+        else:
+            self.device = torch.device(self.args.device)
 
         # Models
         self._build_model()
@@ -133,7 +161,6 @@ class Seq2SeqAgent(BaseAgent):
             self.critic = DDP(self.critic, device_ids=[self.rank], find_unused_parameters=True)
 
         self.models = (self.vln_bert, self.critic)
-        self.device = torch.device('cuda:%d'%self.rank) 
 
         # Optimizers
         if self.args.optim == 'rms':
@@ -184,6 +211,10 @@ class Seq2SeqAgent(BaseAgent):
         self.critic_optimizer = optimizer(self.critic.parameters(), lr=self.args.lr)
         self.optimizers = (self.vln_bert_optimizer, self.critic_optimizer)
 
+        # Mixed precision
+        self.amp_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(self.args.amp)
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=self.args.amp == 'fp16')
+
         # Evaluations
         self.criterion = nn.CrossEntropyLoss(ignore_index=self.args.ignoreid, reduction='sum')
         self.criterion_mse = nn.MSELoss(reduction='none')
@@ -196,7 +227,10 @@ class Seq2SeqAgent(BaseAgent):
     def _build_model(self):
         raise NotImplementedError('child class should implement _build_model: self.vln_bert & self.critic')
 
-    def test(self, use_dropout=False, feedback='argmax', allow_cheat=False, iters=None, viz=False):
+    def autocast(self):
+        return torch.autocast(self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None)
+
+    def test(self, use_dropout=False, feedback='argmax', allow_cheat=False, iters=None, viz=False, shard=None):
         ''' Evaluate once on each instruction in the current environment '''
         self.feedback = feedback
         if use_dropout:
@@ -205,10 +239,18 @@ class Seq2SeqAgent(BaseAgent):
         else:
             self.vln_bert.eval()
             self.critic.eval()
-        if viz:
-            super().test_viz(iters=iters)
-        else:
-            super().test(iters=iters)
+        # no autograd bookkeeping at all for evaluation on cpu
+        grad_mode = torch.inference_mode(self.device.type == 'cpu' and not use_dropout)
+        with grad_mode, self.autocast():
+            if viz:
+                super().test_viz(iters=iters)
+            elif self.args.continuous_eval and iters is None and feedback == 'argmax' and shard is None:
+                self.env.reset_epoch(shuffle=False)
+                self.losses = []
+                self.loss = 0
+                self.results = {traj['instr_id']: traj for traj in self.rollout_continuous()}
+            else:
+                super().test(iters=iters, shard=shard)
 
     def train(self, n_iters, feedback='teacher', **kwargs):
         ''' Train for a given number of iterations '''
@@ -225,35 +267,40 @@ class Seq2SeqAgent(BaseAgent):
 
             self.loss = 0
 
-            if self.args.train_alg == 'imitation':
-                self.feedback = 'teacher'
-                self.rollout(
-                    train_ml=1., train_rl=False, **kwargs
-                )
-            elif self.args.train_alg == 'dagger': 
-                if self.args.ml_weight != 0:
+            with self.autocast():
+                if self.args.train_alg == 'imitation':
                     self.feedback = 'teacher'
                     self.rollout(
-                        train_ml=self.args.ml_weight, train_rl=False, **kwargs
+                        train_ml=1., train_rl=False, **kwargs
                     )
-                self.feedback = self.args.dagger_sample
-                self.rollout(train_ml=1, train_rl=False, **kwargs)
-            else:
-                if self.args.ml_weight != 0:
-                    self.feedback = 'teacher'
-                    self.rollout(
-                        train_ml=self.args.ml_weight, train_rl=False, **kwargs
-                    )
-                self.feedback = 'sample'
-                self.rollout(train_ml=None, train_rl=True, **kwargs)
+                elif self.args.train_alg == 'dagger': 
+                    if self.args.ml_weight != 0:
+                        self.feedback = 'teacher'
+                        self.rollout(
+                            train_ml=self.args.ml_weight, train_rl=False, **kwargs
+                        )
+                    self.feedback = self.args.dagger_sample
+                    self.rollout(train_ml=1, train_rl=False, **kwargs)
+                else:
+                    if self.args.ml_weight != 0:
+                        self.feedback = 'teacher'
+                        self.rollout(
+                            train_ml=self.args.ml_weight, train_rl=False, **kwargs
+                        )
+                    self.feedback = 'sample'
+                    self.rollout(train_ml=None, train_rl=True, **kwargs)
 
             #print(self.rank, iter, self.loss)
-            self.loss.backward()
+            self.scaler.scale(self.loss).backward()
 
+            self.scaler.unscale_(self.vln_bert_optimizer)
             torch.nn.utils.clip_grad_norm_(self.vln_bert.parameters(), 40.)
 
-            self.vln_bert_optimizer.step()
-            self.critic_optimizer.step()
+            self.scaler.step(self.vln_bert_optimizer)
+            # the critic only gets gradients from rl rollouts
+            if any(p.grad is not None for p in self.critic.parameters()):
+                self.scaler.step(self.critic_optimizer)
+            self.scaler.update()
             
             if self.args.aug is None:
                 print_progress(iter, n_iters+1, prefix='Progress:', suffix='Complete', bar_length=50)
@@ -278,7 +325,7 @@ class Seq2SeqAgent(BaseAgent):
 
     def load(self, path):
         ''' Loads parameters (but not training state) '''
-        states = torch.load(path)
+        states = torch.load(path, map_location=self.device)
 
         def recover_state(name, model, optimizer):
             state = model.state_dict()
@@ -312,4 +359,11 @@ class Seq2SeqAgent(BaseAgent):
             recover_state(*param)
         return states['vln_bert']['epoch'] - 1
 
+    def quantize(self):
+        ''' Dynamic int8 quantization of the Linear layers, for cpu inference only '''
+        assert self.device.type == 'cpu', 'dynamic quantization only runs on cpu'
+        self.vln_bert = torch.ao.quantization.quantize_dynamic(self.vln_bert, {nn.Linear}, dtype=torch.qint8)
+        self.critic = torch.ao.quantization.quantize_dynamic(self.critic, {nn.Linear}, dtype=torch.qint8)
+        self.models = (self.vln_bert, self.critic)
+
 
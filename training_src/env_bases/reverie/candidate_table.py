@@ -0,0 +1,127 @@
+''' Precomputed navigable candidates of every viewpoint, one columnar npz per scan.
+
+The table holds what make_candidate used to get by sweeping the simulator
+over the 36 views: for each viewpoint (rows offsets[i]:offsets[i+1]) the
+candidate viewpoint, the view it is seen from (pointId), its index in
+navigableLocations, the heading/elevation relative to the agent's world
+frame, its position and its room id (-1 when unknown).
+'''
+import os
+import math
+import numpy as np
+
+from utils.data import batch_angle_feature
+
+
+def _loc_distance(loc):
+    return np.sqrt(loc.rel_heading ** 2 + loc.rel_elevation ** 2)
+
+
+def build_scan_candidate_table(sim, scan, viewpoints, vp2room=None):
+    ''' Sweep the 36 views of each viewpoint, keep the closest view of every
+        navigable location exactly as make_candidate does. '''
+    viewpoints = sorted(viewpoints)
+    offsets = [0]
+    columns = {
+        'cand_vpids': [], 'point_ids': [], 'nav_idxs': [],
+        'headings': [], 'elevations': [], 'positions': [], 'room_ids': [],
+    }
+    for viewpoint in viewpoints:
+        adj_dict = {}
+        for ix in range(36):
+            if ix == 0:
+                sim.newEpisode([scan], [viewpoint], [0], [math.radians(-30)])
+            elif ix % 12 == 0:
+                sim.makeAction([0], [1.0], [1.0])
+            else:
+                sim.makeAction([0], [1.0], [0])
+            state = sim.getState()[0]
+            assert state.viewIndex == ix
+
+            for j, loc in enumerate(state.navigableLocations[1:]):
+                distance = _loc_distance(loc)
+                if loc.viewpointId not in adj_dict or distance < adj_dict[loc.viewpointId]['distance']:
+                    adj_dict[loc.viewpointId] = {
+                        'distance': distance,
+                        'cand_vpids': loc.viewpointId,
+                        'point_ids': ix,
+                        'nav_idxs': j + 1,
+                        'headings': state.heading + loc.rel_heading,
+                        'elevations': state.elevation + loc.rel_elevation,
+                        'positions': (loc.x, loc.y, loc.z),
+                        'room_ids': -1 if vp2room is None else vp2room[scan + '_' + loc.viewpointId]['id'],
+                    }
+        for c in adj_dict.values():
+            for key, values in columns.items():
+                values.append(c[key])
+        offsets.append(offsets[-1] + len(adj_dict))
+
+    return {
+        'viewpoints': np.array(viewpoints),
+        'offsets': np.array(offsets, dtype=np.int64),
+        'cand_vpids': np.array(columns['cand_vpids'], dtype=np.array(viewpoints).dtype),
+        'point_ids': np.array(columns['point_ids'], dtype=np.int64),
+        'nav_idxs': np.array(columns['nav_idxs'], dtype=np.int64),
+        'headings': np.array(columns['headings'], dtype=np.float64),
+        'elevations': np.array(columns['elevations'], dtype=np.float64),
+        'positions': np.array(columns['positions'], dtype=np.float64).reshape(-1, 3),
+        'room_ids': np.array(columns['room_ids'], dtype=np.int64),
+    }
+
+
+def candidate_table_file(table_dir, scan):
+    return os.path.join(table_dir, '%s_candidates.npz' % scan)
+
+
+class CandidateTable(object):
+    ''' Lazily loads the per-scan tables written by precompute_candidates.py '''
+
+    def __init__(self, table_dir):
+        self.table_dir = table_dir
+        self._tables = {}
+
+    def _get_table(self, scan):
+        if scan not in self._tables:
+            with np.load(candidate_table_file(self.table_dir, scan)) as f:
+                table = {k: f[k] for k in f.files}
+            table['vp2row'] = {vp: row for row, vp in enumerate(table['viewpoints'].tolist())}
+            table['cand_vpids'] = table['cand_vpids'].tolist()
+            table['positions'] = [tuple(x) for x in table['positions'].tolist()]
+            self._tables[scan] = table
+        return self._tables[scan]
+
+    def get_candidate(self, scanId, viewpointId, viewId, features, angle_feat_size, rec_features=None):
+        ''' Candidate dicts of make_candidate (without step_score_to_goal), with
+            the angle and visual features of all candidates gathered at once. '''
+        table = self._get_table(scanId)
+        row = table['vp2row'][viewpointId]
+        start, end = table['offsets'][row], table['offsets'][row + 1]
+
+        base_heading = (viewId % 12) * math.radians(30)
+        base_elevation = (viewId // 12 - 1) * math.radians(30)
+        point_ids = table['point_ids'][start: end]
+        headings = table['headings'][start: end] - base_heading
+        elevations = table['elevations'][start: end] - base_elevation
+        angle_fts = batch_angle_feature(headings, elevations, angle_feat_size)
+        cand_fts = np.concatenate([features[point_ids], angle_fts], -1)
+        if rec_features is not None:
+            rec_cand_fts = np.concatenate([rec_features[point_ids], angle_fts], -1)
+
+        candidate = []
+        for k, ix in enumerate(range(start, end)):
+            c = {
+                'heading': headings[k],
+                'elevation': elevations[k],
+                'scanId': scanId,
+                'viewpointId': table['cand_vpids'][ix],
+                'pointId': int(point_ids[k]),
+                'idx': int(table['nav_idxs'][ix]),
+                'feature': cand_fts[k],
+                'position': table['positions'][ix],
+            }
+            if rec_features is not None:
+                c['rec_feature'] = rec_cand_fts[k]
+            if table['room_ids'][ix] >= 0:
+                c['room_type'] = int(table['room_ids'][ix])
+            candidate.append(c)
+        return candidate
@@ -9,11 +9,8 @@ import networkx as nx
 from collections import defaultdict
 import copy
 import h5py
-import cv2 
-import MatterSim
 import sys 
-from utils.data import load_nav_graphs, new_simulator
-from utils.data import angle_feature, get_all_point_angle_feature
+from utils.data import angle_feature
 
 CROP_SIZE = 5
 class FeaturesDB(object):
@@ -34,24 +31,27 @@ class EnvBatch(object):
     ''' A simple wrapper for a batch of MatterSim environments,
         using discretized viewpoints and pretrained features '''
 
-    def __init__(self, connectivity_dir, scan_data_dir=None, feat_db=None, rec_feat_db=None, batch_size=100):
+    def __init__(self, connectivity_dir, scan_data_dir=None, feat_db=None, rec_feat_db=None, batch_size=100, feat_bundle=None):
         """
         1. Load pretrained image feature
         2. Init the Simulator.
         :param feat_db: The name of file stored the feature.
         :param batch_size:  Used to create the simulator list.
+        :param feat_bundle: FeatureBundle holding the knowledge and crop features (optional).
         """
         self.feat_db = feat_db
         self.rec_feat_db = rec_feat_db
-        self.crop_db = FeaturesDB("../datasets/visionary/clip_crop_image.hdf5")
-        self.knowledge_db = FeaturesDB("../datasets/visionary/captions.hdf5")
+        self.feat_bundle = feat_bundle
+        if feat_bundle is None:
+            self.crop_db = FeaturesDB("../datasets/visionary/clip_crop_image.hdf5")
+            self.knowledge_db = FeaturesDB("../datasets/visionary/captions.hdf5")
         self.image_w = 640
         self.image_h = 480
         self.vfov = 60
         
         self.sims = []
         for i in range(batch_size):
-            sim = MatterSim.Simulator()
+            sim = self._new_simulator()
             if scan_data_dir:
                 sim.setDatasetPath(scan_data_dir)
             sim.setNavGraphPath(connectivity_dir)
@@ -63,6 +63,10 @@ class EnvBatch(object):
             sim.initialize()
             self.sims.append(sim)
 
+    def _new_simulator(self):
+        import MatterSim
+        return MatterSim.Simulator()
+
     def _make_id(self, scanId, viewpointId):
         return scanId + '_' + viewpointId
 
@@ -70,6 +74,19 @@ class EnvBatch(object):
         for i, (scanId, viewpointId, heading) in enumerate(zip(scanIds, viewpointIds, headings)):
             self.sims[i].newEpisode([scanId], [viewpointId], [heading], [0])
 
+    def get_knowledge_crop_features(self, scanId, viewpointId):
+        """
+        :return: knowledge (36, 1, 512), crop (36, CROP_SIZE, 512)
+        """
+        if self.feat_bundle is not None:
+            return self.feat_bundle.get_knowledge_crop_feature(scanId, viewpointId)
+        key = self._make_id(scanId, viewpointId)
+        knowledge_feature = np.stack([
+            self.knowledge_db.get_feature(key + '_' + str(vp_index)).reshape(1, 512) for vp_index in range(36)
+        ], 0)
+        crop_feature = self.crop_db.get_feature(key).reshape(36, CROP_SIZE, 512)
+        return knowledge_feature, crop_feature
+
     def getStates(self):
         """
         Get list of states augmented with precomputed image features. rgb field will be empty.
@@ -100,11 +117,17 @@ class ReverieObjectNavBatch(object):
         self, view_db, obj_db, instr_data, connectivity_dir, obj2vps, 
         multi_endpoints=False, multi_startpoints=False,
         batch_size=64, angle_feat_size=4, max_objects=None, seed=0, name=None, sel_data_idxs=None,
+        cand_table=None, shortest_path_dir=None, scene_registry=None,
     ):  
 
         mp3d_scan_dir = "../mp3d/v1/scans"
         self.env = EnvBatch(connectivity_dir, scan_data_dir=mp3d_scan_dir, feat_db=view_db, batch_size=batch_size)
         self.obj_db = obj_db
+        self.cand_table = cand_table
+        if scene_registry is None:
+            from .scene_registry import SceneRegistry
+            scene_registry = SceneRegistry(connectivity_dir, shortest_path_dir=shortest_path_dir)
+        self.scene_registry = scene_registry
         self.data = instr_data
         self.scans = set([x['scan'] for x in self.data])
         self.multi_endpoints = multi_endpoints
@@ -142,8 +165,8 @@ class ReverieObjectNavBatch(object):
         self.ix = 0
         self._load_nav_graphs()
 
-        self.sim = new_simulator(self.connectivity_dir)
-        self.angle_feature = get_all_point_angle_feature(self.sim, self.angle_feat_size)
+        self.sim = self.scene_registry.sim
+        self.angle_feature = self.scene_registry.get_angle_feature(self.angle_feat_size)
         self.buffered_state_dict = {}
         print('%s loaded with %d instructions, using splits: %s' % (
             self.__class__.__name__, len(self.data), self.name))
@@ -168,13 +191,10 @@ class ReverieObjectNavBatch(object):
         :return: None
         """
         print('Loading navigation graphs for %d scans' % len(self.scans))
-        self.graphs = load_nav_graphs(self.connectivity_dir, self.scans)
-        self.shortest_paths = {}
-        for scan, G in self.graphs.items():  # compute all shortest paths
-            self.shortest_paths[scan] = dict(nx.all_pairs_dijkstra_path(G))
-        self.shortest_distances = {}
-        for scan, G in self.graphs.items():  # compute all shortest paths
-            self.shortest_distances[scan] = dict(nx.all_pairs_dijkstra_path_length(G))
+        self.graphs = self.scene_registry.get_graphs(self.scans)
+        shortest_paths = self.scene_registry.get_shortest_paths(self.scans)
+        self.shortest_paths = {scan: sp.path_map for scan, sp in shortest_paths.items()}
+        self.shortest_distances = {scan: sp.distance_map for scan, sp in shortest_paths.items()}
 
     def _next_minibatch(self, batch_size=None, **kwargs):
         """
@@ -227,6 +247,9 @@ class ReverieObjectNavBatch(object):
         base_heading = (viewId % 12) * math.radians(30)
         base_elevation = (viewId // 12 - 1) * math.radians(30)
 
+        if self.cand_table is not None:
+            return self.cand_table.get_candidate(scanId, viewpointId, viewId, feature, self.angle_feat_size)
+
         adj_dict = {}
         long_id = "%s_%s" % (scanId, viewpointId)
         
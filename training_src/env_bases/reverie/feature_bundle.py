@@ -0,0 +1,292 @@
+''' Single-file feature bundle for the VISIONARY env.
+
+Layout: 8-byte magic, uint64 header length, JSON header, then page aligned
+sections that are memory-mapped on load.
+    viewpoints    one record per scan_vp (sorted keys) holding the image,
+                  rec-image, caption-knowledge and crop features of its 36
+                  views back to back, so a full observation is one contiguous read
+    obj_*         ragged object features and attributes, indexed by obj_offsets
+    ins2img       (num_instrs, num_imgs, D) instruction-to-image features
+'''
+import json
+import struct
+import h5py
+import numpy as np
+
+from .data_utils import ObjectFeatureDB
+
+BUNDLE_MAGIC = b'VSNBNDL1'
+ALIGNMENT = 4096
+KNOWLEDGE_DIM = 512
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _read_ins2img(f, key, ft_dim):
+    ft = f[key][...][:, :ft_dim]
+    if len(ft.shape) == 4:
+        ft = np.squeeze(ft)
+    return ft
+
+
+def pack_feature_bundle(
+    bundle_file, img_ft_file, rec_img_ft_file=None, obj_ft_file=None,
+    knowledge_ft_file=None, crop_ft_file=None, ins2img_ft_file=None,
+    image_feat_size=None, obj_feat_size=None, crop_size=5, dtype=np.float32
+):
+    ''' Pack the hdf5 stores into one bundle. Only img_ft_file is mandatory;
+        the viewpoint keys are taken from it. '''
+    dtype = np.dtype(dtype)
+    img_f = h5py.File(img_ft_file, 'r')
+    vp_keys = sorted(img_f.keys())
+    num_views, image_dim = img_f[vp_keys[0]].shape[:2]
+    if image_feat_size is not None:
+        image_dim = min(image_dim, image_feat_size)
+
+    stores = {'image': img_f}
+    if rec_img_ft_file is not None:
+        stores['rec_image'] = h5py.File(rec_img_ft_file, 'r')
+    if knowledge_ft_file is not None:
+        stores['knowledge'] = h5py.File(knowledge_ft_file, 'r')
+    if crop_ft_file is not None:
+        stores['crop'] = h5py.File(crop_ft_file, 'r')
+    obj_f = h5py.File(obj_ft_file, 'r') if obj_ft_file is not None else None
+    ins2img_f = h5py.File(ins2img_ft_file, 'r') if ins2img_ft_file is not None else None
+
+    record_fields = [['image', dtype.str, [num_views, image_dim]]]
+    if 'rec_image' in stores:
+        record_fields.append(['rec_image', dtype.str, [num_views, image_dim]])
+    if 'knowledge' in stores:
+        record_fields.append(['knowledge', dtype.str, [num_views, 1, KNOWLEDGE_DIM]])
+    if 'crop' in stores:
+        record_fields.append(['crop', dtype.str, [num_views, crop_size, KNOWLEDGE_DIM]])
+
+    header = {
+        'vp_keys': vp_keys, 'record_fields': record_fields,
+        'crop_size': crop_size, 'sections': {},
+    }
+    sections = header['sections']
+    sections['viewpoints'] = {'dtype': None, 'shape': [len(vp_keys)]}
+
+    # objects are ragged: count them first to size the sections
+    obj_ids = []
+    if obj_f is not None:
+        obj_counts = np.zeros(len(vp_keys), dtype=np.int64)
+        obj_dim = None
+        for row, key in enumerate(vp_keys):
+            if key in obj_f:
+                obj_counts[row] = obj_f[key].shape[0]
+                obj_dim = obj_f[key].shape[1] if obj_dim is None else obj_dim
+                if obj_counts[row] > 0:
+                    obj_ids.extend(obj_f[key].attrs['obj_ids'].tolist())
+        if obj_feat_size is not None and obj_dim is not None:
+            obj_dim = min(obj_dim, obj_feat_size)
+        obj_offsets = np.concatenate([[0], np.cumsum(obj_counts)])
+        num_objs = int(obj_offsets[-1])
+        obj_ids = np.array(obj_ids)
+        sections['obj_offsets'] = {'dtype': '<i8', 'shape': [len(vp_keys) + 1]}
+        sections['obj_fts'] = {'dtype': dtype.str, 'shape': [num_objs, obj_dim or 0]}
+        sections['obj_directions'] = {'dtype': '<f4', 'shape': [num_objs, 2]}
+        sections['obj_sizes'] = {'dtype': '<f4', 'shape': [num_objs, 2]}
+        sections['obj_ids'] = {'dtype': obj_ids.dtype.str if num_objs > 0 else '<i8', 'shape': [num_objs]}
+
+    if ins2img_f is not None:
+        instr_keys = sorted(ins2img_f.keys())
+        num_imgs, ins2img_dim = _read_ins2img(ins2img_f, instr_keys[0], image_dim).shape
+        header['instr_keys'] = instr_keys
+        sections['ins2img'] = {'dtype': dtype.str, 'shape': [len(instr_keys), num_imgs, ins2img_dim]}
+
+    # assign offsets once the header size is known
+    # (the placeholders leave room for the offset digits)
+    record_dtype = _record_dtype(record_fields)
+    for section in sections.values():
+        section['offset'] = 10 ** 18
+    header_bytes = json.dumps(header).encode('utf-8')
+    offset = _align(len(BUNDLE_MAGIC) + 8 + len(header_bytes))
+    for name, section in sections.items():
+        section['offset'] = offset
+        item_dtype = record_dtype if name == 'viewpoints' else np.dtype(section['dtype'])
+        offset = _align(offset + item_dtype.itemsize * int(np.prod(section['shape'])))
+    header_bytes = json.dumps(header).encode('utf-8')
+    assert len(BUNDLE_MAGIC) + 8 + len(header_bytes) <= sections[next(iter(sections))]['offset']
+
+    with open(bundle_file, 'wb') as f:
+        f.write(BUNDLE_MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        f.truncate(offset)
+
+    def _open(name, item_dtype=None):
+        section = sections[name]
+        if item_dtype is None:
+            item_dtype = np.dtype(section['dtype'])
+        return np.memmap(bundle_file, dtype=item_dtype, mode='r+',
+                         offset=section['offset'], shape=tuple(section['shape']))
+
+    records = _open('viewpoints', record_dtype)
+    for row, key in enumerate(vp_keys):
+        record = records[row]
+        record['image'] = img_f[key][:, :image_dim]
+        if 'rec_image' in stores:
+            record['rec_image'] = stores['rec_image'][key][:, :image_dim]
+        if 'knowledge' in stores:
+            knowledge_f = stores['knowledge']
+            record['knowledge'] = np.stack([
+                knowledge_f['%s_%d' % (key, ix)][...].reshape(1, KNOWLEDGE_DIM) for ix in range(num_views)
+            ], 0)
+        if 'crop' in stores:
+            record['crop'] = stores['crop'][key][...].reshape(num_views, crop_size, KNOWLEDGE_DIM)
+    records.flush()
+    del records
+
+    if obj_f is not None and num_objs > 0:
+        _open('obj_offsets')[:] = obj_offsets
+        obj_fts = _open('obj_fts')
+        obj_directions = _open('obj_directions')
+        obj_sizes = _open('obj_sizes')
+        for row, key in enumerate(vp_keys):
+            start, end = obj_offsets[row], obj_offsets[row + 1]
+            if end > start:
+                obj_fts[start: end] = obj_f[key][:, :obj_dim]
+                obj_directions[start: end] = obj_f[key].attrs['directions']
+                obj_sizes[start: end] = obj_f[key].attrs['sizes']
+        _open('obj_ids')[:] = obj_ids
+        for section in (obj_fts, obj_directions, obj_sizes):
+            section.flush()
+    elif obj_f is not None:
+        _open('obj_offsets')[:] = obj_offsets
+
+    if ins2img_f is not None:
+        ins2img = _open('ins2img')
+        for row, key in enumerate(instr_keys):
+            ins2img[row] = _read_ins2img(ins2img_f, key, image_dim)
+        ins2img.flush()
+
+    for f in [img_f, obj_f, ins2img_f] + [v for k, v in stores.items() if k != 'image']:
+        if f is not None:
+            f.close()
+    return header
+
+
+def _record_dtype(record_fields):
+    return np.dtype([(name, np.dtype(dt), tuple(shape)) for name, dt, shape in record_fields])
+
+
+class FeatureBundle(object):
+    ''' Read-only view over a bundle written by pack_feature_bundle. '''
+
+    def __init__(self, bundle_file):
+        self.bundle_file = bundle_file
+        with open(bundle_file, 'rb') as f:
+            magic = f.read(len(BUNDLE_MAGIC))
+            if magic != BUNDLE_MAGIC:
+                raise ValueError('%s is not a feature bundle' % bundle_file)
+            header_len = struct.unpack('<Q', f.read(8))[0]
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+        self.crop_size = self.header['crop_size']
+        self.fields = [x[0] for x in self.header['record_fields']]
+        self._vp2row = {key: row for row, key in enumerate(self.header['vp_keys'])}
+        self._instr2row = {key: row for row, key in enumerate(self.header.get('instr_keys', []))}
+        self._open_sections()
+
+    def _open_sections(self):
+        self._sections = {}
+        for name, section in self.header['sections'].items():
+            if name == 'viewpoints':
+                item_dtype = _record_dtype(self.header['record_fields'])
+            else:
+                item_dtype = np.dtype(section['dtype'])
+            if int(np.prod(section['shape'])) == 0:
+                self._sections[name] = np.zeros(tuple(section['shape']), dtype=item_dtype)
+                continue
+            self._sections[name] = np.memmap(
+                self.bundle_file, dtype=item_dtype, mode='r',
+                offset=section['offset'], shape=tuple(section['shape'])
+            )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_sections'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open_sections()
+
+    def has(self, name):
+        return name in self.fields or name in self._sections
+
+    def get_viewpoint(self, scan, viewpoint):
+        ''' All per-view features of one viewpoint (a single record, no copy). '''
+        return self._sections['viewpoints'][self._vp2row['%s_%s' % (scan, viewpoint)]]
+
+    def get_knowledge_crop_feature(self, scan, viewpoint):
+        record = self.get_viewpoint(scan, viewpoint)
+        return record['knowledge'], record['crop']
+
+    def get_objects(self, scan, viewpoint):
+        row = self._vp2row.get('%s_%s' % (scan, viewpoint))
+        if row is None:
+            return None
+        start, end = self._sections['obj_offsets'][row: row + 2]
+        return (
+            self._sections['obj_fts'][start: end],
+            {
+                'directions': self._sections['obj_directions'][start: end],
+                'sizes': self._sections['obj_sizes'][start: end],
+                'obj_ids': self._sections['obj_ids'][start: end],
+            }
+        )
+
+    def get_ins2img(self, instr_id):
+        return self._sections['ins2img'][self._instr2row[instr_id]]
+
+    def image_db(self, image_feat_size, field='image'):
+        return BundleImageFeaturesDB(self, image_feat_size, field=field)
+
+    def obj_db(self, obj_feat_size):
+        return BundleObjectFeatureDB(self, obj_feat_size)
+
+    def ins2img_db(self, image_feat_size):
+        return BundleIns2ImageFeaturesDB(self, image_feat_size)
+
+
+class BundleImageFeaturesDB(object):
+    ''' ImageFeaturesDB interface over the image or rec_image field. '''
+    def __init__(self, bundle, image_feat_size, field='image'):
+        self.bundle = bundle
+        self.image_feat_size = image_feat_size
+        self.field = field
+
+    def get_image_feature(self, scan, viewpoint):
+        return self.bundle.get_viewpoint(scan, viewpoint)[self.field][:, :self.image_feat_size]
+
+
+class BundleIns2ImageFeaturesDB(object):
+    def __init__(self, bundle, image_feat_size):
+        self.bundle = bundle
+        self.image_feat_size = image_feat_size
+
+    def get_ins2image_feature(self, instr_id):
+        return self.bundle.get_ins2img(instr_id)[:, :self.image_feat_size]
+
+
+class BundleObjectFeatureDB(ObjectFeatureDB):
+    def __init__(self, bundle, obj_feat_size):
+        super().__init__(bundle.bundle_file, obj_feat_size)
+        self.bundle = bundle
+
+    def load_feature(self, scan, viewpoint, max_objects=None):
+        objects = self.bundle.get_objects(scan, viewpoint)
+        if objects is None or len(objects[0]) == 0:
+            obj_fts = np.zeros((0, self.obj_feat_size), dtype=np.float32)
+            obj_attrs = {}
+        else:
+            obj_fts, obj_attrs = objects
+            obj_fts = obj_fts[:, :self.obj_feat_size]
+        if max_objects is not None:
+            obj_fts = obj_fts[:max_objects]
+            obj_attrs = {k: v[:max_objects] for k, v in obj_attrs.items()}
+        return obj_fts, obj_attrs
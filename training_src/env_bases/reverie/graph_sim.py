@@ -0,0 +1,219 @@
+''' Simulator-free backend: a stand-in for MatterSim.Simulator (rendering
+disabled, discretized views) driven only by the connectivity graphs.
+
+The navigable locations of a viewpoint are the unobstructed neighbours inside
+the horizontal field of view, sorted by angular distance from the view
+centre, as in MatterSim. They only depend on (viewpoint, viewIndex) and are
+computed once per scan graph. Use validate_graph_sim.py to check the
+backend against states recorded with MatterSim.
+'''
+import os
+import json
+import math
+import numpy as np
+
+from .env_base import EnvBatch
+
+HEADING_COUNT = 12
+ELEVATION_COUNT = 3
+ANGLE_INCREMENT = math.radians(30)
+
+_SCAN_GRAPHS = {}
+
+
+def _lround(x):
+    ''' C lround: nearest integer, halfway cases away from zero '''
+    r = math.floor(abs(x))
+    if abs(x) - r >= 0.5:
+        r += 1
+    return int(r) if x >= 0 else -int(r)
+
+
+class Viewpoint(object):
+    def __init__(self, viewpointId, ix, x, y, z, rel_heading=0., rel_elevation=0., rel_distance=0.):
+        self.viewpointId = viewpointId
+        self.ix = ix
+        self.x = x
+        self.y = y
+        self.z = z
+        self.rel_heading = rel_heading
+        self.rel_elevation = rel_elevation
+        self.rel_distance = rel_distance
+
+
+class SimState(object):
+    def __init__(self, scanId, location, viewIndex, heading, elevation, navigableLocations, step=0):
+        self.scanId = scanId
+        self.location = location
+        self.viewIndex = viewIndex
+        self.heading = heading
+        self.elevation = elevation
+        self.navigableLocations = navigableLocations
+        self.step = step
+
+
+class ScanGraph(object):
+    ''' Positions and unobstructed neighbours of the included viewpoints of a scan. '''
+
+    def __init__(self, connectivity_dir, scan, hfov):
+        with open(os.path.join(connectivity_dir, '%s_connectivity.json' % scan)) as f:
+            data = json.load(f)
+        self.scan = scan
+        self.cos_half_hfov = math.cos(hfov / 2.0)
+        self.positions = np.array([[x['pose'][3], x['pose'][7], x['pose'][11]] for x in data])
+        self.vp_ids = [x['image_id'] for x in data]
+        self.vp2ix = {x['image_id']: ix for ix, x in enumerate(data) if x['included']}
+        self.neighbours = {}
+        for ix, item in enumerate(data):
+            if item['included']:
+                self.neighbours[ix] = np.array([
+                    j for j, conn in enumerate(item['unobstructed']) if conn and data[j]['included']
+                ], dtype=np.int64)
+        self._nav_cache = {}
+
+    def location(self, ix):
+        x, y, z = self.positions[ix]
+        return Viewpoint(self.vp_ids[ix], ix, x, y, z)
+
+    def navigable_locations(self, ix, view_index, heading, elevation):
+        key = (ix, view_index)
+        if key not in self._nav_cache:
+            self._nav_cache[key] = self._compute_navigable_locations(ix, heading, elevation)
+        return self._nav_cache[key]
+
+    def _compute_navigable_locations(self, ix, heading, elevation):
+        nbrs = self.neighbours[ix]
+        locs = [self.location(ix)]
+        if len(nbrs) == 0:
+            return locs
+        target_dir = self.positions[nbrs] - self.positions[ix]
+        rel_distance = np.linalg.norm(target_dir, axis=1)
+        xy_dist = np.linalg.norm(target_dir[:, :2], axis=1)
+        rel_elevation = np.arctan2(target_dir[:, 2], xy_dist) - elevation
+        # heading is clockwise from +y
+        cam_x, cam_y = math.sin(heading), math.cos(heading)
+        tx, ty = target_dir[:, 0] / xy_dist, target_dir[:, 1] / xy_dist
+        cos_angle = tx * cam_x + ty * cam_y
+        rel_heading = np.arctan2(tx * cam_y - ty * cam_x, cos_angle)
+
+        visible = np.nonzero(cos_angle >= self.cos_half_hfov)[0]
+        order = visible[np.argsort(np.sqrt(rel_heading[visible] ** 2 + rel_elevation[visible] ** 2), kind='stable')]
+        for k in order:
+            loc = self.location(nbrs[k])
+            loc.rel_heading = rel_heading[k]
+            loc.rel_elevation = rel_elevation[k]
+            loc.rel_distance = rel_distance[k]
+            locs.append(loc)
+        return locs
+
+
+def load_scan_graph(connectivity_dir, scan, hfov):
+    key = (connectivity_dir, scan, hfov)
+    if key not in _SCAN_GRAPHS:
+        _SCAN_GRAPHS[key] = ScanGraph(connectivity_dir, scan, hfov)
+    return _SCAN_GRAPHS[key]
+
+
+class GraphSimulator(object):
+    ''' MatterSim.Simulator interface with batch size 1 and discretized views. '''
+
+    def __init__(self):
+        self.connectivity_dir = None
+        self.image_w = 640
+        self.image_h = 480
+        self.vfov = math.radians(60)
+        self.state = None
+
+    # configuration calls of MatterSim, only the ones affecting navigation are kept
+    def setNavGraphPath(self, connectivity_dir):
+        self.connectivity_dir = connectivity_dir
+
+    def setCameraResolution(self, width, height):
+        self.image_w, self.image_h = width, height
+
+    def setCameraVFOV(self, vfov):
+        self.vfov = vfov
+
+    def setDiscretizedViewingAngles(self, discretized):
+        assert discretized, 'GraphSimulator only supports discretized views'
+
+    def setDatasetPath(self, path):
+        pass
+
+    def setRenderingEnabled(self, enabled):
+        assert not enabled, 'GraphSimulator cannot render'
+
+    def setBatchSize(self, batch_size):
+        assert batch_size == 1
+
+    def initialize(self):
+        pass
+
+    @property
+    def hfov(self):
+        return self.vfov * self.image_w / self.image_h
+
+    def _update_state(self, scanId, ix, view_index, heading, elevation, step):
+        graph = load_scan_graph(self.connectivity_dir, scanId, self.hfov)
+        self.state = SimState(
+            scanId, graph.location(ix), view_index, heading, elevation,
+            graph.navigable_locations(ix, view_index, heading, elevation), step=step
+        )
+
+    def newEpisode(self, scanIds, viewpointIds, headings, elevations):
+        scanId, viewpointId, heading, elevation = scanIds[0], viewpointIds[0], headings[0], elevations[0]
+        graph = load_scan_graph(self.connectivity_dir, scanId, self.hfov)
+        # snap to the nearest discretized view as MatterSim does: lround of the signed
+        # angle, only a full turn is wrapped, so a negative heading stays negative
+        heading_step = _lround(heading / ANGLE_INCREMENT)
+        if heading_step == HEADING_COUNT:
+            heading_step = 0
+        elevation_step = min(max(_lround(elevation / ANGLE_INCREMENT), -1), ELEVATION_COUNT - 2)
+        self._update_state(
+            scanId, graph.vp2ix[viewpointId], heading_step % HEADING_COUNT + (elevation_step + 1) * HEADING_COUNT,
+            heading_step * ANGLE_INCREMENT, elevation_step * ANGLE_INCREMENT, 0
+        )
+
+    def getState(self):
+        return [self.state]
+
+    def makeAction(self, indices, headings, elevations):
+        index, heading, elevation = indices[0], headings[0], elevations[0]
+        state = self.state
+        ix = state.navigableLocations[index].ix if index > 0 else state.location.ix
+        view_index = state.viewIndex
+        new_heading, new_elevation = state.heading, state.elevation
+        if heading > 0:
+            new_heading += ANGLE_INCREMENT
+            view_index = view_index // HEADING_COUNT * HEADING_COUNT + (view_index + 1) % HEADING_COUNT
+        elif heading < 0:
+            new_heading -= ANGLE_INCREMENT
+            view_index = view_index // HEADING_COUNT * HEADING_COUNT + (view_index - 1) % HEADING_COUNT
+        if elevation > 0 and view_index < (ELEVATION_COUNT - 1) * HEADING_COUNT:
+            new_elevation += ANGLE_INCREMENT
+            view_index += HEADING_COUNT
+        elif elevation < 0 and view_index >= HEADING_COUNT:
+            new_elevation -= ANGLE_INCREMENT
+            view_index -= HEADING_COUNT
+        new_heading = math.fmod(new_heading, 2 * math.pi)
+        while new_heading < 0:
+            new_heading += 2 * math.pi
+        self._update_state(state.scanId, ix, view_index, new_heading, new_elevation, state.step + 1)
+
+
+def new_graph_simulator(connectivity_dir):
+    sim = GraphSimulator()
+    sim.setNavGraphPath(connectivity_dir)
+    sim.setCameraResolution(640, 480)
+    sim.setCameraVFOV(math.radians(60))
+    sim.setDiscretizedViewingAngles(True)
+    sim.setBatchSize(1)
+    sim.initialize()
+    return sim
+
+
+class GraphEnvBatch(EnvBatch):
+    ''' EnvBatch on GraphSimulators, runs without MatterSim '''
+
+    def _new_simulator(self):
+        return GraphSimulator()
@@ -0,0 +1,146 @@
+''' Vectorized REVERIE navigation and grounding metrics.
+
+The predicted and ground truth trajectories are turned into integer viewpoint
+arrays of the compact shortest path store (ShortestPaths) once, per scan.
+Lengths, success, oracle success, SPL, RGS and RGSPL are then NumPy ops over
+the ragged offsets of the concatenated trajectories. Only numpy is needed, so
+the scorer also runs outside the training environment.
+
+The distances are the float32 ones of ShortestPaths (summed in float64): the
+lengths, SPL and RGSPL agree with a per-item computation on the float64 graph
+distances up to float32 rounding (about 1e-7 relative), the other metrics are
+the same.
+'''
+import numpy as np
+from collections import defaultdict
+
+# gt path lengths (meters) of the length breakdown
+LENGTH_BUCKETS = (5., 10., 15., 20.)
+
+
+def _ragged_sums(values, offsets):
+    ''' sums of values[offsets[i]: offsets[i+1]], 0 for empty rows '''
+    sums = np.zeros(len(offsets) - 1, dtype=np.float64)
+    nonempty = offsets[1:] > offsets[:-1]
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(values, offsets[:-1][nonempty])
+    return sums
+
+
+def _path_lengths(distances, nodes, offsets):
+    ''' summed edge distances of the trajectories nodes[offsets[i]: offsets[i+1]] (each non-empty) '''
+    edges = distances[nodes[:-1], nodes[1:]].astype(np.float64)
+    keep = np.ones(len(edges), dtype=bool)
+    keep[offsets[1:-1] - 1] = False     # pairs across two trajectories
+    return _ragged_sums(edges[keep], offsets - np.arange(len(offsets)))
+
+
+def _to_nodes(vp2idx, paths):
+    ''' concatenated viewpoint indices and offsets of a list of viewpoint lists '''
+    lens = np.array([len(path) for path in paths], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lens)])
+    nodes = np.fromiter((vp2idx[vp] for path in paths for vp in path), dtype=np.int64, count=offsets[-1])
+    return nodes, offsets
+
+
+def _flatten(pred_path):
+    return [vp for step in pred_path for vp in step]
+
+
+def score_predictions(preds, gt_trajs, shortest_paths, obj2vps):
+    ''' Per prediction metrics of the REVERIE evaluation.
+        preds: [{'instr_id', 'trajectory': [[vp, ...], ...], 'predObjId'}]
+        gt_trajs: {instr_id: (scan, gt_path, gt_objid)}
+        shortest_paths: {scan: ShortestPaths}, obj2vps: {scan_objid: [vp]}
+        Returns {metric: array in the order of preds}, plus instr_id / scan / gt_lengths. '''
+    num_preds = len(preds)
+    metrics = {
+        k: np.zeros(num_preds, dtype=np.float64) for k in [
+            'action_steps', 'trajectory_steps', 'trajectory_lengths', 'success', 'oracle_success',
+            'spl', 'rgs', 'rgspl', 'gt_lengths',
+        ]
+    }
+    scans = []
+    scan_items = defaultdict(list)
+    for i, item in enumerate(preds):
+        scan = gt_trajs[item['instr_id']][0]
+        scans.append(scan)
+        scan_items[scan].append(i)
+    metrics['instr_id'] = [item['instr_id'] for item in preds]
+    metrics['scan'] = scans
+
+    for scan, idxs in scan_items.items():
+        sp = shortest_paths[scan]
+        paths = [_flatten(preds[i]['trajectory']) for i in idxs]
+        gt_paths = [gt_trajs[preds[i]['instr_id']][1] for i in idxs]
+        gt_objids = [str(gt_trajs[preds[i]['instr_id']][2]) for i in idxs]
+        nodes, offsets = _to_nodes(sp.vp2idx, paths)
+        gt_nodes, gt_offsets = _to_nodes(sp.vp2idx, gt_paths)
+        assert np.array_equal(nodes[offsets[:-1]], gt_nodes[gt_offsets[:-1]]), \
+            'Result trajectories should include the start position'
+
+        idxs = np.array(idxs)
+        lens = np.diff(offsets)
+        metrics['action_steps'][idxs] = [len(preds[i]['trajectory']) - 1 for i in idxs]
+        metrics['trajectory_steps'][idxs] = lens - 1
+        traj_lengths = _path_lengths(sp.distances, nodes, offsets)
+        gt_lengths = _path_lengths(sp.distances, gt_nodes, gt_offsets)
+
+        # navigation: success is to arrive to a viewpoint where the object is visible
+        objids = sorted(set(gt_objids))
+        goal_masks = np.zeros((len(objids), len(sp.vp_ids)), dtype=bool)
+        for k, objid in enumerate(objids):
+            goal_vps = obj2vps['%s_%s' % (scan, objid)]
+            assert len(goal_vps) > 0, '%s_%s' % (scan, objid)
+            goal_masks[k, [sp.vp2idx[vp] for vp in goal_vps]] = True
+        goal_rows = np.searchsorted(objids, gt_objids)
+        in_goal = goal_masks[np.repeat(goal_rows, lens), nodes]
+        success = in_goal[offsets[1:] - 1].astype(np.float64)
+        path_weights = gt_lengths / np.maximum(np.maximum(traj_lengths, gt_lengths), 0.01)
+
+        pred_objids = [str(preds[i].get('predObjId', None)) for i in idxs]
+        rgs = (np.array(pred_objids) == np.array(gt_objids)).astype(np.float64)
+
+        metrics['trajectory_lengths'][idxs] = traj_lengths
+        metrics['gt_lengths'][idxs] = gt_lengths
+        metrics['success'][idxs] = success
+        metrics['oracle_success'][idxs] = np.maximum.reduceat(in_goal, offsets[:-1])
+        metrics['spl'][idxs] = success * path_weights
+        metrics['rgs'][idxs] = rgs
+        metrics['rgspl'][idxs] = rgs * path_weights
+    return metrics
+
+
+def average_metrics(metrics, idxs=None):
+    ''' the summary of eval_metrics, over the predictions idxs (all by default) '''
+    def mean(k):
+        return np.mean(metrics[k] if idxs is None else metrics[k][idxs])
+    return {
+        'action_steps': mean('action_steps'),
+        'steps': mean('trajectory_steps'),
+        'lengths': mean('trajectory_lengths'),
+        'sr': mean('success') * 100,
+        'oracle_sr': mean('oracle_success') * 100,
+        'spl': mean('spl') * 100,
+        'rgs': mean('rgs') * 100,
+        'rgspl': mean('rgspl') * 100,
+    }
+
+
+def metric_breakdowns(metrics, length_buckets=LENGTH_BUCKETS):
+    ''' {'scan': {scan: summary}, 'gt_length': {'a-bm': summary}} with the number of
+        predictions of each group under 'num' '''
+    breakdowns = {'scan': {}, 'gt_length': {}}
+    scans = np.array(metrics['scan'])
+    for scan in sorted(set(metrics['scan'])):
+        idxs = np.nonzero(scans == scan)[0]
+        breakdowns['scan'][scan] = dict(average_metrics(metrics, idxs), num=len(idxs))
+
+    edges = [0.] + list(length_buckets) + [np.inf]
+    buckets = np.digitize(metrics['gt_lengths'], length_buckets)
+    for k in range(len(edges) - 1):
+        idxs = np.nonzero(buckets == k)[0]
+        if len(idxs) > 0:
+            name = '%g-%gm' % (edges[k], edges[k + 1]) if k < len(length_buckets) else '>=%gm' % edges[k]
+            breakdowns['gt_length'][name] = dict(average_metrics(metrics, idxs), num=len(idxs))
+    return breakdowns
@@ -21,6 +21,19 @@ def parse_args():
     parser.add_argument('--world_size', type=int, default=1, help='number of gpus')
     parser.add_argument('--local_rank', type=int, default=-1)
     parser.add_argument("--node_rank", type=int, default=0, help="Id of the node")
+    parser.add_argument(
+        '--device', choices=['cuda', 'cpu'], default='cuda',
+        help='cpu evaluation runs under torch.inference_mode'
+    )
+    parser.add_argument('--num_threads', type=int, default=None, help='torch intra-op threads on cpu')
+    parser.add_argument(
+        '--amp', choices=['none', 'fp16', 'bf16'], default='none',
+        help='mixed precision autocast for rollouts, fp16 trains with a GradScaler'
+    )
+    parser.add_argument(
+        '--quantize', action='store_true', default=False,
+        help='cpu evaluation: dynamic int8 quantization of the Linear layers after loading'
+    )
     
     # General
     parser.add_argument('--iters', type=int, default=100000, help='training iterations')
@@ -32,6 +45,28 @@ def parse_args():
     parser.add_argument('--max_action_len', type=int, default=15)
     parser.add_argument('--max_objects', type=int, default=20)
     parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument(
+        '--batch_obs', action='store_true', default=False,
+        help='build the panorama inputs of the whole batch with array ops in the env'
+    )
+    parser.add_argument(
+        '--batched_gmap', action='store_true', default=False,
+        help='keep the graph maps of the whole batch in padded arrays (BatchedGraphMap)'
+    )
+    parser.add_argument(
+        '--compact_batch', action='store_true', default=False,
+        help='during evaluation, only run the model forwards of a rollout step on the episodes that have not ended'
+    )
+    parser.add_argument(
+        '--async_env', action='store_true', default=False,
+        help='teacher forcing: step the env and build the next observations in a worker thread '
+             'while the navigation policy runs'
+    )
+    parser.add_argument(
+        '--continuous_eval', action='store_true', default=False,
+        help='evaluation: refill the slot of an ended episode with the next instruction '
+             '(ReverieMapAgent.rollout_continuous), argmax feedback without --record_rt'
+    )
     parser.add_argument('--ignoreid', type=int, default=-100, help='ignoreid for action')
     
     # Load the model from
@@ -45,6 +80,10 @@ def parse_args():
     parser.add_argument("--aug", default=None)
     parser.add_argument('--bert_ckpt_file', default=None, help='init vlnbert')
     parser.add_argument('--eval_ckpt_file', default=None, help='Ckpt for evaluation')
+    parser.add_argument(
+        '--eval_workers', type=int, default=1,
+        help='eval.py: evaluate the minibatches round robin in this many processes, same output as one'
+    )
 
     # Listener Model Config
     parser.add_argument("--ml_weight", type=float, default=0.20)
@@ -52,6 +91,30 @@ def parse_args():
 
     parser.add_argument("--features", type=str, default='vitbase')
     parser.add_argument('--obj_features', type=str, default='vitbase')
+    parser.add_argument(
+        '--img_ft_backend', choices=['hdf5', 'mmap'], default='hdf5',
+        help='mmap reads the .npy files written by pack_features.py next to the hdf5 files'
+    )
+    parser.add_argument(
+        '--feat_bundle', type=str, default=None,
+        help='feature bundle written by pack_features.py --bundle, replaces all hdf5 stores'
+    )
+    parser.add_argument(
+        '--cand_table_dir', type=str, default=None,
+        help='candidate tables written by precompute_candidates.py, replaces the simulator sweeps'
+    )
+    parser.add_argument(
+        '--sim_backend', choices=['mattersim', 'graph'], default='mattersim',
+        help='graph runs the env on the connectivity graphs without MatterSim'
+    )
+    parser.add_argument(
+        '--shortest_path_dir', type=str, default=None,
+        help='cache of the per-scan shortest path .npz files, defaults to R2R/shortest_paths'
+    )
+    parser.add_argument(
+        '--scene_shm_dir', type=str, default=None,
+        help='node-local shared memory dir (e.g. /dev/shm/visionary) for the shortest paths of all ranks'
+    )
 
     parser.add_argument('--fix_lang_embedding', action='store_true', default=False)
     parser.add_argument('--fix_pano_embedding', action='store_true', default=False)
@@ -159,6 +222,9 @@ def postprocess_args(args):
     args.ins2img_ft_file = os.path.join(ROOTDIR, 'REVERIE', 'features', ins2img_ft_file_map[args.features])
 
     args.rec_img_ft_file = os.path.join(ROOTDIR, 'R2R', 'features', 'rec_pth_clip_vit_l_14_336px.hdf5')
+    if args.img_ft_backend == 'mmap':
+        args.img_ft_file = os.path.splitext(args.img_ft_file)[0] + '.npy'
+        args.rec_img_ft_file = os.path.splitext(args.rec_img_ft_file)[0] + '.npy'
 
     obj_ft_file_map = {
         'vitbase': 'obj.avg.top3.min80_vit_base_patch16_224_imagenet.hdf5',
@@ -166,6 +232,8 @@ def postprocess_args(args):
     args.obj_ft_file = os.path.join(ROOTDIR, 'REVERIE', 'features', obj_ft_file_map[args.obj_features])
     
     args.connectivity_dir = os.path.join(ROOTDIR, 'R2R', 'connectivity')
+    if args.shortest_path_dir is None:
+        args.shortest_path_dir = os.path.join(ROOTDIR, 'R2R', 'shortest_paths')
     args.scan_data_dir = os.path.join(ROOTDIR, 'Matterport3D', 'v1_unzip_scans')
 
     args.anno_dir = os.path.join(ROOTDIR, 'REVERIE', 'annotations')
@@ -0,0 +1,71 @@
+''' Per-scan navigation data shared by all envs of a process.
+
+build_dataset creates the train and val envs on the same scans; with a
+SceneRegistry the nav graphs, shortest paths, the helper simulator and the
+36x36 view angle features are built once and every env gets the same
+(read-only) objects. With shared_dir the shortest path matrices are
+memory-mapped from node-local shared memory, so DDP ranks on a node share
+them too.
+'''
+import os
+import numpy as np
+
+from utils.data import load_nav_graphs, new_simulator, get_all_point_angle_feature
+from warmup_src.data.shortest_paths import load_shortest_paths
+from .graph_sim import new_graph_simulator
+
+
+class SceneRegistry(object):
+    def __init__(
+        self, connectivity_dir, sim_backend='mattersim', shortest_path_dir=None, shared_dir=None,
+        shared_writer=True
+    ):
+        self.connectivity_dir = connectivity_dir
+        self.sim_backend = sim_backend
+        self.shortest_path_dir = shortest_path_dir
+        self.shared_dir = shared_dir
+        self.shared_writer = shared_writer
+        self._graphs = {}
+        self._sim = None
+        self._angle_features = {}
+
+    @property
+    def sim(self):
+        ''' the single helper simulator for candidate sweeps, used synchronously by the envs '''
+        if self._sim is None:
+            if self.sim_backend == 'graph':
+                self._sim = new_graph_simulator(self.connectivity_dir)
+            else:
+                self._sim = new_simulator(self.connectivity_dir)
+        return self._sim
+
+    def get_graphs(self, scans):
+        missing = [scan for scan in scans if scan not in self._graphs]
+        if len(missing) > 0:
+            self._graphs.update(load_nav_graphs(self.connectivity_dir, missing))
+        return {scan: self._graphs[scan] for scan in scans}
+
+    def get_shortest_paths(self, scans):
+        return load_shortest_paths(
+            self.get_graphs(scans), cache_dir=self.shortest_path_dir, shared_dir=self.shared_dir,
+            shared_writer=self.shared_writer
+        )
+
+    def get_angle_feature(self, angle_feat_size):
+        ''' [36 base views] of (36, angle_feat_size) '''
+        if angle_feat_size not in self._angle_features:
+            angle_feature = get_all_point_angle_feature(self.sim, angle_feat_size)
+            for ft in angle_feature:
+                ft.flags.writeable = False
+            self._angle_features[angle_feat_size] = angle_feature
+        return self._angle_features[angle_feat_size]
+
+
+def build_scene_registry(args):
+    # local rank 0 writes the shared files of the node
+    local_rank = args.local_rank if args.local_rank != -1 else int(os.environ.get('LOCAL_RANK', 0))
+    return SceneRegistry(
+        args.connectivity_dir, sim_backend=args.sim_backend,
+        shortest_path_dir=args.shortest_path_dir, shared_dir=args.scene_shm_dir,
+        shared_writer=local_rank <= 0
+    )
@@ -1,9 +1,14 @@
 import os 
 import json 
-import MatterSim
-from utils.distributed import is_default_gpu, merge_dist_results, all_gather, init_distributed
-from utils.data import ImageFeaturesDB, Ins2ImageFeaturesDB
+import torch
+import multiprocessing
+from utils.distributed import is_default_gpu, merge_dist_results, merge_shard_results, all_gather, init_distributed
+from utils.data import get_image_features_db, Ins2ImageFeaturesDB
 from env_bases.reverie.data_utils import ObjectFeatureDB, construct_instrs, load_obj2vps, load_vp2roomlabel
+from env_bases.reverie.feature_bundle import FeatureBundle
+from env_bases.reverie.candidate_table import CandidateTable
+from env_bases.reverie.scene_registry import build_scene_registry
+from env_bases.reverie.nav_metrics import score_predictions, average_metrics, metric_breakdowns
 from env_bases.reverie.parser import parse_args
 from env import ReverNavBatchEnv
 from rever_agent import ReverieMapAgent
@@ -11,30 +16,33 @@ from utils.misc import set_random_seed
 
 class Evaluater(object):
     """Class for evaluation """
-    def __init__(self, args, splits,):
+    def __init__(self, args, splits, rank=0, gt_only=False):
         r"""
         splits: should be a list eg: ['val_unseen','val_seen']
+        gt_only: only load the ground truth to score the predictions of the eval workers
         """
         self.args = args 
         self.splits = splits 
+        self.rank = rank
         self.allowd_split_list = ['val_train_seen', 'val_seen', 'val_unseen', 'test']
         
         self.output_root = None 
-        self._load_feat_db()
-        self._build_dataset()
+        if gt_only:
+            self._load_ground_truth()
+        else:
+            self._load_feat_db()
+            self._build_dataset()
 
     def eval(self,rank=0):
         
-        agent_class = ReverieMapAgent
-        for env_name, env in self.eval_envs.items():
+        if self.args.eval_workers > 1:
+            shard_preds = run_eval_workers(self.args, self.splits)
+        for env_name in self.splits:
             
-            agent = ReverieMapAgent(self.args, env, rank=rank)
-            print(f"Loading model from {self.args.eval_ckpt_file}")
-          
-            agent.load(self.args.eval_ckpt_file)
-            print(f"Running evaluation on {env_name}")
-            agent.test(use_dropout=False, feedback='argmax', iters=None)
-            preds = agent.get_results(detailed_output=False)
+            if self.args.eval_workers > 1:
+                preds = merge_shard_results([x[env_name] for x in shard_preds])
+            else:
+                preds = self.predict(env_name, self.eval_envs[env_name], rank=rank)
 
             for pre in preds:
                 pre["trajectory"] = [[x] for x in sum(pre["trajectory"],[])]
@@ -50,12 +58,41 @@ class Evaluater(object):
                 sort_keys=True, indent=4, separators=(',',': '))
             print(f"Finish evaluation on {env_name} dataset !!!")
             if env_name != 'test':
-                avg_metrics, _ = env.eval_metrics(preds)
+                avg_metrics, metrics = self.eval_metrics(env_name, preds)
                 print(f"Test results on {env_name}: ")
                 print(avg_metrics)
+                breakdown_file = os.path.join(output_dir, "breakdown_"+env_name+".json")
+                print(f"Saving per scan / gt length results to {breakdown_file}")
+                json.dump(
+                    metric_breakdowns(metrics), open(breakdown_file, "w"),
+                    sort_keys=True, indent=4, separators=(',',': '))
         
             
 
+    def eval_metrics(self, env_name, preds):
+        if env_name in self.eval_envs:
+            return self.eval_envs[env_name].eval_metrics(preds)
+        print('eval %d predictions' % (len(preds)))
+        gt_trajs, shortest_paths = self.ground_truth[env_name]
+        metrics = score_predictions(preds, gt_trajs, shortest_paths, self.obj2vps)
+        return average_metrics(metrics), metrics
+
+    def predict(self, env_name, env, rank=0, shard=None):
+        ''' Predictions of a full round on env, of the minibatches of shard (worker, num_workers)
+            only as [(minibatch index, pred)] when it is given '''
+        agent = ReverieMapAgent(self.args, env, rank=rank)
+        print(f"Loading model from {self.args.eval_ckpt_file}")
+      
+        agent.load(self.args.eval_ckpt_file)
+        if self.args.quantize:
+            agent.quantize()
+        print(f"Running evaluation on {env_name}")
+        agent.test(use_dropout=False, feedback='argmax', iters=None, shard=shard)
+        preds = agent.get_results(detailed_output=False)
+        if shard is not None:
+            preds = [(agent.results_batch[pred['instr_id']], pred) for pred in preds]
+        return preds
+
     def _build_dataset(self):
         
         self.eval_envs = {}
@@ -73,20 +110,52 @@ class Evaluater(object):
                 view_db=self.feat_db, rec_view_db=self.rec_feat_db, ins2img_db = self.ins2img_db, obj_db = self.obj_db,
                 instr_data = instr_data, connectivity_dir = self.args.connectivity_dir,
                 obj2vps = self.obj2vps, vp2room = self.vp2room_label, batch_size = self.args.batch_size,
-                angle_feat_size = self.args.angle_feat_size, seed = self.args.seed + rank,
-                sel_data_idxs = None if self.args.world_size < 2 else (rank, args.world_size),
+                angle_feat_size = self.args.angle_feat_size, seed = self.args.seed + self.rank,
+                sel_data_idxs = None if self.args.world_size < 2 else (self.rank, self.args.world_size),
                 name=split, max_objects=None, multi_startpoints=False,
-                multi_endpoints=False, args=self.args 
+                multi_endpoints=False, args=self.args, feat_bundle=self.feat_bundle,
+                cand_table=self.cand_table, scene_registry=self.scene_registry
             )
             print(f"Load {split} env !!!")
             self.eval_envs[split] = env 
     
+    def _load_ground_truth(self):
+        ''' gt trajectories and shortest paths of the splits, without features, envs or simulators '''
+        self.eval_envs = {}
+        self.ground_truth = {}
+        self.scene_registry = build_scene_registry(self.args)
+        self.obj2vps = load_obj2vps(os.path.join(self.args.anno_dir, "BBoxes.json"))
+        for split in self.splits:
+            assert split in self.allowd_split_list, f"Invalid split: {split}, split should be one of {self.allowd_split_list}" 
+            if split == 'test':
+                continue
+            instr_data = construct_instrs(
+                self.args.anno_dir, self.args.dataset, [split],
+                tokenizer = self.args.tokenizer, max_instr_len = self.args.max_instr_len
+            )
+            gt_trajs = {
+                x['instr_id']: (x['scan'], x['path'], x['objId'])
+                for x in instr_data if x.get('objId', None) is not None
+            }
+            scans = sorted(set(x[0] for x in gt_trajs.values()))
+            self.ground_truth[split] = (gt_trajs, self.scene_registry.get_shortest_paths(scans))
+
     def _load_feat_db(self):
 
-        self.feat_db = ImageFeaturesDB(self.args.img_ft_file, self.args.image_feat_size)
-        self.rec_feat_db = ImageFeaturesDB(self.args.rec_img_ft_file, self.args.image_feat_size)
-        self.obj_db = ObjectFeatureDB(self.args.obj_ft_file, self.args.obj_feat_size)
-        self.ins2img_db = Ins2ImageFeaturesDB(self.args.ins2img_ft_file, self.args.image_feat_size)
+        if self.args.feat_bundle is not None:
+            self.feat_bundle = FeatureBundle(self.args.feat_bundle)
+            self.feat_db = self.feat_bundle.image_db(self.args.image_feat_size)
+            self.rec_feat_db = self.feat_bundle.image_db(self.args.image_feat_size, field='rec_image')
+            self.obj_db = self.feat_bundle.obj_db(self.args.obj_feat_size)
+            self.ins2img_db = self.feat_bundle.ins2img_db(self.args.image_feat_size)
+        else:
+            self.feat_bundle = None
+            self.feat_db = get_image_features_db(self.args.img_ft_file, self.args.image_feat_size, self.args.img_ft_backend)
+            self.rec_feat_db = get_image_features_db(self.args.rec_img_ft_file, self.args.image_feat_size, self.args.img_ft_backend)
+            self.obj_db = ObjectFeatureDB(self.args.obj_ft_file, self.args.obj_feat_size)
+            self.ins2img_db = Ins2ImageFeaturesDB(self.args.ins2img_ft_file, self.args.image_feat_size)
+        self.cand_table = CandidateTable(self.args.cand_table_dir) if self.args.cand_table_dir is not None else None
+        self.scene_registry = build_scene_registry(self.args)
         self.obj2vps = load_obj2vps(os.path.join(self.args.anno_dir, "BBoxes.json"))
         self.vp2room_label = load_vp2roomlabel(os.path.join(self.args.anno_dir, "vp2room_label.json"))
         
@@ -97,11 +166,43 @@ class Evaluater(object):
         print("================================================")
 
 
+def eval_worker(args, splits, shard):
+    ''' One process of run_eval_workers: the minibatches of shard of every split, with the
+        seeds and env order of a single process run so that the minibatches are the same '''
+    rank = 0
+    # worker 0 writes the shared files of --scene_shm_dir, the others map them
+    os.environ['LOCAL_RANK'] = str(shard[0])
+    if args.device == 'cuda':
+        rank = shard[0] % torch.cuda.device_count()
+        torch.cuda.set_device(rank)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    set_random_seed(args.seed)
+    evaluater = Evaluater(args, splits)
+    return {
+        env_name: evaluater.predict(env_name, env, rank=rank, shard=shard)
+        for env_name, env in evaluater.eval_envs.items()
+    }
+
+
+def run_eval_workers(args, splits):
+    ''' Evaluation in args.eval_workers processes (round robin over the gpus with --device
+        cuda), each with its own envs and model, returns the eval_worker outputs '''
+    assert args.world_size < 2, 'eval workers replace the distributed evaluation'
+    assert not args.continuous_eval, 'continuous batching does not keep the minibatches of a single process run'
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(args.eval_workers) as pool:
+        return pool.starmap(eval_worker, [(args, splits, (i, args.eval_workers)) for i in range(args.eval_workers)])
+
+
 if __name__ == "__main__":
     args = parse_args()
     rank = 0
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
     set_random_seed(args.seed+rank)
-    evaluater = Evaluater(args, splits=["val_seen", "val_unseen", "test"])
+    # with eval workers, the parent only scores the predictions
+    evaluater = Evaluater(args, splits=["val_seen", "val_unseen", "test"], gt_only=args.eval_workers > 1)
     # evaluater = Evaluater(args, splits=["val_seen", "val_unseen"])
     # evaluater = Evaluater(args, splits=["val_unseen"])
     # evaluater = Evaluater(args, splits=["test"])
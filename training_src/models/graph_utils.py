@@ -1,6 +1,6 @@
-from collections import defaultdict
 # from ipdb import set_trace
 import numpy as np
+import torch
 
 MAX_DIST = 30
 MAX_STEP = 10
@@ -10,7 +10,8 @@ def calc_position_distance(a, b):
     dx = b[0] - a[0]
     dy = b[1] - a[1]
     dz = b[2] - a[2]
-    dist = np.sqrt(dx**2 + dy**2 + dz**2)
+    # products rather than **2, so BatchedGraphMap gets the same bits from array ops
+    dist = np.sqrt(dx * dx + dy * dy + dz * dz)
     return dist
 
 def calculate_vp_rel_pos_fts(a, b, base_heading=0, base_elevation=0):
@@ -41,38 +42,118 @@ def get_angle_fts(headings, elevations, angle_feat_size):
     return ang_fts
 
 
+def get_local_fusion_idxs(gmap_vpids, gmap_visited_masks, vp_cand_vpids, num_vps):
+    ''' Where the local logits go in the global ones: (batch, gmap_len) index of each
+        unvisited gmap node among the local candidates (-1 if not a candidate) and
+        (batch, num_vps) mask of the candidates that are visited gmap nodes (backtracking) '''
+    batch_size = len(gmap_vpids)
+    gmap_cand_idxs = np.full((batch_size, max(len(x) for x in gmap_vpids)), -1, dtype=np.int64)
+    vp_bw_masks = np.zeros((batch_size, num_vps), dtype=bool)
+    for i in range(batch_size):
+        visited_nodes = set([vp for vp, mask in zip(gmap_vpids[i], gmap_visited_masks[i]) if mask])
+        cand_idxs = {}
+        for j, cand_vpid in enumerate(vp_cand_vpids[i]):
+            if j > 0:
+                if cand_vpid in visited_nodes:
+                    vp_bw_masks[i, j] = True
+                else:
+                    cand_idxs[cand_vpid] = j
+        for j, vp in enumerate(gmap_vpids[i]):
+            if j > 0 and vp not in visited_nodes and vp in cand_idxs:
+                gmap_cand_idxs[i, j] = cand_idxs[vp]
+    return gmap_cand_idxs, vp_bw_masks
+
+
+def get_gmap_pos_fts(graph, node_positions, cur_vp, gmap_vpids, cur_heading, cur_elevation, angle_feat_size=4):
+    ''' calculate_vp_rel_pos_fts from cur_vp to all gmap_vpids at once, None gives zeros '''
+    valid = np.array([vp is not None for vp in gmap_vpids])
+    a = np.array(node_positions[cur_vp], dtype=np.float64)
+    b = np.array([node_positions[vp] if vp is not None else a for vp in gmap_vpids], dtype=np.float64)
+    dx, dy, dz = b[:, 0] - a[0], b[:, 1] - a[1], b[:, 2] - a[2]
+    xy_dist = np.maximum(np.sqrt(dx**2 + dy**2), 1e-8)
+    xyz_dist = np.maximum(np.sqrt(dx**2 + dy**2 + dz**2), 1e-8)
+    heading = np.arcsin(dx / xy_dist)
+    heading = np.where(b[:, 1] < a[1], np.pi - heading, heading) - cur_heading
+    elevation = np.arcsin(dz / xyz_dist) - cur_elevation
+
+    shortest_dists = graph.distances([cur_vp], gmap_vpids)[0]
+    shortest_steps = np.array([len(graph.path(cur_vp, vp)) if vp is not None else 0 for vp in gmap_vpids])
+    rel_angles = np.stack([heading, elevation], 1) * valid[:, None]
+    rel_dists = np.stack([xyz_dist / MAX_DIST, shortest_dists / MAX_DIST, shortest_steps / MAX_STEP], 1) * valid[:, None]
+    rel_angles = rel_angles.astype(np.float32)
+    rel_dists = rel_dists.astype(np.float32)
+    rel_ang_fts = get_angle_fts(rel_angles[:, 0], rel_angles[:, 1], angle_feat_size)
+    return np.concatenate([rel_ang_fts, rel_dists], 1)
+
+
 class FloydGraph(object):
+    '''
+    Shortest paths among the nodes seen so far, kept in arrays that grow with
+    the graph. update(k) relaxes all pairs through the newly visited node k
+    only, as the original dict version did.
+    '''
+    UNREACHABLE = 95959595
+
     def __init__(self):
-        self._dis = defaultdict(lambda :defaultdict(lambda: 95959595))
-        self._point = defaultdict(lambda :defaultdict(lambda: ""))
+        self._vp2idx = {}
+        self._vpids = []
+        self._dis = np.zeros((0, 0), dtype=np.float64)
+        self._point = np.zeros((0, 0), dtype=np.int64)    # intermediate node of x->y, -1 for a direct edge
         self._visited = set()
 
+    def _add_node(self, x):
+        if x not in self._vp2idx:
+            n = len(self._vpids)
+            if n == len(self._dis):
+                capacity = max(16, 2 * n)
+                dis = np.full((capacity, capacity), self.UNREACHABLE, dtype=np.float64)
+                point = np.full((capacity, capacity), -1, dtype=np.int64)
+                dis[:n, :n] = self._dis
+                point[:n, :n] = self._point
+                np.fill_diagonal(dis, 0)
+                self._dis, self._point = dis, point
+            self._vp2idx[x] = n
+            self._vpids.append(x)
+        return self._vp2idx[x]
+
     def distance(self, x, y):
         if x == y:
             return 0
-        else:
-            return self._dis[x][y]
+        if x not in self._vp2idx or y not in self._vp2idx:
+            return self.UNREACHABLE
+        return self._dis[self._vp2idx[x], self._vp2idx[y]]
+
+    def distances(self, xs, ys):
+        ''' (len(xs), len(ys)) matrix of distance(x, y) '''
+        x_idxs = np.array([self._vp2idx.get(x, -1) for x in xs], dtype=np.int64)
+        y_idxs = np.array([self._vp2idx.get(y, -1) for y in ys], dtype=np.int64)
+        dis = self._dis[np.maximum(x_idxs, 0)[:, None], np.maximum(y_idxs, 0)[None, :]]
+        unknown = (x_idxs < 0)[:, None] | (y_idxs < 0)[None, :]
+        if unknown.any():
+            dis[unknown] = self.UNREACHABLE
+            for i, j in zip(*np.nonzero(unknown)):
+                if xs[i] == ys[j]:
+                    dis[i, j] = 0
+        return dis
 
     def add_edge(self, x, y, dis):
         # x,y viewpointId  dis ecludi-> distance
-        if dis < self._dis[x][y]:
-            self._dis[x][y] = dis
-            self._dis[y][x] = dis
-            self._point[x][y] = ""
-            self._point[y][x] = ""
+        i, j = self._add_node(x), self._add_node(y)
+        if x != y and dis < self._dis[i, j]:
+            self._dis[i, j] = self._dis[j, i] = dis
+            self._point[i, j] = self._point[j, i] = -1
 
     def update(self, k):
-        # k viewpoint 
-        for x in self._dis:
-            for y in self._dis:
-                if x != y:
-                    #if dis(x->k->y) < dis(x->y)
-                    # => dis(x->y) = dis(x->k->y) shortest path of x-->y
-                    if self._dis[x][k] + self._dis[k][y] < self._dis[x][y]:
-                        self._dis[x][y] = self._dis[x][k] + self._dis[k][y]
-                        self._dis[y][x] = self._dis[x][y]
-                        self._point[x][y] = k
-                        self._point[y][x] = k
+        # k viewpoint: dis(x->y) = dis(x->k->y) if shorter
+        n = len(self._vpids)
+        if k in self._vp2idx:
+            kx = self._vp2idx[k]
+            dis = self._dis[:n, :n]
+            via_k = dis[:, kx: kx + 1] + dis[kx: kx + 1, :]
+            shorter = via_k < dis
+            np.fill_diagonal(shorter, False)
+            dis[shorter] = via_k[shorter]
+            self._point[:n, :n][shorter] = kx
         self._visited.add(k)
 
     def visited(self, k):
@@ -86,20 +167,126 @@ class FloydGraph(object):
         """
         if x == y:
             return []
-        if self._point[x][y] == "":     # Direct edge
+        if x not in self._vp2idx or y not in self._vp2idx:
             return [y]
+        point = self._point
+        i, j = self._vp2idx[x], self._vp2idx[y]
+        if point.item(i, j) < 0:    # direct edge
+            return [y]
+        path = []
+        stack = [(i, j)]
+        while len(stack) > 0:
+            i, j = stack.pop()
+            k = point.item(i, j)
+            if k < 0:   # direct edge
+                path.append(self._vpids[j])
+            else:
+                stack.append((k, j))
+                stack.append((i, k))
+        return path
+
+    def connected_pairs(self):
+        n = len(self._vpids)
+        xs, ys = np.nonzero(self._dis[:n, :n] < self.UNREACHABLE)
+        return [(self._vpids[i], self._vpids[j]) for i, j in zip(xs, ys) if i != j]
+
+
+class NodeEmbedBuffer(object):
+    '''
+    Node embeddings of all episodes of a rollout, replacing the per-viewpoint
+    [embed, count] lists: a preallocated (batch, max_nodes, hidden) tensor of
+    sums and a (batch, max_nodes) tensor of counts, created on the device and
+    dtype of the first embeddings and doubled when full. slots[b] maps the
+    viewpoints of episode b to their node slots. update() writes all rewrites
+    (or all accumulations) of a step with one index_copy_ (index_add_).
+    '''
+    def __init__(self, batch_size, max_nodes=64):
+        self.batch_size = batch_size
+        self.max_nodes = max_nodes
+        self.slots = [{} for _ in range(batch_size)]
+        self.sums = None
+        self.counts = None
+
+    def slot(self, b, vp):
+        slots = self.slots[b]
+        if vp not in slots:
+            slots[vp] = len(slots)
+        return slots[vp]
+
+    def _reserve(self, embeds, num_slots):
+        if self.sums is None:
+            while self.max_nodes < num_slots:
+                self.max_nodes *= 2
+            self.sums = embeds.new_zeros(self.batch_size, self.max_nodes, embeds.size(-1))
+            self.counts = embeds.new_zeros(self.batch_size, self.max_nodes)
+        elif num_slots > self.max_nodes:
+            pad = self.max_nodes
+            while self.max_nodes + pad < num_slots:
+                pad *= 2
+            self.sums = torch.cat([self.sums, self.sums.new_zeros(self.batch_size, pad, self.sums.size(2))], 1)
+            self.counts = torch.cat([self.counts, self.counts.new_zeros(self.batch_size, pad)], 1)
+            self.max_nodes += pad
+
+    def update_slots(self, bs, slots, embeds, rewrite=False):
+        ''' embeds (n, hidden) of the (bs[k], slots[k]) nodes, given as int arrays '''
+        bs, slots = np.asarray(bs, dtype=np.int64), np.asarray(slots, dtype=np.int64)
+        self._reserve(embeds, slots.max() + 1 if len(slots) > 0 else 0)
+        if len(slots) == 0:
+            return
+        flat_idxs = torch.from_numpy(bs * self.max_nodes + slots).to(embeds.device)
+        sums, counts = self.sums.view(-1, self.sums.size(2)), self.counts.view(-1)
+        if rewrite:
+            sums.index_copy_(0, flat_idxs, embeds.to(sums.dtype))
+            counts.index_fill_(0, flat_idxs, 1)
         else:
-            k = self._point[x][y]
-            # print(x, y, k)
-            # for x1 in (x, k, y):
-            #     for x2 in (x, k, y):
-            #         print(x1, x2, "%.4f" % self._dis[x1][x2])
-            return self.path(x, k) + self.path(k, y)
+            sums.index_add_(0, flat_idxs, embeds.to(sums.dtype))
+            counts.index_add_(0, flat_idxs, counts.new_ones(len(slots)))
+
+    def update(self, bs, vps, embeds, rewrite=False):
+        self.update_slots(bs, [self.slot(b, vp) for b, vp in zip(bs, vps)], embeds, rewrite=rewrite)
+
+    def get_slots(self, bs, slots):
+        ''' averaged embeddings of the nodes of the int arrays bs and slots (same
+            shape), zeros where slots is -1 '''
+        bs, slots = np.asarray(bs, dtype=np.int64), np.asarray(slots, dtype=np.int64)
+        device = self.sums.device
+        valid = torch.from_numpy(slots >= 0).to(device)
+        bs = torch.from_numpy(np.broadcast_to(bs, slots.shape).copy()).to(device)
+        slots = torch.from_numpy(np.maximum(slots, 0)).to(device)
+        # gather before dividing, the buffers are updated in place later
+        embeds = self.sums[bs, slots] / self.counts[bs, slots].clamp(min=1).unsqueeze(-1)
+        return embeds * valid.unsqueeze(-1)
+
+    def get(self, b, vp):
+        return self.get_slots(np.array([b]), np.array([self.slots[b][vp]]))[0]
+
+    def reset(self, bs):
+        ''' clear the nodes of the episodes bs, for new episodes in their rows '''
+        for b in bs:
+            self.slots[b] = {}
+        if self.sums is not None:
+            idxs = torch.from_numpy(np.asarray(bs, dtype=np.int64)).to(self.sums.device)
+            self.sums[idxs] = 0
+            self.counts[idxs] = 0
+
+    def get_slot_idxs(self, batch_vpids):
+        ''' (batch, 1 + max_len) slots of [STOP] + vpids, -1 for [STOP], padding and nodes not embedded yet '''
+        max_len = max(len(vpids) for vpids in batch_vpids)
+        slots = np.full((len(batch_vpids), max_len + 1), -1, dtype=np.int64)
+        for b, vpids in enumerate(batch_vpids):
+            slots[b, 1: len(vpids) + 1] = [self.slots[b].get(vp, -1) for vp in vpids]
+        return slots
+
+    def get_padded(self, batch_vpids):
+        ''' (batch, 1 + max_len, hidden) embeddings of [STOP] (zeros) + vpids, zero padded '''
+        return self.get_slots(np.arange(len(batch_vpids))[:, None], self.get_slot_idxs(batch_vpids))
 
 
 class GraphMap(object): 
-    def __init__(self, start_vp):
+    def __init__(self, start_vp, embed_buffer=None, buffer_idx=None):
         self.start_vp = start_vp    # start viewpoint
+        self.embed_buffer = embed_buffer    # NodeEmbedBuffer shared by the batch, replaces node_embeds
+        self.buffer_idx = buffer_idx
 
         self.node_positions = {}             # viewpoint to position (x, y, z)
         self.graph = FloydGraph()   # shortest path graph
@@ -117,7 +304,9 @@ class GraphMap(object):
         self.graph.update(ob['viewpoint'])
 
     def update_node_embed(self, vp, embed, rewrite=False):
-        if rewrite:
+        if self.embed_buffer is not None:
+            self.embed_buffer.update([self.buffer_idx], [vp], embed.unsqueeze(0), rewrite=rewrite)
+        elif rewrite:
             self.node_embeds[vp] = [embed, 1]
         else:
             if vp in self.node_embeds:
@@ -127,30 +316,17 @@ class GraphMap(object):
                 self.node_embeds[vp] = [embed, 1]
     
     def get_node_embed(self, vp):
+        if self.embed_buffer is not None:
+            return self.embed_buffer.get(self.buffer_idx, vp)
         return self.node_embeds[vp][0] / self.node_embeds[vp][1]
 
     def get_pos_fts(self, cur_vp, gmap_vpids, cur_heading, cur_elevation, angle_feat_size=4):
         # dim=7 (sin(heading), cos(heading), sin(elevation), cos(elevation),
         #  line_dist, shortest_dist, shortest_step)
-        rel_angles, rel_dists = [], []
-        for vp in gmap_vpids:
-            if vp is None:
-                rel_angles.append([0, 0])
-                rel_dists.append([0, 0, 0])
-            else:
-                rel_heading, rel_elevation, rel_dist = calculate_vp_rel_pos_fts(
-                    self.node_positions[cur_vp], self.node_positions[vp],
-                    base_heading=cur_heading, base_elevation=cur_elevation,
-                )
-                rel_angles.append([rel_heading, rel_elevation])
-                rel_dists.append(
-                    [rel_dist / MAX_DIST, self.graph.distance(cur_vp, vp) / MAX_DIST, \
-                    len(self.graph.path(cur_vp, vp)) / MAX_STEP]
-                )
-        rel_angles = np.array(rel_angles).astype(np.float32)
-        rel_dists = np.array(rel_dists).astype(np.float32)
-        rel_ang_fts = get_angle_fts(rel_angles[:, 0], rel_angles[:, 1], angle_feat_size)
-        return np.concatenate([rel_ang_fts, rel_dists], 1)
+        return get_gmap_pos_fts(
+            self.graph, self.node_positions, cur_vp, gmap_vpids, cur_heading, cur_elevation,
+            angle_feat_size=angle_feat_size
+        )
 
     def save_to_json(self):
         nodes = {}
@@ -165,18 +341,17 @@ class GraphMap(object):
             else:
                 nodes[vp]['nav_prob'] = self.node_nav_scores[vp]
 
-        edges = []
-        for k, v in self.graph._dis.items():
-            for kk in v.keys():
-                edges.append((k, kk))
+        edges = self.graph.connected_pairs()
                 
         return {'nodes': nodes, 'edges': edges}
 
 
 
 class GraphRoomMap(object):
-    def __init__(self, start_vp):
+    def __init__(self, start_vp, embed_buffer=None, buffer_idx=None):
         self.start_vp = start_vp # start viewpoint 
+        self.embed_buffer = embed_buffer
+        self.buffer_idx = buffer_idx
         
         self.node_positions = {}
         self.graph = FloydGraph() 
@@ -207,7 +382,9 @@ class GraphRoomMap(object):
         self.graph.update(ob['viewpoint'])
     
     def update_node_embed(self, vp, embed, rewrite=False):
-        if rewrite:
+        if self.embed_buffer is not None:
+            self.embed_buffer.update([self.buffer_idx], [vp], embed.unsqueeze(0), rewrite=rewrite)
+        elif rewrite:
             self.node_embeds[vp] = [embed, 1]
         else:
             if vp in self.node_embeds:
@@ -217,6 +394,8 @@ class GraphRoomMap(object):
                 self.node_embeds[vp] = [embed, 1]
     
     def get_node_embed(self, vp):
+        if self.embed_buffer is not None:
+            return self.embed_buffer.get(self.buffer_idx, vp)
         return self.node_embeds[vp][0] / self.node_embeds[vp][1]
     
     def get_node_room_type(self, vp):
@@ -228,25 +407,10 @@ class GraphRoomMap(object):
     def get_pos_fts(self, cur_vp, gmap_vpids, cur_heading, cur_elevation, angle_feat_size=4):
         # dim=7 (sin(heading), cos(heading), sin(elevation), cos(elevation),
         #  line_dist, shortest_dist, shortest_step)
-        rel_angles, rel_dists = [], []
-        for vp in gmap_vpids:
-            if vp is None:
-                rel_angles.append([0, 0])
-                rel_dists.append([0, 0, 0])
-            else:
-                rel_heading, rel_elevation, rel_dist = calculate_vp_rel_pos_fts(
-                    self.node_positions[cur_vp], self.node_positions[vp],
-                    base_heading=cur_heading, base_elevation=cur_elevation,
-                )
-                rel_angles.append([rel_heading, rel_elevation])
-                rel_dists.append(
-                    [rel_dist / MAX_DIST, self.graph.distance(cur_vp, vp) / MAX_DIST, \
-                    len(self.graph.path(cur_vp, vp)) / MAX_STEP]
-                )
-        rel_angles = np.array(rel_angles).astype(np.float32)
-        rel_dists = np.array(rel_dists).astype(np.float32)
-        rel_ang_fts = get_angle_fts(rel_angles[:, 0], rel_angles[:, 1], angle_feat_size)
-        return np.concatenate([rel_ang_fts, rel_dists], 1)
+        return get_gmap_pos_fts(
+            self.graph, self.node_positions, cur_vp, gmap_vpids, cur_heading, cur_elevation,
+            angle_feat_size=angle_feat_size
+        )
 
     def save_to_json(self):
         nodes = {}
@@ -261,14 +425,366 @@ class GraphRoomMap(object):
             else:
                 nodes[vp]['nav_prob'] = self.node_nav_scores[vp]
 
-        edges = []
-        for k, v in self.graph._dis.items():
-            for kk in v.keys():
-                edges.append((k, kk))
+        edges = self.graph.connected_pairs()
                 
         return {'nodes': nodes, 'edges': edges}
 
 
+class _GraphView(object):
+    ''' FloydGraph interface of one episode of a BatchedGraphMap '''
+    def __init__(self, bgmap, b):
+        self.bgmap = bgmap
+        self.b = b
+
+    def visited(self, k):
+        idx = self.bgmap.vp2idx[self.b].get(k)
+        return idx is not None and bool(self.bgmap.visited[self.b, idx])
+
+    def distance(self, x, y):
+        if x == y:
+            return 0
+        vp2idx = self.bgmap.vp2idx[self.b]
+        if x not in vp2idx or y not in vp2idx:
+            return BatchedGraphMap.UNREACHABLE
+        return self.bgmap.dis[self.b, vp2idx[x], vp2idx[y]]
+
+    def path(self, x, y):
+        if x == y:
+            return []
+        vp2idx = self.bgmap.vp2idx[self.b]
+        if x not in vp2idx or y not in vp2idx:
+            return [y]
+        point, vpids = self.bgmap.point[self.b], self.bgmap.vpids[self.b]
+        path = []
+        stack = [(vp2idx[x], vp2idx[y])]
+        while len(stack) > 0:
+            i, j = stack.pop()
+            k = point.item(i, j)
+            if k < 0:   # direct edge
+                path.append(vpids[j])
+            else:
+                stack.append((k, j))
+                stack.append((i, k))
+        return path
+
+
+class _GraphMapView(object):
+    ''' the per-episode attributes of GraphMap used outside the batched calls '''
+    def __init__(self, bgmap, b):
+        self.start_vp = bgmap.start_vps[b]
+        self.graph = _GraphView(bgmap, b)
+        self.node_stop_scores = bgmap.node_stop_scores[b]
+        self.node_nav_scores = bgmap.node_nav_scores[b]
+        self.curr_id = bgmap.curr_ids[b]
+
+
+class BatchedGraphMap(object):
+    '''
+    GraphMap (GraphRoomMap with use_room_type) of all episodes of a rollout.
+    Node positions, visit flags, step ids, shortest paths and embeddings live in
+    padded (batch, node, ...) arrays, nodes are indexed in the order they are
+    first seen as in node_positions. Only registering new viewpoints loops over
+    the episodes, the gmap inputs come from array ops. gmaps[i] gives a view
+    with graph.path / node_stop_scores / curr_id of episode i.
+    '''
+    UNREACHABLE = FloydGraph.UNREACHABLE
+
+    def __init__(self, start_vps, use_room_type=False):
+        batch_size = len(start_vps)
+        self.start_vps = list(start_vps)
+        self.use_room_type = use_room_type
+        self.vp2idx = [{} for _ in range(batch_size)]
+        self.vpids = [[] for _ in range(batch_size)]
+        self.num_nodes = np.zeros(batch_size, dtype=np.int64)
+        self.node_stop_scores = [{} for _ in range(batch_size)]
+        self.node_nav_scores = [{} for _ in range(batch_size)]
+        self.curr_ids = [None] * batch_size
+
+        self.capacity = 0
+        self.positions = np.zeros((batch_size, 0, 3), dtype=np.float64)
+        self.visited = np.zeros((batch_size, 0), dtype=bool)
+        self.step_ids = np.zeros((batch_size, 0), dtype=np.int64)
+        self.room_types = np.zeros((batch_size, 0), dtype=np.int64)
+        self.node_dists = np.zeros((batch_size, 0), dtype=np.float64)
+        # as FloydGraph: distance and intermediate node (-1 for a direct edge)
+        self.dis = np.zeros((batch_size, 0, 0), dtype=np.float64)
+        self.point = np.zeros((batch_size, 0, 0), dtype=np.int64)
+        self._steps = None      # len(path) of all pairs, computed when needed
+        self.node_embeds = NodeEmbedBuffer(batch_size)     # slots are the node indices
+
+        # nodes of the last observation of each episode
+        self.cur_idxs = np.zeros(batch_size, dtype=np.int64)
+        self.cand_idxs = np.full((batch_size, 0), -1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.start_vps)
+
+    def __getitem__(self, b):
+        return _GraphMapView(self, b)
+
+    def __iter__(self):
+        return (self[b] for b in range(len(self)))
+
+    def _grow(self, num_nodes):
+        capacity = max(16, 2 * self.capacity)
+        while capacity < num_nodes:
+            capacity *= 2
+        n, pad = self.capacity, capacity - self.capacity
+
+        def pad_nodes(x, value, ndim=1):
+            widths = [(0, 0)] + [(0, pad)] * ndim + [(0, 0)] * (x.ndim - ndim - 1)
+            return np.pad(x, widths, constant_values=value)
+
+        self.positions = pad_nodes(self.positions, 0)
+        self.visited = pad_nodes(self.visited, False)
+        self.step_ids = pad_nodes(self.step_ids, 0)
+        self.room_types = pad_nodes(self.room_types, 0)
+        self.node_dists = pad_nodes(self.node_dists, 0)
+        self.dis = pad_nodes(self.dis, self.UNREACHABLE, ndim=2)
+        self.point = pad_nodes(self.point, -1, ndim=2)
+        diag = np.arange(n, capacity)
+        self.dis[:, diag, diag] = 0
+        self.capacity = capacity
+
+    def _add_node(self, b, vp, position):
+        idx = self.vp2idx[b].get(vp)
+        if idx is None:
+            idx = self.num_nodes[b]
+            if idx == self.capacity:
+                self._grow(idx + 1)
+            self.vp2idx[b][vp] = idx
+            self.vpids[b].append(vp)
+            self.num_nodes[b] += 1
+        self.positions[b, idx] = position
+        return idx
+
+    def update_graph(self, obs, masks=None):
+        ''' GraphMap.update_graph of every obs with masks[b] (all by default) '''
+        bs = [b for b in range(len(obs)) if masks is None or masks[b]]
+        cur_idxs, edge_bs, edge_cands = [], [], []
+        cand_idxs = []
+        for b in bs:
+            ob = obs[b]
+            k = self._add_node(b, ob['viewpoint'], ob['position'])
+            self.curr_ids[b] = ob['viewpoint']
+            if self.use_room_type:
+                self.room_types[b, k] = ob['room_type']
+                self.node_dists[b, k] = ob['step_score_to_goal']
+            idxs = []
+            for cc in ob['candidate']:
+                j = self._add_node(b, cc['viewpointId'], cc['position'])
+                if self.use_room_type and 'room_type' in cc:
+                    self.room_types[b, j] = cc['room_type']
+                    self.node_dists[b, j] = cc['step_score_to_goal']
+                idxs.append(j)
+            cur_idxs.append(k)
+            edge_bs.extend([b] * len(idxs))
+            edge_cands.extend(idxs)
+            cand_idxs.append(idxs)
+        if len(bs) == 0:
+            return
+        bs, cur_idxs = np.array(bs), np.array(cur_idxs)
+        self.cur_idxs[bs] = cur_idxs
+
+        max_cands = max(self.cand_idxs.shape[1], max(len(x) for x in cand_idxs))
+        if max_cands > self.cand_idxs.shape[1]:
+            self.cand_idxs = np.pad(
+                self.cand_idxs, [(0, 0), (0, max_cands - self.cand_idxs.shape[1])], constant_values=-1
+            )
+        self.cand_idxs[bs] = -1
+        for b, idxs in zip(bs, cand_idxs):
+            self.cand_idxs[b, :len(idxs)] = idxs
+
+        # add_edge(viewpoint, candidate, euclidean distance)
+        if len(edge_bs) > 0:
+            edge_bs, edge_cands = np.array(edge_bs), np.array(edge_cands)
+            edge_curs = self.cur_idxs[edge_bs]
+            diff = self.positions[edge_bs, edge_cands] - self.positions[edge_bs, edge_curs]
+            dist = np.sqrt(diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1] + diff[:, 2] * diff[:, 2])
+            shorter = (edge_curs != edge_cands) & (dist < self.dis[edge_bs, edge_curs, edge_cands])
+            eb, ei, ej, ed = edge_bs[shorter], edge_curs[shorter], edge_cands[shorter], dist[shorter]
+            self.dis[eb, ei, ej] = self.dis[eb, ej, ei] = ed
+            self.point[eb, ei, ej] = self.point[eb, ej, ei] = -1
+
+        # update(viewpoint): relax all pairs through the current node
+        n = self.num_nodes[bs].max()
+        rows = np.arange(len(bs))
+        dis = self.dis[bs, :n, :n]
+        via_k = dis[rows, :, cur_idxs][:, :, None] + dis[rows, cur_idxs, :][:, None, :]
+        shorter = via_k < dis
+        shorter[:, np.arange(n), np.arange(n)] = False
+        self.dis[bs, :n, :n] = np.where(shorter, via_k, dis)
+        self.point[bs, :n, :n] = np.where(shorter, cur_idxs[:, None, None], self.point[bs, :n, :n])
+        self.visited[bs, cur_idxs] = True
+        self._steps = None
+
+    def get_steps(self):
+        ''' (batch, node, node) len(graph.path(x, y)). Paths are expanded through the
+            current intermediate nodes, so the number of edges is solved as a fixed
+            point of steps(i, j) = steps(i, k) + steps(k, j) over all pairs. '''
+        if self._steps is None:
+            n = self.num_nodes.max()
+            point = self.point[:, :n, :n]
+            direct = point < 0
+            k = np.maximum(point, 0)
+            bs, i, j = np.arange(len(self))[:, None, None], np.arange(n)[None, :, None], np.arange(n)[None, None, :]
+            steps = np.ones(point.shape, dtype=np.int64)
+            while True:
+                new_steps = np.where(direct, 1, steps[bs, i, k] + steps[bs, k, j])
+                if np.array_equal(new_steps, steps):
+                    break
+                steps = new_steps
+            steps[:, np.arange(n), np.arange(n)] = 0
+            self._steps = steps
+        return self._steps
+
+    def reset(self, bs, start_vps):
+        ''' new episodes starting at start_vps in the rows bs '''
+        for b, vp in zip(bs, start_vps):
+            self.start_vps[b] = vp
+            self.vp2idx[b] = {}
+            self.vpids[b] = []
+            self.node_stop_scores[b] = {}
+            self.node_nav_scores[b] = {}
+            self.curr_ids[b] = None
+        bs = np.asarray(bs, dtype=np.int64)
+        self.num_nodes[bs] = 0
+        self.positions[bs] = 0
+        self.visited[bs] = False
+        self.step_ids[bs] = 0
+        self.room_types[bs] = 0
+        self.node_dists[bs] = 0
+        self.dis[bs] = self.UNREACHABLE
+        diag = np.arange(self.capacity)
+        self.dis[bs[:, None], diag, diag] = 0
+        self.point[bs] = -1
+        self.cur_idxs[bs] = 0
+        self.cand_idxs[bs] = -1
+        self._steps = None
+        self.node_embeds.reset(bs)
+
+    def update_step_ids(self, masks, step):
+        ''' step: int or (batch, ) per episode '''
+        bs = np.nonzero(masks)[0]
+        self.step_ids[bs, self.cur_idxs[bs]] = np.broadcast_to(step, masks.shape)[bs]
+
+    def update_node_embeds(self, masks, cur_embeds, cand_embeds):
+        ''' rewrite the current node with cur_embeds (batch, hidden), add cand_embeds
+            (batch, view, hidden) to the unvisited candidates, both in the order of obs '''
+        device = cur_embeds.device
+        bs = np.nonzero(masks)[0]
+        self.node_embeds.update_slots(
+            bs, self.cur_idxs[bs], cur_embeds[torch.from_numpy(bs).to(device)], rewrite=True
+        )
+
+        cand_idxs = self.cand_idxs[bs]
+        cand_bs, cand_js = np.nonzero(
+            (cand_idxs >= 0) & ~self.visited[bs[:, None], np.maximum(cand_idxs, 0)]
+        )
+        self.node_embeds.update_slots(
+            bs[cand_bs], cand_idxs[cand_bs, cand_js],
+            cand_embeds[torch.from_numpy(bs[cand_bs]).to(device), torch.from_numpy(cand_js).to(device)]
+        )
+
+    def get_gmap_nodes(self, enc_full_graph=True):
+        ''' (batch, max_len) node indices of the gmap (visited then unvisited nodes,
+            or unvisited only), -1 for padding, and the number of nodes '''
+        ar = np.arange(self.capacity)
+        valid = ar[None, :] < self.num_nodes[:, None]
+        if enc_full_graph:
+            keep, key = valid, (~self.visited).astype(np.int64)
+        else:
+            keep, key = valid & ~self.visited, np.zeros(self.visited.shape, dtype=np.int64)
+        order = np.argsort(np.where(keep, key, 2) * self.capacity + ar[None, :], axis=1)
+        lens = keep.sum(1)
+        max_len = lens.max()
+        node_idxs = np.where(ar[None, :max_len] < lens[:, None], order[:, :max_len], -1)
+        return node_idxs, lens
+
+    def get_vpids(self, node_idxs, lens):
+        return [
+            [self.vpids[b][k] for k in node_idxs[b, :lens[b]].tolist()] for b in range(len(self))
+        ]
+
+    def get_pos_fts(self, node_idxs, cur_headings, cur_elevations, angle_feat_size=4):
+        ''' GraphMap.get_pos_fts from the current nodes to (batch, len) node_idxs,
+            -1 is treated as None '''
+        bs = np.arange(len(self))[:, None]
+        valid = node_idxs >= 0
+        safe_idxs = np.maximum(node_idxs, 0)
+        cur_idxs = self.cur_idxs[:, None]
+        a = self.positions[bs, cur_idxs]
+        b = np.where(valid[..., None], self.positions[bs, safe_idxs], a)
+        dx, dy, dz = b[..., 0] - a[..., 0], b[..., 1] - a[..., 1], b[..., 2] - a[..., 2]
+        xy_dist = np.maximum(np.sqrt(dx**2 + dy**2), 1e-8)
+        xyz_dist = np.maximum(np.sqrt(dx**2 + dy**2 + dz**2), 1e-8)
+        heading = np.arcsin(dx / xy_dist)
+        heading = np.where(b[..., 1] < a[..., 1], np.pi - heading, heading) - cur_headings[:, None]
+        elevation = np.arcsin(dz / xyz_dist) - cur_elevations[:, None]
+
+        shortest_dists = self.dis[bs, cur_idxs, safe_idxs]
+        shortest_steps = self.get_steps()[bs, cur_idxs, safe_idxs]
+        rel_angles = (np.stack([heading, elevation], -1) * valid[..., None]).astype(np.float32)
+        rel_dists = (np.stack(
+            [xyz_dist / MAX_DIST, shortest_dists / MAX_DIST, shortest_steps / MAX_STEP], -1
+        ) * valid[..., None]).astype(np.float32)
+        rel_ang_fts = get_angle_fts(
+            rel_angles[..., 0].reshape(-1), rel_angles[..., 1].reshape(-1), angle_feat_size
+        ).reshape(*node_idxs.shape, -1)
+        return np.concatenate([rel_ang_fts, rel_dists], -1)
+
+    def get_gmap_inputs(self, node_idxs, lens, cur_headings, cur_elevations):
+        ''' [STOP] + nodes inputs of _nav_gmap_variable, padded with zeros '''
+        batch_size, max_len = node_idxs.shape
+        bs = np.arange(batch_size)[:, None]
+        stop_idxs = np.full((batch_size, 1), -1, dtype=np.int64)
+        valid = node_idxs >= 0
+        safe_idxs = np.maximum(node_idxs, 0)
+
+        img_embeds = self.node_embeds.get_slots(bs, np.concatenate([stop_idxs, node_idxs], 1))
+
+        step_ids = np.concatenate([stop_idxs + 1, self.step_ids[bs, safe_idxs] * valid], 1)
+        pos_fts = self.get_pos_fts(
+            np.concatenate([stop_idxs, node_idxs], 1), cur_headings, cur_elevations
+        )
+        pos_fts[:, 1:] *= valid[..., None]
+        pair_dists = np.zeros((batch_size, max_len + 1, max_len + 1), dtype=np.float32)
+        pair_dists[:, 1:, 1:] = self.dis[bs[..., None], safe_idxs[:, :, None], safe_idxs[:, None, :]] \
+            * (valid[:, :, None] & valid[:, None, :])
+        visited_masks = np.concatenate([stop_idxs >= 0, self.visited[bs, safe_idxs] & valid], 1)
+        unvisited = (np.arange(self.capacity)[None, :] < self.num_nodes[:, None]) & ~self.visited
+
+        inputs = {
+            'gmap_vpids': [[None] + x for x in self.get_vpids(node_idxs, lens)],
+            'gmap_img_embeds': img_embeds,
+            'gmap_step_ids': torch.from_numpy(step_ids),
+            'gmap_pos_fts': torch.from_numpy(pos_fts),
+            'gmap_pair_dists': torch.from_numpy(pair_dists),
+            'gmap_visited_masks': torch.from_numpy(visited_masks),
+            'gmap_lens': torch.from_numpy(lens + 1),
+            'no_vp_left': (unvisited.sum(1) == 0).tolist(),
+        }
+        if self.use_room_type:
+            inputs['gmap_room_types'] = torch.from_numpy(self.room_types[bs, safe_idxs] * valid)
+            inputs['gmap_node_dist'] = torch.from_numpy(
+                (self.node_dists[bs, safe_idxs] * valid).astype(np.float32)
+            )
+            inputs['curr_vid_idx'] = (np.argmax(node_idxs == self.cur_idxs[:, None], 1) + 1).tolist()
+        return inputs
+
+    def get_vp_pos_fts(self, num_vps, cur_headings, cur_elevations):
+        ''' vp_pos_fts of _nav_vp_variable: start node for all [STOP] + views,
+            candidates (in the order of obs) from the second one '''
+        batch_size = len(self)
+        cand_idxs = self.cand_idxs
+        start_pos_fts = self.get_pos_fts(np.zeros((batch_size, 1), dtype=np.int64), cur_headings, cur_elevations)
+        cand_pos_fts = self.get_pos_fts(cand_idxs, cur_headings, cur_elevations) * (cand_idxs >= 0)[..., None]
+        vp_pos_fts = np.zeros((batch_size, num_vps, 14), dtype=np.float32)
+        vp_pos_fts[:, :, :7] = start_pos_fts
+        vp_pos_fts[:, 1: cand_idxs.shape[1] + 1, 7:] = cand_pos_fts[:, :num_vps - 1]
+        return vp_pos_fts
+
+
 class HierarchicalGraphMap(object):
     def __init__(self, start_vp):
         self.start_vp = start_vp
@@ -284,26 +800,12 @@ class HierarchicalGraphMap(object):
         pass 
     
     def get_pos_fts(self, cur_vp, gmap_vpids, cur_heading, cur_elevation, angle_feat_size=4):
-        
-        rel_angles, rel_dists = [], []
-        for vp in gmap_vpids:
-            if vp is None:
-                rel_angles.append([0, 0])
-                rel_dists.append([0, 0, 0])
-            else:
-                rel_heading, rel_elevation, rel_dist = calculate_vp_rel_pos_fts(
-                    self.node_positions[cur_vp], self.node_positions[vp],
-                    base_heading=cur_heading, base_elevation=cur_elevation,
-                )
-                rel_angles.append([rel_heading, rel_elevation])
-                rel_dists.append(
-                    [rel_dist / MAX_DIST, self.graph.distance(cur_vp, vp) / MAX_DIST, \
-                    len(self.graph.path(cur_vp, vp)) / MAX_STEP]
-                )
-        rel_angles = np.array(rel_angles).astype(np.float32)
-        rel_dists = np.array(rel_dists).astype(np.float32)
-        rel_ang_fts = get_angle_fts(rel_angles[:, 0], rel_angles[:, 1], angle_feat_size)
-        return np.concatenate([rel_ang_fts, rel_dists], 1)
+        # dim=7 (sin(heading), cos(heading), sin(elevation), cos(elevation),
+        #  line_dist, shortest_dist, shortest_step)
+        return get_gmap_pos_fts(
+            self.graph, self.node_positions, cur_vp, gmap_vpids, cur_heading, cur_elevation,
+            angle_feat_size=angle_feat_size
+        )
    
     def update_layout_graph_embeds(self):
         pass 
@@ -15,7 +15,7 @@ def get_vlnbert_models(args, config=None):
     new_ckpt_weights = {}
 
     if model_name_or_path is not None:
-        ckpt_weights = torch.load(model_name_or_path)
+        ckpt_weights = torch.load(model_name_or_path, map_location='cpu')
         for k,v in ckpt_weights.items():
             # if k.startswith('module'):
             #     k = k[7 :]
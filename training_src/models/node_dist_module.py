@@ -33,7 +33,7 @@ class NodeDistReg(nn.Module):
         fuse_weight = torch.sigmoid(self.dreamer_fuse_linear(
             torch.cat([x[:, 0], attention_output[:, 0]], 1)
         ))
-        return None, self.dist_sap_head(attention_output).squeeze(2), fuse_weight
+        return None, self.dist_sap_head(attention_output).squeeze(2).float(), fuse_weight
 
 
 class NodeVisReg(nn.Module):
@@ -66,4 +66,4 @@ class NodeVisReg(nn.Module):
         fuse_weight = torch.sigmoid(self.dreamer_fuse_linear(
             torch.cat([x[:, 0], attention_output[:, 0]], 1)
         ))
-        return None, self.dist_sap_head(attention_output).squeeze(2), fuse_weight
+        return None, self.dist_sap_head(attention_output).squeeze(2).float(), fuse_weight
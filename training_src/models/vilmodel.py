@@ -346,15 +346,17 @@ class BertOutAttention(nn.Module):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
+
+    def context_key_value(self, context):
+        return self.transpose_for_scores(self.key(context)), self.transpose_for_scores(self.value(context))
     
-    def forward(self, hidden_states, context, attention_mask=None):
+    def forward(self, hidden_states, context, attention_mask=None, context_kv=None):
         mixed_query_layer = self.query(hidden_states)
-        mixed_key_layer = self.key(context)
-        mixed_value_layer = self.value(context)
-
         query_layer = self.transpose_for_scores(mixed_query_layer)
-        key_layer = self.transpose_for_scores(mixed_key_layer)
-        value_layer = self.transpose_for_scores(mixed_value_layer)
+        if context_kv is None:
+            key_layer, value_layer = self.context_key_value(context)
+        else:
+            key_layer, value_layer = context_kv
 
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
@@ -383,8 +385,8 @@ class BertXAttention(nn.Module):
         self.att = BertOutAttention(config, ctx_dim=ctx_dim)
         self.output = BertSelfOutput(config)
 
-    def forward(self, input_tensor, ctx_tensor, ctx_att_mask=None):
-        output, attention_scores = self.att(input_tensor, ctx_tensor, ctx_att_mask)
+    def forward(self, input_tensor, ctx_tensor, ctx_att_mask=None, ctx_kv=None):
+        output, attention_scores = self.att(input_tensor, ctx_tensor, ctx_att_mask, context_kv=ctx_kv)
         attention_output = self.output(output, input_tensor)
         return attention_output, attention_scores
 
@@ -488,15 +490,16 @@ class GraphLXRTXLayer(nn.Module):
     
     def forward(
         self, lang_feats, lang_attention_mask, visn_feats, visn_attention_mask,
-        graph_sprels=None
+        graph_sprels=None, lang_kv=None
     ):  
         '''
         1 step:  q = vision, k,v = lang, vision cross attend to lang
           ===> final output input + cross_attend_out (input_vision + vision_cross_lang)
         2 step : vision self attend (output of the first step)
+        lang_kv: precomputed k,v of lang_feats (see TextContext)
         '''
         visn_att_output = self.visual_attention(
-            visn_feats, lang_feats, ctx_att_mask=lang_attention_mask
+            visn_feats, lang_feats, ctx_att_mask=lang_attention_mask, ctx_kv=lang_kv
         )[0]
         if graph_sprels is not None:
             visn_attention_mask = visn_attention_mask + graph_sprels
@@ -534,10 +537,12 @@ class CrossmodalEncoder(nn.Module):
             [GraphLXRTXLayer(config) for _ in range(self.num_x_layers)]
         )
 
-    def forward(self, txt_embeds, txt_masks, img_embeds, img_masks, graph_sprels=None):
+    def forward(self, txt_embeds, txt_masks, img_embeds, img_masks, graph_sprels=None, txt_ctx=None):
         extended_txt_masks = None
         extended_img_masks = None
-        if txt_masks != None:
+        if txt_ctx is not None:
+            extended_txt_masks = txt_ctx.extended_txt_masks
+        elif txt_masks != None:
             extended_txt_masks = extend_neg_masks(txt_masks)
         if img_masks != None:
             extended_img_masks = extend_neg_masks(img_masks)  # (N, 1(H), 1(L_q), L_v)
@@ -545,10 +550,45 @@ class CrossmodalEncoder(nn.Module):
             img_embeds = layer_module(
                 txt_embeds, extended_txt_masks, 
                 img_embeds, extended_img_masks,
-                graph_sprels=graph_sprels
+                graph_sprels=graph_sprels,
+                lang_kv=None if txt_ctx is None else txt_ctx.key_value(layer_module.visual_attention.att)
             )
         return img_embeds
 
+
+class TextContext(object):
+    ''' Step-invariant functions of the instruction, created once per rollout
+        after the language pass: the extended text masks, the text side
+        keys / values of the cross-attention layers and the instruction
+        projections of the panorama step are computed on the first step and
+        reused by the following ones. '''
+    def __init__(self, txt_embeds, txt_masks):
+        self.txt_embeds = txt_embeds
+        self.txt_masks = txt_masks
+        self.extended_txt_masks = extend_neg_masks(txt_masks)
+        self._cache = {}
+
+    def get(self, module, fn):
+        ''' fn(txt_embeds), computed once per module '''
+        if module not in self._cache:
+            self._cache[module] = fn(self.txt_embeds)
+        return self._cache[module]
+
+    def key_value(self, att):
+        ''' keys and values of a BertOutAttention over txt_embeds '''
+        return self.get(att, att.context_key_value)
+
+    def select(self, idxs):
+        ''' the context of the batch items idxs (LongTensor), keeping the computed projections '''
+        ctx = TextContext(self.txt_embeds[idxs], self.txt_masks[idxs])
+        for module, value in self._cache.items():
+            if isinstance(value, tuple):
+                ctx._cache[module] = tuple(x[idxs] for x in value)
+            else:
+                ctx._cache[module] = value[idxs]
+        return ctx
+
+
 class ImageEmbeddings(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -796,9 +836,9 @@ class RoomPredictionImg(nn.Module):
                     if len(rp_embed.shape) == 4:
                         rp_embed = np.squeeze(rp_embed)
                 rp_img_tensor = torch.from_numpy(rp_embed)
-                linear = nn.Linear(input_size, output_size).cuda()
+                linear = nn.Linear(input_size, output_size)
                 
-                linear.weight.data.copy_(rp_img_tensor.cuda())
+                linear.weight.data.copy_(rp_img_tensor)
                 self.room_type_list.append(linear)
            
         if not config.update_rp_embed:
@@ -809,6 +849,9 @@ class RoomPredictionImg(nn.Module):
     def forward(self, view_feat):
         outs = []
         for layer in self.room_type_list:
+            # not registered as submodules, so they follow the inputs instead of model.to()
+            if layer.weight.device != view_feat.device:
+                layer.to(view_feat.device)
             outs.append(torch.sum(layer(view_feat),dim=-1).unsqueeze(-1))
         outs = torch.cat(outs,dim=-1)
         return outs 
@@ -852,6 +895,41 @@ class RoomPrototypeEmbedding(nn.Module):
         return rp_embeds
 
 from .node_dist_module import NodeDistReg, NodeVisReg
+from .graph_utils import get_local_fusion_idxs
+from utils.data import get_view_perm_idxs
+
+
+def fuse_local_logits(
+    global_logits, local_logits, gmap_masks, gmap_visited_masks, gmap_vpids, vp_cand_vpids,
+    gmap_cand_idxs=None, vp_bw_masks=None, bw_weight=None, avg_bw=False
+):
+    ''' global logits + local logits: [STOP] to [STOP], each unvisited candidate to its
+        gmap node, and the sum (mean with avg_bw) of the visited candidates (backtracking)
+        to the other unvisited gmap nodes. gmap_cand_idxs / vp_bw_masks come from
+        get_local_fusion_idxs, the agent passes them so no mask is read back here. '''
+    if gmap_cand_idxs is None:
+        gmap_cand_idxs, vp_bw_masks = get_local_fusion_idxs(
+            gmap_vpids, gmap_visited_masks.cpu().numpy(), vp_cand_vpids, local_logits.size(1)
+        )
+        gmap_cand_idxs = torch.from_numpy(gmap_cand_idxs).to(local_logits.device)
+        vp_bw_masks = torch.from_numpy(vp_bw_masks).to(local_logits.device)
+
+    bw_logits = local_logits.masked_fill(vp_bw_masks.logical_not(), 0).sum(1)
+    if bw_weight:
+        bw_logits = torch.where(bw_logits > 0, bw_logits * bw_weight, bw_logits)
+    if avg_bw:
+        n_accum = vp_bw_masks.sum(1)
+        bw_logits = torch.where(n_accum > 0, bw_logits / n_accum.clamp(min=1), bw_logits)
+
+    cand_logits = local_logits.gather(1, gmap_cand_idxs.clamp(min=0))
+    local_to_gmap = torch.where(gmap_cand_idxs >= 0, cand_logits, bw_logits.unsqueeze(1))
+    unvisited_masks = gmap_masks & gmap_visited_masks.logical_not()
+    unvisited_masks[:, 0] = False
+    local_to_gmap = local_to_gmap.masked_fill(unvisited_masks.logical_not(), 0)
+    local_to_gmap[:, 0] = local_logits[:, 0]   # stop
+    return global_logits + local_to_gmap
+
+
 class GlocalTextPathNavCMT(BertPreTrainedModel):
 
     def __init__(self, config):
@@ -966,34 +1044,37 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
 
     def forward_panorama_per_step(
         self, view_img_fts, rec_view_img_fts, obj_img_fts, loc_fts, nav_types, view_lens, obj_lens,
-            instruction_fts, knowledge_fts, crop_fts, used_cand_ids, gmap_img_embeds, gmap_step_ids, gmap_pos_fts
+            instruction_fts, knowledge_fts, crop_fts, used_cand_ids, gmap_img_embeds, gmap_step_ids, gmap_pos_fts,
+            view_perm_idxs=None, txt_ctx=None
     ):
         global CROP_SIZE
         batch_size = view_img_fts.size(0)
 
         # History feature
+        # the history and the instruction are shared by the 36 views, they are
+        # broadcast over the view dim instead of being repeated
         if gmap_img_embeds != None:
             gmap_embeds = gmap_img_embeds + \
                           self.global_encoder.gmap_step_embeddings(gmap_step_ids) + \
                           self.global_encoder.gmap_pos_embeddings(gmap_pos_fts)
 
-            history_fts = self.history_proj(gmap_embeds).unsqueeze(1).repeat(1, 36, 1, 1)
-            history_fts_shape = history_fts.shape
+            history_fts = self.history_proj(gmap_embeds)
 
         knowledge_fts = self.knowledge_proj(knowledge_fts)
-        knowledge_fts_shape = knowledge_fts.shape
         crop_fts = self.crop_proj(crop_fts)
-        crop_fts_shape = crop_fts.shape
 
-        instruction_fts_pure = self.instruction_proj(instruction_fts).permute(0, 2, 1).unsqueeze(1).repeat(1, 36, 1, 1)
+        if txt_ctx is None:
+            instruction_fts_pure = self.instruction_proj(instruction_fts).permute(0, 2, 1)
+        else:
+            instruction_fts_pure = txt_ctx.get(self.instruction_proj, lambda x: self.instruction_proj(x).permute(0, 2, 1))
 
         # Purification
         if gmap_img_embeds != None:
             history_matrix, _ = torch.matmul(history_fts, instruction_fts_pure).max(dim=-1)
 
-        crop_matrix, _ = torch.matmul(crop_fts, instruction_fts_pure).max(dim=-1)
+        crop_matrix, _ = torch.matmul(crop_fts, instruction_fts_pure.unsqueeze(1)).max(dim=-1)
 
-        knowledge_matrix, _ = torch.matmul(knowledge_fts, instruction_fts_pure).max(dim=-1)
+        knowledge_matrix, _ = torch.matmul(knowledge_fts, instruction_fts_pure.unsqueeze(1)).max(dim=-1)
 
         if gmap_img_embeds != None:
             history_purify_weight = torch.softmax(history_matrix / math.sqrt(768), dim=-1)
@@ -1013,12 +1094,19 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
             batch_size, 36, CROP_SIZE, 768)
 
         if gmap_img_embeds != None:
+            # the encoder updates the history per view, its input is the only 36x copy
             history_knowledge_fts = self.cross_history_knowledge(
                 knowledge_fts.view(batch_size * 36, 1, 768), None,
-                history_fts.view(batch_size * 36, -1, 768), None).view(batch_size, 36, -1, 768)
+                history_fts.unsqueeze(1).expand(-1, 36, -1, -1).reshape(batch_size * 36, -1, 768), None
+            ).view(batch_size, 36, -1, 768)
 
         # Fusion
-        instruction_cls = self.fusion_proj(instruction_fts[:, 0:1, :]).permute(0, 2, 1).unsqueeze(1).repeat(1, 36, 1, 1)
+        if txt_ctx is None:
+            instruction_cls = self.fusion_proj(instruction_fts[:, 0:1, :]).permute(0, 2, 1).unsqueeze(1)
+        else:
+            instruction_cls = txt_ctx.get(
+                self.fusion_proj, lambda x: self.fusion_proj(x[:, 0:1, :]).permute(0, 2, 1).unsqueeze(1)
+            )
 
         if gmap_img_embeds != None:
             history_knowledge_logits = torch.matmul(history_knowledge_fts, instruction_cls) / math.sqrt(768)
@@ -1042,23 +1130,18 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
 
         else:
             fusion_fts = torch.cat(
-                [crop_knowledge_fts, self.no_history_embedding.unsqueeze(0).repeat(batch_size, 36, 1)], dim=-1)
+                [crop_knowledge_fts, self.no_history_embedding.unsqueeze(0).expand(batch_size, 36, -1)], dim=-1)
 
         fusion_fts = self.final_ffn(fusion_fts)
         fusion_fts = self.final_layer_norm(fusion_fts)
 
-        for i in range(batch_size):
-            view_ft_id = 0
-            for cand_id in used_cand_ids[i]:
-                view_img_fts[i, view_ft_id] = fusion_fts[i, cand_id] + view_img_fts[i, view_ft_id]
-                rec_view_img_fts[i, view_ft_id] = fusion_fts[i, cand_id] + rec_view_img_fts[i, view_ft_id]
-                view_ft_id += 1
-
-            for cand_id in range(36):
-                if cand_id not in used_cand_ids[i]:
-                    view_img_fts[i, view_ft_id] = fusion_fts[i, cand_id] + view_img_fts[i, view_ft_id]
-                    rec_view_img_fts[i, view_ft_id] = fusion_fts[i, cand_id] + rec_view_img_fts[i, view_ft_id]
-                    view_ft_id += 1
+        # view k of the panorama input gets the fusion feature of view view_perm_idxs[:, k]
+        if view_perm_idxs is None:
+            view_perm_idxs = torch.from_numpy(get_view_perm_idxs(used_cand_ids)).to(device)
+        view_perm_idxs = view_perm_idxs.unsqueeze(-1).expand(-1, -1, fusion_fts.size(-1))
+        fusion_fts = torch.gather(fusion_fts, 1, view_perm_idxs)
+        view_img_fts = torch.cat([view_img_fts[:, :36] + fusion_fts, view_img_fts[:, 36:]], 1)
+        rec_view_img_fts = torch.cat([rec_view_img_fts[:, :36] + fusion_fts.to(device2), rec_view_img_fts[:, 36:]], 1)
 
         # caption-instruction enhanced
         view_img_embeds = self.img_embeddings.img_layer_norm(
@@ -1123,34 +1206,45 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
         
         return pano_embeds, rec_pano_embeds, pano_masks, rec_pano_masks
     
+    def encode_gmap(
+        self, txt_embeds, txt_masks, gmap_img_embeds, gmap_step_ids, gmap_pos_fts, gmap_masks, gmap_pair_dists,
+        visual_encoder=True, txt_ctx=None
+    ):
+        ''' global branch: the gmap nodes encoded with the graph and the instruction '''
+        gmap_embeds = gmap_img_embeds + self.global_encoder.gmap_step_embeddings(gmap_step_ids) \
+                      + self.global_encoder.gmap_pos_embeddings(gmap_pos_fts)
+
+        if self.global_encoder.sprel_linear is not None:
+            graph_sprels = self.global_encoder.sprel_linear(
+                gmap_pair_dists.unsqueeze(3)).squeeze(3).unsqueeze(1)
+        else:
+            graph_sprels = None
+
+        if visual_encoder:
+            gmap_embeds = self.global_visual_encoder(gmap_embeds, gmap_masks, graph_sprels)
+        return self.global_encoder.encoder(
+            txt_embeds, txt_masks, gmap_embeds, gmap_masks,
+            graph_sprels=graph_sprels, txt_ctx=txt_ctx
+        )
+
     def forward_navigation_per_step(
         self, txt_embeds, txt_masks, gmap_img_embeds, gmap_step_ids, gmap_pos_fts,
         gmap_masks, gmap_pair_dists, gmap_visited_masks, gmap_vpids,
         vp_img_embeds, vp_pos_fts, vp_masks, vp_nav_masks, vp_obj_masks, vp_cand_vpids,
+        gmap_cand_idxs=None, vp_bw_masks=None, txt_ctx=None,
     ):  
         # vp_img_embeds[0] --> zero vector --> stop action 
         # gmap_img_embeds[0] --> zero vector --> stop action
         batch_size = txt_embeds.size(0)
         # global branch 
-        gmap_embeds = gmap_img_embeds + \
-                      self.global_encoder.gmap_step_embeddings(gmap_step_ids) + \
-                      self.global_encoder.gmap_pos_embeddings(gmap_pos_fts)
-        
-        if self.global_encoder.sprel_linear is not None:
-            graph_sprels = self.global_encoder.sprel_linear(
-                gmap_pair_dists.unsqueeze(3)
-            ).squeeze(3).unsqueeze(1)
-        else:
-            graph_sprels = None 
-
-        gmap_embeds = self.global_encoder.encoder(
-            txt_embeds, txt_masks, gmap_embeds, gmap_masks,
-            graph_sprels = graph_sprels
+        gmap_embeds = self.encode_gmap(
+            txt_embeds, txt_masks, gmap_img_embeds, gmap_step_ids, gmap_pos_fts, gmap_masks, gmap_pair_dists,
+            visual_encoder=False, txt_ctx=txt_ctx
         )
 
         # local branch
         vp_embeds = vp_img_embeds + self.local_encoder.vp_pos_embeddings(vp_pos_fts)
-        vp_embeds = self.local_encoder.encoder(txt_embeds, txt_masks, vp_embeds, vp_masks)
+        vp_embeds = self.local_encoder.encoder(txt_embeds, txt_masks, vp_embeds, vp_masks, txt_ctx=txt_ctx)
          # -> same operation as global 
 
 
@@ -1162,39 +1256,24 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
                 torch.cat([gmap_embeds[:, 0], vp_embeds[:, 0]], 1)
             ))
         
-        global_logits = self.global_sap_head(gmap_embeds).squeeze(2) * fuse_weights
+        # logits in fp32 under autocast: the -inf masking, fusion and losses stay as in fp32
+        global_logits = self.global_sap_head(gmap_embeds).squeeze(2).float() * fuse_weights
         global_logits.masked_fill_(gmap_visited_masks, -float('inf')) # mask visited node
         global_logits.masked_fill_(gmap_masks.logical_not(), -float('inf')) # mask padding
         
-        local_logits = self.local_sap_head(vp_embeds).squeeze(2) * (1-fuse_weights)
+        local_logits = self.local_sap_head(vp_embeds).squeeze(2).float() * (1-fuse_weights)
         local_logits.masked_fill_(vp_nav_masks.logical_not(), -float('inf')) # masked padding
         
         # fusion 
-        fused_logits = torch.clone(global_logits)
-        fused_logits[:, 0] += local_logits[:, 0] # stop
-        for i in range(batch_size):
-            visited_nodes = set([vp for vp,mask in zip(gmap_vpids[i], gmap_visited_masks[i]) if mask ])
-            tmp = {}
-            bw_logits = 0
-
-            for j, cand_vpid in enumerate(vp_cand_vpids[i]): # handle local branch 
-                # 0 for stop so skip 
-                if j > 0:
-                    if cand_vpid in visited_nodes:
-                        bw_logits += local_logits[i, j]
-                    else:
-                        tmp[cand_vpid] = local_logits[i, j]
-            for j, vp in enumerate(gmap_vpids[i]):
-                if j > 0 and vp not in visited_nodes: # unvisited node in gmap
-                    if vp in tmp:
-                        fused_logits[i, j] += tmp[vp]
-                    else:  # this vp also no in local vp_cand_vpids
-                        fused_logits[i, j] += bw_logits
+        fused_logits = fuse_local_logits(
+            global_logits, local_logits, gmap_masks, gmap_visited_masks, gmap_vpids, vp_cand_vpids,
+            gmap_cand_idxs, vp_bw_masks
+        )
 
         # object grounding logits
      
         if vp_obj_masks is not None:
-            obj_logits = self.og_head(vp_embeds).squeeze(2)
+            obj_logits = self.og_head(vp_embeds).squeeze(2).float()
             obj_logits.masked_fill_(vp_obj_masks.logical_not(), -float('inf'))
         else:
             obj_logits = None 
@@ -1214,33 +1293,20 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
         self, txt_embeds, txt_masks, gmap_img_embeds, gmap_step_ids, gmap_pos_fts,
         gmap_masks, gmap_pair_dists, gmap_visited_masks, gmap_vpids, 
         vp_img_embeds, vp_pos_fts, vp_masks, vp_nav_masks, vp_obj_masks, vp_cand_vpids,
+        gmap_cand_idxs=None, vp_bw_masks=None, txt_ctx=None,
     ):  
         batch_size = txt_embeds.size(0)
 
         # global branch
-        gmap_embeds = gmap_img_embeds + \
-                      self.global_encoder.gmap_step_embeddings(gmap_step_ids) + \
-                      self.global_encoder.gmap_pos_embeddings(gmap_pos_fts)
-
-        if self.global_encoder.sprel_linear is not None:
-            graph_sprels = self.global_encoder.sprel_linear(
-                gmap_pair_dists.unsqueeze(3)).squeeze(3).unsqueeze(1)
-        else:
-            graph_sprels = None 
-        
-        
-        gmap_embeds = self.global_visual_encoder(gmap_embeds,gmap_masks,graph_sprels)
-        #gmap_room_type = self.global_room_cls_head(gmap_embeds)
-
-        gmap_embeds = self.global_encoder.encoder(
-            txt_embeds, txt_masks, gmap_embeds, gmap_masks,
-            graph_sprels = graph_sprels
+        gmap_embeds = self.encode_gmap(
+            txt_embeds, txt_masks, gmap_img_embeds, gmap_step_ids, gmap_pos_fts, gmap_masks, gmap_pair_dists,
+            visual_encoder=True, txt_ctx=txt_ctx
         )
 
         gmap_room_type = self.global_room_cls_head(gmap_embeds)
         # local_branch
         vp_embeds = vp_img_embeds + self.local_encoder.vp_pos_embeddings(vp_pos_fts)
-        vp_embeds = self.local_encoder.encoder(txt_embeds, txt_masks, vp_embeds, vp_masks)
+        vp_embeds = self.local_encoder.encoder(txt_embeds, txt_masks, vp_embeds, vp_masks, txt_ctx=txt_ctx)
  
         # navigation logits
         if self.sap_fuse_linear is None:
@@ -1251,39 +1317,25 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
             ))
         # print(fuse_weights)
 
-        global_logits = self.global_sap_head(gmap_embeds).squeeze(2) * fuse_weights
+        global_logits = self.global_sap_head(gmap_embeds).squeeze(2).float() * fuse_weights
         global_logits.masked_fill_(gmap_visited_masks, -float('inf'))
         global_logits.masked_fill_(gmap_masks.logical_not(), -float('inf'))
         # print('global', torch.softmax(global_logits, 1)[0], global_logits[0])
 
-        local_logits = self.local_sap_head(vp_embeds).squeeze(2) * (1 - fuse_weights)
+        local_logits = self.local_sap_head(vp_embeds).squeeze(2).float() * (1 - fuse_weights)
         local_logits.masked_fill_(vp_nav_masks.logical_not(), -float('inf'))
         # print('local', torch.softmax(local_logits, 1)[0], local_logits[0])
 
         # fusion
-        fused_logits = torch.clone(global_logits)
-        fused_logits[:, 0] += local_logits[:, 0]   # stop
-        for i in range(batch_size):
-            visited_nodes = set([vp for vp, mask in zip(gmap_vpids[i], gmap_visited_masks[i]) if mask])
-            tmp = {}
-            bw_logits = 0
-            for j, cand_vpid in enumerate(vp_cand_vpids[i]):
-                if j > 0:
-                    if cand_vpid in visited_nodes:
-                        bw_logits += local_logits[i, j]
-                    else:
-                        tmp[cand_vpid] = local_logits[i, j]
-            for j, vp in enumerate(gmap_vpids[i]):
-                if j > 0 and vp not in visited_nodes:
-                    if vp in tmp:
-                        fused_logits[i, j] += tmp[vp]
-                    else:
-                        fused_logits[i, j] += bw_logits
+        fused_logits = fuse_local_logits(
+            global_logits, local_logits, gmap_masks, gmap_visited_masks, gmap_vpids, vp_cand_vpids,
+            gmap_cand_idxs, vp_bw_masks
+        )
         # print('fused', torch.softmax(fused_logits, 1)[0], fused_logits[0])
 
         # object grounding logits
         if vp_obj_masks is not None:
-            obj_logits = self.og_head(vp_embeds).squeeze(2)
+            obj_logits = self.og_head(vp_embeds).squeeze(2).float()
             obj_logits.masked_fill_(vp_obj_masks.logical_not(), -float('inf'))
         else:
             obj_logits = None
@@ -1303,27 +1355,14 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
         self, txt_embeds, txt_masks, gmap_img_embeds, gmap_step_ids, gmap_pos_fts,
         gmap_masks, gmap_pair_dists, gmap_visited_masks, gmap_vpids, 
         vp_img_embeds, vp_pos_fts, vp_masks, vp_nav_masks, vp_obj_masks, vp_cand_vpids,
-        ins2img, curr_vid_idx
+        ins2img, curr_vid_idx, gmap_cand_idxs=None, vp_bw_masks=None, txt_ctx=None,
     ):  
         batch_size = txt_embeds.size(0)
 
         # global branch
-        gmap_embeds = gmap_img_embeds + \
-                      self.global_encoder.gmap_step_embeddings(gmap_step_ids) + \
-                      self.global_encoder.gmap_pos_embeddings(gmap_pos_fts)
-
-        if self.global_encoder.sprel_linear is not None:
-            graph_sprels = self.global_encoder.sprel_linear(
-                gmap_pair_dists.unsqueeze(3)).squeeze(3).unsqueeze(1)
-        else:
-            graph_sprels = None 
-        
-        
-        gmap_embeds = self.global_visual_encoder(gmap_embeds,gmap_masks,graph_sprels)
-
-        gmap_embeds = self.global_encoder.encoder(
-            txt_embeds, txt_masks, gmap_embeds, gmap_masks,
-            graph_sprels = graph_sprels
+        gmap_embeds = self.encode_gmap(
+            txt_embeds, txt_masks, gmap_img_embeds, gmap_step_ids, gmap_pos_fts, gmap_masks, gmap_pair_dists,
+            visual_encoder=True, txt_ctx=txt_ctx
         )
 
         gmap_room_type = self.global_room_cls_head(gmap_embeds)
@@ -1332,7 +1371,7 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
 
         # local_branch
         vp_embeds = vp_img_embeds + self.local_encoder.vp_pos_embeddings(vp_pos_fts)
-        vp_embeds = self.local_encoder.encoder(txt_embeds, txt_masks, vp_embeds, vp_masks)
+        vp_embeds = self.local_encoder.encoder(txt_embeds, txt_masks, vp_embeds, vp_masks, txt_ctx=txt_ctx)
  
         # navigation logits
         fuse_weights = torch.sigmoid(self.sap_fuse_linear(
@@ -1345,7 +1384,7 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
         if self.config.const_fuse_gd:
             fuse_weight2 = self.config.const_fuse_gd_weight
 
-        global_logits = self.global_sap_head(gmap_embeds).squeeze(2) * fuse_weights
+        global_logits = self.global_sap_head(gmap_embeds).squeeze(2).float() * fuse_weights
         if self.config.switch_first_gd:
             global_logits[:,0] = global_logits[np.arange(len(curr_vid_idx)), np.array(curr_vid_idx)]
         # if self.config.bw_weight:
@@ -1354,11 +1393,11 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
         global_logits.masked_fill_(gmap_masks.logical_not(), -float('inf'))
         # print('global', torch.softmax(global_logits, 1)[0], global_logits[0])
 
-        local_logits = self.local_sap_head(vp_embeds).squeeze(2) * (1 - fuse_weights)
+        local_logits = self.local_sap_head(vp_embeds).squeeze(2).float() * (1 - fuse_weights)
         local_logits.masked_fill_(vp_nav_masks.logical_not(), -float('inf'))
         # print('local', torch.softmax(local_logits, 1)[0], local_logits[0])
 
-        fused_logits2 = self.global_distsap_head(gmap_embeds).squeeze(2)
+        fused_logits2 = self.global_distsap_head(gmap_embeds).squeeze(2).float()
         if self.config.switch_first_gd:
             dist_logits[:,0] = dist_logits[np.arange(len(curr_vid_idx)), np.array(curr_vid_idx)]
             fused_logits2[:,0] = fused_logits2[np.arange(len(curr_vid_idx)), np.array(curr_vid_idx)]
@@ -1374,40 +1413,16 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
         dist_logits_copy.masked_fill_(gmap_masks.logical_not(), -float('inf')) 
 
         # fusion
-        fused_logits = torch.clone(global_logits)
-        fused_logits[:, 0] += local_logits[:, 0]   # stop
-        for i in range(batch_size):
-            visited_nodes = set([vp for vp, mask in zip(gmap_vpids[i], gmap_visited_masks[i]) if mask])
-            tmp = {}
-            bw_logits = 0
-            n_accum = 0
-            for j, cand_vpid in enumerate(vp_cand_vpids[i]):
-                if j > 0:
-                    if cand_vpid in visited_nodes:
-                        bw_logits += local_logits[i, j]
-                        n_accum += 1
-                    else:
-                        tmp[cand_vpid] = local_logits[i, j]
-
-            if self.config.bw_weight and bw_logits>0:
-                bw_logits = bw_logits * self.config.bw_weight
-
-            for j, vp in enumerate(gmap_vpids[i]):
-                if j > 0 and vp not in visited_nodes:
-                    if vp in tmp:
-                        fused_logits[i, j] += tmp[vp]
-                    else:
-                        # if n_accum != 0 and bw_logits>0 and self.config.avg_local_emb:
-                        if n_accum != 0 and self.config.avg_local_emb:
-                            fused_logits[i, j] += bw_logits/n_accum
-                        else:
-                            fused_logits[i, j] += bw_logits
+        fused_logits = fuse_local_logits(
+            global_logits, local_logits, gmap_masks, gmap_visited_masks, gmap_vpids, vp_cand_vpids,
+            gmap_cand_idxs, vp_bw_masks, bw_weight=self.config.bw_weight, avg_bw=self.config.avg_local_emb
+        )
         # print('fused', torch.softmax(fused_logits, 1)[0], fused_logits[0])
 
         fused_logits += fused_logits2
         # object grounding logits
         if vp_obj_masks is not None:
-            obj_logits = self.og_head(vp_embeds).squeeze(2)
+            obj_logits = self.og_head(vp_embeds).squeeze(2).float()
             obj_logits.masked_fill_(vp_obj_masks.logical_not(), -float('inf'))
         else:
             obj_logits = None
@@ -1428,27 +1443,14 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
         self, txt_embeds, txt_masks, gmap_img_embeds, gmap_step_ids, gmap_pos_fts,
         gmap_masks, gmap_pair_dists, gmap_visited_masks, gmap_vpids, 
         vp_img_embeds, vp_rec_img_embeds, vp_pos_fts, vp_masks, vp_nav_masks, vp_obj_masks, vp_cand_vpids,
-        ins2img, curr_vid_idx
+        ins2img, curr_vid_idx, gmap_cand_idxs=None, vp_bw_masks=None, txt_ctx=None,
     ):  
         batch_size = txt_embeds.size(0)
 
         # global branch
-        gmap_embeds = gmap_img_embeds + \
-                      self.global_encoder.gmap_step_embeddings(gmap_step_ids) + \
-                      self.global_encoder.gmap_pos_embeddings(gmap_pos_fts)
-
-        if self.global_encoder.sprel_linear is not None:
-            graph_sprels = self.global_encoder.sprel_linear(
-                gmap_pair_dists.unsqueeze(3)).squeeze(3).unsqueeze(1)
-        else:
-            graph_sprels = None 
-        
-        
-        gmap_embeds = self.global_visual_encoder(gmap_embeds,gmap_masks,graph_sprels)
-
-        gmap_embeds = self.global_encoder.encoder(
-            txt_embeds, txt_masks, gmap_embeds, gmap_masks,
-            graph_sprels = graph_sprels
+        gmap_embeds = self.encode_gmap(
+            txt_embeds, txt_masks, gmap_img_embeds, gmap_step_ids, gmap_pos_fts, gmap_masks, gmap_pair_dists,
+            visual_encoder=True, txt_ctx=txt_ctx
         )
 
         gmap_room_type = self.global_room_cls_head(gmap_embeds)
@@ -1456,10 +1458,10 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
 
         # local_branch
         vp_embeds = vp_img_embeds + self.local_encoder.vp_pos_embeddings(vp_pos_fts)
-        vp_embeds = self.local_encoder.encoder(txt_embeds, txt_masks, vp_embeds, vp_masks)
+        vp_embeds = self.local_encoder.encoder(txt_embeds, txt_masks, vp_embeds, vp_masks, txt_ctx=txt_ctx)
 
         vp_rec_embeds = vp_rec_img_embeds + self.local_encoder.vp_pos_embeddings(vp_pos_fts)
-        vp_rec_embeds = self.local_encoder.encoder(txt_embeds, txt_masks, vp_rec_embeds, vp_masks)
+        vp_rec_embeds = self.local_encoder.encoder(txt_embeds, txt_masks, vp_rec_embeds, vp_masks, txt_ctx=txt_ctx)
         _, rec_logits, fuse_weight3 = self.local_rec_reg_head(vp_embeds, vp_rec_embeds)
  
         # fuse_weights = 0.5
@@ -1468,70 +1470,36 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
         ))
 
         # global
-        global_logits = self.global_sap_head(gmap_embeds).squeeze(2) * fuse_weights
+        global_logits = self.global_sap_head(gmap_embeds).squeeze(2).float() * fuse_weights
         global_logits.masked_fill_(gmap_visited_masks, -float('inf'))
         global_logits.masked_fill_(gmap_masks.logical_not(), -float('inf'))
 
         # local
-        local_logits = self.local_sap_head(vp_embeds).squeeze(2) * (1 - fuse_weights)
+        local_logits = self.local_sap_head(vp_embeds).squeeze(2).float() * (1 - fuse_weights)
         local_logits.masked_fill_(vp_nav_masks.logical_not(), -float('inf'))
 
         # gd
-        fused_logits2 = self.global_distsap_head(gmap_embeds).squeeze(2)
+        fused_logits2 = self.global_distsap_head(gmap_embeds).squeeze(2).float()
 
         fused_logits2 = dist_logits * (1-fuse_weight2) + fused_logits2 * fuse_weight2
         fused_logits2.masked_fill_(gmap_visited_masks, -float('inf'))
         fused_logits2.masked_fill_(gmap_masks.logical_not(), -float('inf'))
 
         # visionary
-        fused_logits3 = self.local_rec_sap_head(vp_embeds).squeeze(2)
+        fused_logits3 = self.local_rec_sap_head(vp_embeds).squeeze(2).float()
         fused_logits3 = rec_logits * (1 - fuse_weight3) + fused_logits3 * fuse_weight3
         fused_logits3.masked_fill_(vp_nav_masks.logical_not(), -float('inf'))
 
         # fusion
-        fused_logits = torch.clone(global_logits)
-        fused_logits[:, 0] += local_logits[:, 0]   # stop
-        for i in range(batch_size):
-            visited_nodes = set([vp for vp, mask in zip(gmap_vpids[i], gmap_visited_masks[i]) if mask])
-            tmp = {}
-            bw_logits = 0
-            n_accum = 0
-            for j, cand_vpid in enumerate(vp_cand_vpids[i]):
-                if j > 0:
-                    if cand_vpid in visited_nodes:
-                        bw_logits += local_logits[i, j]
-                        n_accum += 1
-                    else:
-                        tmp[cand_vpid] = local_logits[i, j]
-
-            for j, vp in enumerate(gmap_vpids[i]):
-                if j > 0 and vp not in visited_nodes:
-                    if vp in tmp:
-                        fused_logits[i, j] += tmp[vp]
-                    else:
-                        fused_logits[i, j] += bw_logits
-
-        fused_rec_logits = torch.clone(global_logits)
-        fused_rec_logits[:, 0] += fused_logits3[:, 0]  # stop
-        for i in range(batch_size):
-            visited_nodes = set([vp for vp, mask in zip(gmap_vpids[i], gmap_visited_masks[i]) if mask])
-            tmp = {}
-            bw_logits = 0
-            n_accum = 0
-            for j, cand_vpid in enumerate(vp_cand_vpids[i]):
-                if j > 0:
-                    if cand_vpid in visited_nodes:
-                        bw_logits += fused_logits3[i, j]
-                        n_accum += 1
-                    else:
-                        tmp[cand_vpid] = fused_logits3[i, j]
-
-            for j, vp in enumerate(gmap_vpids[i]):
-                if j > 0 and vp not in visited_nodes:
-                    if vp in tmp:
-                        fused_rec_logits[i, j] += tmp[vp]
-                    else:
-                        fused_rec_logits[i, j] += bw_logits
+        fused_logits = fuse_local_logits(
+            global_logits, local_logits, gmap_masks, gmap_visited_masks, gmap_vpids, vp_cand_vpids,
+            gmap_cand_idxs, vp_bw_masks
+        )
+
+        fused_rec_logits = fuse_local_logits(
+            global_logits, fused_logits3, gmap_masks, gmap_visited_masks, gmap_vpids, vp_cand_vpids,
+            gmap_cand_idxs, vp_bw_masks
+        )
 
         # add gd
         fused_logits += fused_logits2
@@ -1540,7 +1508,7 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
 
         # object grounding logits
         if vp_obj_masks is not None:
-            obj_logits = self.og_head(vp_embeds).squeeze(2)
+            obj_logits = self.og_head(vp_embeds).squeeze(2).float()
             obj_logits.masked_fill_(vp_obj_masks.logical_not(), -float('inf'))
         else:
             obj_logits = None
@@ -1566,7 +1534,8 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
                 batch['view_img_fts'], batch['rec_view_img_fts'], batch['obj_img_fts'], batch['loc_fts'],
                 batch['nav_types'], batch['view_lens'], batch['obj_lens'],
                 batch['instruction_fts'], batch['knowledge_fts'], batch['crop_fts'], batch['used_cand_ids'],
-                batch['gmap_img_embeds'], batch['gmap_step_ids'], batch['gmap_pos_fts']
+                batch['gmap_img_embeds'], batch['gmap_step_ids'], batch['gmap_pos_fts'], batch.get('view_perm_idxs'),
+                batch.get('txt_ctx')
             )
 
             return pano_embeds, rec_pano_embeds, pano_masks, rec_pano_masks
@@ -1578,6 +1547,7 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
                 batch['gmap_pair_dists'], batch['gmap_visited_masks'], batch['gmap_vpids'],
                 batch['vp_img_embeds'], batch['vp_pos_fts'], batch['vp_masks'],
                 batch['vp_nav_masks'], batch['vp_obj_masks'], batch['vp_cand_vpids'],
+                batch.get('gmap_cand_idxs'), batch.get('vp_bw_masks'), batch.get('txt_ctx'),
             )
         elif mode == 'navigation_with_room_type':
             return self.forward_navigation_with_room_type(
@@ -1586,6 +1556,7 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
                 batch['gmap_pair_dists'], batch['gmap_visited_masks'],batch['gmap_vpids'],
                 batch['vp_img_embeds'], batch['vp_pos_fts'], batch['vp_masks'],
                 batch['vp_nav_masks'], batch['vp_obj_masks'], batch['vp_cand_vpids'],
+                batch.get('gmap_cand_idxs'), batch.get('vp_bw_masks'), batch.get('txt_ctx'),
             )
         elif mode == 'navigation_with_room_type_node_dist': # tuning version with multiple tuning config
             return self.forward_navigation_with_room_type_node_dist(
@@ -1594,7 +1565,8 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
                 batch['gmap_pair_dists'], batch['gmap_visited_masks'],batch['gmap_vpids'],
                 batch['vp_img_embeds'], batch['vp_pos_fts'], batch['vp_masks'],
                 batch['vp_nav_masks'], batch['vp_obj_masks'], batch['vp_cand_vpids'],
-                batch['ins2img'], batch['curr_vid_idx']
+                batch['ins2img'], batch['curr_vid_idx'], batch.get('gmap_cand_idxs'), batch.get('vp_bw_masks'),
+                batch.get('txt_ctx')
             )
         elif mode == 'navigation_with_rt_gd':  # stable version -- cur
             return self.forward_navigation_with_rt_gd(
@@ -1603,7 +1575,8 @@ class GlocalTextPathNavCMT(BertPreTrainedModel):
                 batch['gmap_pair_dists'], batch['gmap_visited_masks'], batch['gmap_vpids'],
                 batch['vp_img_embeds'], batch['vp_rec_img_embeds'], batch['vp_pos_fts'], batch['vp_masks'],
                 batch['vp_nav_masks'], batch['vp_obj_masks'], batch['vp_cand_vpids'],
-                batch['ins2img'], batch['curr_vid_idx']
+                batch['ins2img'], batch['curr_vid_idx'], batch.get('gmap_cand_idxs'), batch.get('vp_bw_masks'),
+                batch.get('txt_ctx')
             )
 
 
@@ -11,8 +11,11 @@ from env import ReverNavBatchEnv
 from tensorboardX import SummaryWriter
 from rever_agent import ReverieMapAgent
 from env_bases.reverie.data_utils import ObjectFeatureDB, construct_instrs, load_obj2vps, load_vp2roomlabel
+from env_bases.reverie.feature_bundle import FeatureBundle
+from env_bases.reverie.candidate_table import CandidateTable
+from env_bases.reverie.scene_registry import build_scene_registry
 from env_bases.reverie.parser import parse_args
-from utils.data import ImageFeaturesDB, Ins2ImageFeaturesDB
+from utils.data import get_image_features_db, Ins2ImageFeaturesDB
 from utils.distributed import is_default_gpu, merge_dist_results, all_gather, init_distributed
 from utils.logger import write_to_record_file
 from utils.misc import set_random_seed
@@ -24,10 +27,20 @@ def build_dataset(args, rank = 0):
     print(f"If use room type {args.use_room_type}")
     print(f"Using {args.tokenizer} tokenizer ")
 
-    feat_db = ImageFeaturesDB(args.img_ft_file, args.image_feat_size)
-    rec_feat_db = ImageFeaturesDB(args.rec_img_ft_file, args.image_feat_size)
-    obj_db = ObjectFeatureDB(args.obj_ft_file, args.obj_feat_size)
-    ins2img_db = Ins2ImageFeaturesDB(args.ins2img_ft_file, args.image_feat_size)
+    if args.feat_bundle is not None:
+        feat_bundle = FeatureBundle(args.feat_bundle)
+        feat_db = feat_bundle.image_db(args.image_feat_size)
+        rec_feat_db = feat_bundle.image_db(args.image_feat_size, field='rec_image')
+        obj_db = feat_bundle.obj_db(args.obj_feat_size)
+        ins2img_db = feat_bundle.ins2img_db(args.image_feat_size)
+    else:
+        feat_bundle = None
+        feat_db = get_image_features_db(args.img_ft_file, args.image_feat_size, args.img_ft_backend)
+        rec_feat_db = get_image_features_db(args.rec_img_ft_file, args.image_feat_size, args.img_ft_backend)
+        obj_db = ObjectFeatureDB(args.obj_ft_file, args.obj_feat_size)
+        ins2img_db = Ins2ImageFeaturesDB(args.ins2img_ft_file, args.image_feat_size)
+    cand_table = CandidateTable(args.cand_table_dir) if args.cand_table_dir is not None else None
+    scene_registry = build_scene_registry(args)
     obj2vps = load_obj2vps(os.path.join(args.anno_dir, "BBoxes.json"))
     vp2room_label = load_vp2roomlabel(os.path.join(args.anno_dir, "vp2room_label.json"))
     
@@ -43,7 +56,8 @@ def build_dataset(args, rank = 0):
         vp2room = vp2room_label, batch_size = args.batch_size, max_objects = args.max_objects,
         angle_feat_size = args.angle_feat_size, seed = args.seed+rank,
         sel_data_idxs = None, name = 'train', multi_endpoints = args.multi_endpoints,
-        multi_startpoints = args.multi_startpoints, args=args
+        multi_startpoints = args.multi_startpoints, args=args, feat_bundle=feat_bundle,
+        cand_table=cand_table, scene_registry=scene_registry
     )
     
     val_env_names = ['val_train_seen', 'val_seen', 'val_unseen']
@@ -66,7 +80,8 @@ def build_dataset(args, rank = 0):
             angle_feat_size = args.angle_feat_size, seed = args.seed + rank,
             sel_data_idxs = None if args.world_size < 2 else (rank, args.world_size), 
             name = split, max_objects = None, multi_startpoints=False, 
-            multi_endpoints = False, args=args
+            multi_endpoints = False, args=args, feat_bundle=feat_bundle,
+            cand_table=cand_table, scene_registry=scene_registry
         )
 
         val_envs[split] = val_env 
@@ -241,6 +256,8 @@ def valid(args, train_env, val_envs, rank=-1):
         print("Loaded the agent model at iter %d from %s" % (
             agent.load(args.resume_file), args.resume_file
         ))
+    if args.quantize:
+        agent.quantize()
     
     if default_gpu:
         with open(os.path.join(args.log_dir, "validation_args.json"), "w") as  outf:
@@ -292,6 +309,8 @@ def main():
         torch.cuda.set_device(args.local_rank)
     else:
         rank = 0
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
 
     set_random_seed(args.seed + rank)
     train_env, val_envs = build_dataset(args, rank=rank)
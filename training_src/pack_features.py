@@ -0,0 +1,68 @@
+''' Pack hdf5 feature files for faster loading.
+
+    Memory-mapped image features read by MmapImageFeaturesDB (use with --img_ft_backend mmap):
+    python pack_features.py --img_ft_file ../datasets/R2R/features/pth_clip_vit_l_14_336px.hdf5
+
+    One feature bundle holding every store of the VISIONARY env (use with --feat_bundle):
+    python pack_features.py --bundle ../datasets/visionary/reverie_clip.bundle \
+        --img_ft_file ../datasets/R2R/features/pth_clip_vit_l_14_336px.hdf5 \
+        --rec_img_ft_file ../datasets/R2R/features/rec_pth_clip_vit_l_14_336px.hdf5 \
+        --obj_ft_file ../datasets/REVERIE/features/obj.avg.top3.min80_vit_base_patch16_224_imagenet.hdf5 \
+        --knowledge_ft_file ../datasets/visionary/captions.hdf5 \
+        --crop_ft_file ../datasets/visionary/clip_crop_image.hdf5 \
+        --ins2img_ft_file ../datasets/REVERIE/features/full_reverie_ins2img_clip.h5
+'''
+import argparse
+import os
+import numpy as np
+
+from utils.data import pack_image_features
+from env_bases.reverie.feature_bundle import pack_feature_bundle
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pack hdf5 features for --img_ft_backend mmap or --feat_bundle')
+    parser.add_argument('--img_ft_file', nargs='+', required=True, help='hdf5 feature files to pack')
+    parser.add_argument('--output_dir', default=None, help='defaults to the directory of each input file')
+    parser.add_argument('--image_feat_size', type=int, default=None, help='keep only the first D dims')
+    parser.add_argument('--dtype', choices=['float32', 'float16'], default='float32')
+
+    parser.add_argument('--bundle', default=None, help='write a single feature bundle to this file instead')
+    parser.add_argument('--rec_img_ft_file', default=None)
+    parser.add_argument('--obj_ft_file', default=None)
+    parser.add_argument('--obj_feat_size', type=int, default=None)
+    parser.add_argument('--knowledge_ft_file', default=None)
+    parser.add_argument('--crop_ft_file', default=None)
+    parser.add_argument('--ins2img_ft_file', default=None)
+    parser.add_argument('--crop_size', type=int, default=5, help='CROP_SIZE of the env')
+    args = parser.parse_args()
+
+    if args.bundle is not None:
+        assert len(args.img_ft_file) == 1, 'a bundle holds a single image feature file'
+        header = pack_feature_bundle(
+            args.bundle, args.img_ft_file[0], rec_img_ft_file=args.rec_img_ft_file,
+            obj_ft_file=args.obj_ft_file, knowledge_ft_file=args.knowledge_ft_file,
+            crop_ft_file=args.crop_ft_file, ins2img_ft_file=args.ins2img_ft_file,
+            image_feat_size=args.image_feat_size, obj_feat_size=args.obj_feat_size,
+            crop_size=args.crop_size, dtype=np.dtype(args.dtype)
+        )
+        print('Packed %d viewpoints (%s) and sections %s into %s' % (
+            len(header['vp_keys']), ', '.join(x[0] for x in header['record_fields']),
+            ', '.join(header['sections'].keys()), args.bundle
+        ))
+        return
+
+    for img_ft_file in args.img_ft_file:
+        output_dir = args.output_dir or os.path.dirname(img_ft_file)
+        packed_ft_file = os.path.join(
+            output_dir, os.path.splitext(os.path.basename(img_ft_file))[0] + '.npy'
+        )
+        num_vps = pack_image_features(
+            img_ft_file, packed_ft_file, image_feat_size=args.image_feat_size,
+            dtype=np.dtype(args.dtype)
+        )
+        print('Packed %d viewpoints from %s into %s' % (num_vps, img_ft_file, packed_ft_file))
+
+
+if __name__ == '__main__':
+    main()
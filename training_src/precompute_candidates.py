@@ -0,0 +1,39 @@
+''' Precompute the navigable candidates of every viewpoint with MatterSim
+    (use with --cand_table_dir, the env then needs no simulator sweeps).
+
+    python precompute_candidates.py --output_dir ../datasets/REVERIE/candidates
+'''
+import argparse
+import os
+import numpy as np
+
+from utils.data import load_nav_graphs, new_simulator
+from env_bases.reverie.data_utils import load_vp2roomlabel
+from env_bases.reverie.candidate_table import build_scan_candidate_table, candidate_table_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description='precompute candidate tables for --cand_table_dir')
+    parser.add_argument('--connectivity_dir', default='../datasets/R2R/connectivity')
+    parser.add_argument('--vp2room_file', default='../datasets/REVERIE/annotations/vp2room_label.json',
+                        help='room ids of the candidates, pass "" to skip')
+    parser.add_argument('--output_dir', required=True)
+    parser.add_argument('--scans', nargs='+', default=None, help='defaults to all scans in scans.txt')
+    args = parser.parse_args()
+
+    if args.scans is None:
+        with open(os.path.join(args.connectivity_dir, 'scans.txt')) as f:
+            args.scans = [x.strip() for x in f if x.strip()]
+    vp2room = load_vp2roomlabel(args.vp2room_file)['vp2room'] if args.vp2room_file else None
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    sim = new_simulator(args.connectivity_dir)
+    graphs = load_nav_graphs(args.connectivity_dir, args.scans)
+    for scan, G in graphs.items():
+        table = build_scan_candidate_table(sim, scan, G.nodes(), vp2room=vp2room)
+        np.savez(candidate_table_file(args.output_dir, scan), **table)
+        print('%s: %d viewpoints, %d candidates' % (scan, len(table['viewpoints']), len(table['cand_vpids'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,23 +11,39 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from torch import optim 
 from utils.distributed import is_default_gpu
-from utils.ops import pad_tensors, gen_seq_masks
+from utils.ops import pad_tensors, gen_seq_masks, select_batch, scatter_batch
 from torch.nn.utils.rnn import pad_sequence
 from env_bases.reverie.agent_base import Seq2SeqAgent 
-from models.graph_utils import GraphMap, GraphRoomMap
+from utils.data import get_view_perm_idxs
+from models.graph_utils import GraphMap, GraphRoomMap, BatchedGraphMap, NodeEmbedBuffer, get_local_fusion_idxs
 from models.model import VLNBert, Critic 
+from models.vilmodel import TextContext
 from warmup_src.model.ops import pad_tensors_wgrad 
 # from ipdb import set_trace
 
 CROP_SIZE = 5
 
+# per-episode inputs of the panorama / navigation steps, the ones _select_inputs indexes
+PANO_BATCH_KEYS = (
+    'view_img_fts', 'rec_view_img_fts', 'obj_img_fts', 'loc_fts', 'nav_types', 'view_lens', 'obj_lens',
+    'cand_vpids', 'obj_ids', 'knowledge_fts', 'crop_fts', 'used_cand_ids', 'view_perm_idxs',
+    'gmap_img_embeds', 'gmap_step_ids', 'gmap_pos_fts',
+)
+NAV_BATCH_KEYS = (
+    'gmap_vpids', 'gmap_img_embeds', 'gmap_step_ids', 'gmap_pos_fts', 'gmap_visited_masks',
+    'gmap_pair_dists', 'gmap_masks', 'no_vp_left', 'gmap_room_types', 'gmap_node_dist', 'ins2img',
+    'curr_vid_idx', 'vp_img_embeds', 'vp_rec_img_embeds', 'vp_pos_fts', 'vp_masks', 'vp_nav_masks',
+    'vp_obj_masks', 'vp_cand_vpids', 'gmap_cand_idxs', 'vp_bw_masks',
+)
+
 class ReverieMapAgent(Seq2SeqAgent):
 
     def _build_model(self):
-        self.vln_bert = VLNBert(self.args).cuda()
-        self.critic = Critic(self.args).cuda()
+        self.vln_bert = VLNBert(self.args).to(self.device)
+        self.critic = Critic(self.args).to(self.device)
         # buffer
         self.scanvp_cands = {}
     
@@ -64,8 +80,8 @@ class ReverieMapAgent(Seq2SeqAgent):
                 mask[i, : seq_lengths[i]] = True  
             ins2img = None
 
-        seq_tensor = torch.from_numpy(seq_tensor).long().cuda()
-        mask = torch.from_numpy(mask).cuda()
+        seq_tensor = torch.from_numpy(seq_tensor).long().to(self.device)
+        mask = torch.from_numpy(mask).to(self.device)
         return {
             'txt_ids': seq_tensor, 'txt_masks': mask, 'ins2img': ins2img
         }
@@ -73,6 +89,10 @@ class ReverieMapAgent(Seq2SeqAgent):
 
     def _panorama_feature_variable(self, obs):
         '''Extract precomputed features into variable. '''
+        if self.args.batch_obs:
+            assert getattr(obs, 'batch_fts', None) is not None, \
+                '--batch_obs expects the BatchObs of ReverNavBatchEnv._get_obs'
+            return self._panorama_feature_batch(obs.batch_fts)
         batch_view_img_fts, batch_rec_view_img_fts, batch_obj_img_fts, batch_loc_fts, batch_nav_types = [], [], [], [], []
         batch_view_lens, batch_obj_lens = [], []
         batch_cand_vpids, batch_objids = [], []
@@ -98,12 +118,10 @@ class ReverieMapAgent(Seq2SeqAgent):
             # ob['feature'] -> 36*772 ->pano feature -> here only add not candidate view point
             # length of view_img_fts not sure, for candidate point could have same pointId
             # since we collect all posibile navigable position on all 36 angles
-            view_img_fts.extend([x[:self.args.image_feat_size] for k, x 
-                in enumerate(ob['feature']) if k not in used_viewidxs])
-            rec_view_img_fts.extend([x[:self.args.image_feat_size] for k, x
-                                 in enumerate(ob['rec_feature']) if k not in used_viewidxs])
-            view_ang_fts.extend([x[self.args.image_feat_size:] for k, x  
-                in enumerate(ob['feature']) if k not in used_viewidxs])
+            noncand_viewidxs = get_view_perm_idxs([used_viewidxs])[0, len(used_viewidxs):]
+            view_img_fts.extend(ob['feature'][noncand_viewidxs, :self.args.image_feat_size])
+            rec_view_img_fts.extend(ob['rec_feature'][noncand_viewidxs, :self.args.image_feat_size])
+            view_ang_fts.extend(ob['feature'][noncand_viewidxs, self.args.image_feat_size:])
             nav_types.extend([0] * (36 - len(used_viewidxs)))
 
             # combine cand views and noncand views
@@ -131,29 +149,40 @@ class ReverieMapAgent(Seq2SeqAgent):
             knowledge_fts.append(ob['knowledge_feature'].reshape(1, 36, 1, 512))
             crop_fts.append(ob['crop_feature'].reshape(1, 36, CROP_SIZE, 512))
 
-        knowledge_fts = torch.tensor(np.concatenate(knowledge_fts, axis=0)).cuda()
-        crop_fts = torch.tensor(np.concatenate(crop_fts, axis=0)).cuda()
+        knowledge_fts = torch.tensor(np.concatenate(knowledge_fts, axis=0)).to(self.device)
+        crop_fts = torch.tensor(np.concatenate(crop_fts, axis=0)).to(self.device)
 
         # pad features to max_len
-        batch_view_img_fts = pad_tensors(batch_view_img_fts).cuda()
-        batch_rec_view_img_fts = pad_tensors(batch_rec_view_img_fts).cuda()
-        batch_obj_img_fts = pad_tensors(batch_obj_img_fts).cuda()
-        batch_loc_fts = pad_tensors(batch_loc_fts).cuda()
-        batch_nav_types = pad_sequence(batch_nav_types, batch_first=True, padding_value=0).cuda()
-        batch_view_lens = torch.LongTensor(batch_view_lens).cuda()
-        batch_obj_lens = torch.LongTensor(batch_obj_lens).cuda()
+        batch_view_img_fts = pad_tensors(batch_view_img_fts).to(self.device)
+        batch_rec_view_img_fts = pad_tensors(batch_rec_view_img_fts).to(self.device)
+        batch_obj_img_fts = pad_tensors(batch_obj_img_fts).to(self.device)
+        batch_loc_fts = pad_tensors(batch_loc_fts).to(self.device)
+        batch_nav_types = pad_sequence(batch_nav_types, batch_first=True, padding_value=0).to(self.device)
+        batch_view_lens = torch.LongTensor(batch_view_lens).to(self.device)
+        batch_obj_lens = torch.LongTensor(batch_obj_lens).to(self.device)
         
         # obj_ids are the objects in current position 
         return {
             'view_img_fts': batch_view_img_fts, 'rec_view_img_fts': batch_rec_view_img_fts, 'obj_img_fts': batch_obj_img_fts,
             'loc_fts': batch_loc_fts, 'nav_types': batch_nav_types,
             'view_lens': batch_view_lens, 'obj_lens': batch_obj_lens,
-            'cand_vpids': batch_cand_vpids, 'obj_ids': batch_objids, 'knowledge_fts': knowledge_fts,  'crop_fts': crop_fts, 'used_cand_ids': used_cand_ids
+            'cand_vpids': batch_cand_vpids, 'obj_ids': batch_objids, 'knowledge_fts': knowledge_fts,  'crop_fts': crop_fts, 'used_cand_ids': used_cand_ids,
+            'view_perm_idxs': torch.from_numpy(get_view_perm_idxs(used_cand_ids)).to(self.device)
         }        
     
 
+    def _panorama_feature_batch(self, batch_fts):
+        '''Same as _panorama_feature_variable from the arrays built by env._get_batch_fts '''
+        pano_inputs = {k: v for k, v in batch_fts.items() if isinstance(v, list)}
+        for k, v in batch_fts.items():
+            if not isinstance(v, list):
+                pano_inputs[k] = torch.from_numpy(v).to(self.device)
+        return pano_inputs
+
     def _nav_gmap_variable(self, obs, gmaps):
         # [STOP] + gmap_vpids
+        if self.args.batched_gmap:
+            return self._nav_batched_gmap_variable(obs, gmaps)
         batch_size = len(obs)
         
         batch_gmap_vpids, batch_gmap_lens = [], []
@@ -184,20 +213,12 @@ class ReverieMapAgent(Seq2SeqAgent):
             gmap_step_ids = [gmap.node_step_ids.get(vp, 0) for vp in gmap_vpids] 
             # get view point steps -> the point is visited in which step 
 
-            gmap_img_embeds = [gmap.get_node_embed(vp) for vp in gmap_vpids[1:]]
-            gmap_img_embeds = torch.stack(
-                [torch.zeros_like(gmap_img_embeds[0])] + gmap_img_embeds, 0
-            ) # cuda  [0] --> for stop 
-            
             gmap_pos_fts = gmap.get_pos_fts(
                 obs[i]['viewpoint'], gmap_vpids, obs[i]['heading'], obs[i]['elevation'],
             )
             curr_obs = obs[i]
             gmap_pair_dists = np.zeros((len(gmap_vpids), len(gmap_vpids)), dtype=np.float32)
-            for i in range(1, len(gmap_vpids)):
-                for j in range(i+1, len(gmap_vpids)):
-                    gmap_pair_dists[i, j] = gmap_pair_dists[j, i] = \
-                        gmap.graph.distance(gmap_vpids[i], gmap_vpids[j])
+            gmap_pair_dists[1:, 1:] = gmap.graph.distances(gmap_vpids[1:], gmap_vpids[1:])
             
             if self.args.use_room_type:
                 gmap_node_room_types = [gmap.get_node_room_type(vp) for vp in gmap_vpids[1:]]
@@ -213,7 +234,6 @@ class ReverieMapAgent(Seq2SeqAgent):
                 batch_gmap_node_score.append(torch.FloatTensor(gmap_node_score))
                 batch_curr_vids.append(curr_node_idx)
            
-            batch_gmap_img_embeds.append(gmap_img_embeds)
             batch_gmap_step_ids.append(torch.LongTensor(gmap_step_ids))
             batch_gmap_pos_fts.append(torch.from_numpy(gmap_pos_fts))
             batch_gmap_pair_dists.append(torch.from_numpy(gmap_pair_dists))
@@ -223,28 +243,32 @@ class ReverieMapAgent(Seq2SeqAgent):
             
         # collate
         batch_gmap_lens = torch.LongTensor(batch_gmap_lens)
-        batch_gmap_masks = gen_seq_masks(batch_gmap_lens).cuda()
-        batch_gmap_img_embeds = pad_tensors_wgrad(batch_gmap_img_embeds)
-        batch_gmap_step_ids = pad_sequence(batch_gmap_step_ids, batch_first=True).cuda()
-        batch_gmap_pos_fts = pad_tensors(batch_gmap_pos_fts).cuda()
-        batch_gmap_visited_masks = pad_sequence(batch_gmap_visited_masks, batch_first=True).cuda()
+        batch_gmap_masks = gen_seq_masks(batch_gmap_lens).to(self.device)
+        # cuda  [0] --> for stop 
+        batch_gmap_slot_idxs = gmaps[0].embed_buffer.get_slot_idxs([vpids[1:] for vpids in batch_gmap_vpids])
+        batch_gmap_img_embeds = gmaps[0].embed_buffer.get_slots(
+            np.arange(batch_size)[:, None], batch_gmap_slot_idxs
+        )
+        batch_gmap_step_ids = pad_sequence(batch_gmap_step_ids, batch_first=True).to(self.device)
+        batch_gmap_pos_fts = pad_tensors(batch_gmap_pos_fts).to(self.device)
+        batch_gmap_visited_masks = pad_sequence(batch_gmap_visited_masks, batch_first=True).to(self.device)
        
         if self.args.use_room_type:
-            batch_gmap_room_types = pad_sequence(batch_gmap_room_types, batch_first=True).cuda()
+            batch_gmap_room_types = pad_sequence(batch_gmap_room_types, batch_first=True).to(self.device)
             nav_gmap = {"gmap_room_types": batch_gmap_room_types}
         else:
             nav_gmap = {}
 
         if self.args.use_gd:
             batch_ins2img_feat = np.array(batch_ins2img_feat)
-            batch_gmap_node_score = pad_sequence(batch_gmap_node_score, batch_first=True).cuda()
+            batch_gmap_node_score = pad_sequence(batch_gmap_node_score, batch_first=True).to(self.device)
             nav_gmap.update({"gmap_node_dist": batch_gmap_node_score, "ins2img": batch_ins2img_feat, "curr_vid_idx": batch_curr_vids})
 
         max_gmap_len = max(batch_gmap_lens)
         gmap_pair_dists = torch.zeros(batch_size, max_gmap_len, max_gmap_len).float()
         for i in range(batch_size):
             gmap_pair_dists[i, :batch_gmap_lens[i], :batch_gmap_lens[i]] = batch_gmap_pair_dists[i]
-        gmap_pair_dists = gmap_pair_dists.cuda()
+        gmap_pair_dists = gmap_pair_dists.to(self.device)
        
         nav_gmap.update({
             'gmap_vpids': batch_gmap_vpids, 'gmap_img_embeds': batch_gmap_img_embeds,
@@ -255,6 +279,27 @@ class ReverieMapAgent(Seq2SeqAgent):
         })
         return nav_gmap
 
+    def _nav_batched_gmap_variable(self, obs, gmaps):
+        '''Same as _nav_gmap_variable from a BatchedGraphMap '''
+        node_idxs, gmap_lens = gmaps.get_gmap_nodes(self.args.enc_full_graph)
+        nav_gmap = gmaps.get_gmap_inputs(
+            node_idxs, gmap_lens,
+            np.array([ob['heading'] for ob in obs]), np.array([ob['elevation'] for ob in obs])
+        )
+        nav_gmap['gmap_masks'] = gen_seq_masks(nav_gmap.pop('gmap_lens')).to(self.device)
+        for k in ['gmap_step_ids', 'gmap_pos_fts', 'gmap_pair_dists', 'gmap_visited_masks']:
+            nav_gmap[k] = nav_gmap[k].to(self.device)
+        if self.args.use_room_type:
+            nav_gmap['gmap_room_types'] = nav_gmap['gmap_room_types'].to(self.device)
+            gmap_node_dist = nav_gmap.pop('gmap_node_dist')
+            curr_vid_idx = nav_gmap.pop('curr_vid_idx')
+            if self.args.use_gd:
+                nav_gmap.update({
+                    'gmap_node_dist': gmap_node_dist.to(self.device),
+                    'ins2img': np.array([ob['ins2img_feat'][:self.args.num_of_ins_img, :] for ob in obs]),
+                    'curr_vid_idx': curr_vid_idx,
+                })
+        return nav_gmap
 
     def _nav_vp_variable(self, obs, gmaps, pano_embeds, rec_pano_embeds, cand_vpids, view_lens, obj_lens, nav_types):
         batch_size = len(obs)
@@ -267,8 +312,193 @@ class ReverieMapAgent(Seq2SeqAgent):
             [torch.zeros_like(rec_pano_embeds[:, :1]), rec_pano_embeds], 1
         )
 
-        batch_vp_pos_fts = []
+        if self.args.batched_gmap:
+            batch_vp_pos_fts = torch.from_numpy(gmaps.get_vp_pos_fts(
+                vp_img_embeds.size(1),
+                np.array([ob['heading'] for ob in obs]), np.array([ob['elevation'] for ob in obs])
+            ))
+        else:
+            batch_vp_pos_fts = self._vp_pos_fts(obs, gmaps, cand_vpids, vp_img_embeds.size(1))
+        batch_vp_pos_fts = batch_vp_pos_fts.to(self.device)
 
+        vp_nav_masks = torch.cat([torch.ones(batch_size, 1).bool().to(self.device), nav_types == 1], 1)  # candidate node
+        vp_obj_masks = torch.cat([torch.zeros(batch_size, 1).bool().to(self.device), nav_types == 2], 1)  # object
+        
+        return {
+            'vp_img_embeds': vp_img_embeds,
+            'vp_rec_img_embeds': vp_rec_img_embeds,
+            'vp_pos_fts': batch_vp_pos_fts,
+            'vp_masks': gen_seq_masks(view_lens+obj_lens+1),
+            'vp_nav_masks': vp_nav_masks,
+            'vp_obj_masks': vp_obj_masks,
+            'vp_cand_vpids': [[None]+x for x in cand_vpids]
+        }
+
+    def _panorama_forward(self, pano_inputs, txt_ctx, idxs=None):
+        '''vln_bert('panorama') on the episodes idxs (all by default, txt_ctx holds their rows).
+        pano_embeds, rec_pano_embeds and the average of pano_embeds, scattered back to the whole
+        batch with zeros for the other episodes '''
+        batch_size = pano_inputs['nav_types'].size(0)
+        model_inputs = self._select_inputs(pano_inputs, idxs, PANO_BATCH_KEYS) if idxs is not None else pano_inputs
+        model_inputs.update({'instruction_fts': txt_ctx.txt_embeds, 'txt_ctx': txt_ctx})
+
+        pano_embeds, rec_pano_embeds, pano_masks, rec_pano_masks = self.vln_bert('panorama', model_inputs)
+        avg_pano_embeds = torch.sum(pano_embeds * pano_masks.unsqueeze(2), 1) / \
+                          torch.sum(pano_masks, 1, keepdim = True)
+        if idxs is not None:
+            # padded to the views + objects of the whole batch
+            pano_size = (pano_inputs['nav_types'].size(1), pano_embeds.size(2))
+            pano_embeds = scatter_batch(pano_embeds, idxs, batch_size, pano_size)
+            rec_pano_embeds = scatter_batch(rec_pano_embeds, idxs, batch_size, pano_size)
+            avg_pano_embeds = scatter_batch(avg_pano_embeds, idxs, batch_size)
+        return pano_embeds, rec_pano_embeds, avg_pano_embeds
+
+    def _update_node_embeds(self, gmaps, obs, ended, pano_inputs, pano_embeds, avg_pano_embeds):
+        if self.args.batched_gmap:
+            gmaps.update_node_embeds(~ended, avg_pano_embeds, pano_embeds)
+            return
+        # update visited nodes (rewrite) and unvisited nodes (accumulate) of all episodes at once
+        embed_buffer = gmaps[0].embed_buffer
+        cur_bs = [i for i in range(len(obs)) if not ended[i]]
+        cand_bs, cand_js, cand_vps = [], [], []
+        for i in cur_bs:
+            for j, i_cand_vp in enumerate(pano_inputs['cand_vpids'][i]):
+                if not gmaps[i].graph.visited(i_cand_vp):
+                    cand_bs.append(i)
+                    cand_js.append(j)
+                    cand_vps.append(i_cand_vp)
+        embed_buffer.update(
+            cur_bs, [obs[i]['viewpoint'] for i in cur_bs], avg_pano_embeds[cur_bs], rewrite=True
+        )
+        embed_buffer.update(cand_bs, cand_vps, pano_embeds[cand_bs, cand_js])     # contains obj info
+
+    def _nav_variable(self, obs, gmaps, pano_inputs, pano_embeds, rec_pano_embeds):
+        nav_inputs = self._nav_gmap_variable(obs, gmaps) 
+        # -> get embed for global branch   -> node embeding, visited->avg_pano  unvisited->view feat
+    
+        nav_inputs.update(
+            self._nav_vp_variable(
+                obs, gmaps, pano_embeds, rec_pano_embeds, pano_inputs['cand_vpids'],
+                pano_inputs['view_lens'], pano_inputs['obj_lens'],
+                pano_inputs['nav_types'],
+            )
+        )   # -> get embeding for local branch 
+        nav_inputs.update(
+            self._nav_fusion_variable(
+                gmaps, nav_inputs['gmap_vpids'], nav_inputs['vp_cand_vpids'],
+                nav_inputs['vp_nav_masks'].size(1)
+            )
+        )
+        return nav_inputs
+
+    def _navigation_forward(self, nav_inputs, txt_ctx, idxs=None):
+        '''vln_bert navigation step of the episodes idxs (all by default, txt_ctx holds
+        their rows), the outputs scattered back to the whole batch with zeros '''
+        batch_size = len(nav_inputs['gmap_vpids'])
+        model_inputs = self._select_inputs(nav_inputs, idxs, NAV_BATCH_KEYS) if idxs is not None else nav_inputs
+        model_inputs.update({
+            'txt_embeds': txt_ctx.txt_embeds,
+            'txt_masks': txt_ctx.txt_masks,
+            'txt_ctx': txt_ctx,
+            # 'ins2img': language_inputs['ins2img']
+        })
+
+        if not self.args.use_room_type:
+            nav_outs = self.vln_bert('navigation', model_inputs)
+        elif self.args.h_graph:
+            nav_outs = self.vln_bert('navigation_with_layout_graph', model_inputs)
+        elif self.args.use_gd:
+            if self.args.stable_gd:
+                nav_outs = self.vln_bert('navigation_with_rt_gd', model_inputs)  # cur
+            else:  # dynamic weight
+                nav_outs = self.vln_bert('navigation_with_room_type_node_dist', model_inputs)
+        else:
+            nav_outs = self.vln_bert('navigation_with_room_type', model_inputs) 
+        if idxs is not None:
+            nav_outs = {
+                k: scatter_batch(v, idxs, batch_size) if isinstance(v, torch.Tensor) else v
+                for k, v in nav_outs.items()
+            }
+        return nav_outs
+
+    def _nav_logits(self, nav_outs, nav_inputs):
+        if self.args.fusion == 'local':
+            nav_logits = nav_outs['local_logits']
+            nav_vpids = nav_inputs['vp_cand_vpids']
+        elif self.args.fusion == 'global':
+            nav_logits = nav_outs['global_logits']
+            nav_vpids = nav_inputs['gmap_vpids']
+        elif self.args.fusion == 'fuse_ins_img':
+            nav_logits = nav_outs['fused_logits'] 
+            dist_logits = nav_outs['dist_logits']
+            logit_mask = dist_logits == -float('inf')
+            nav_logits = torch.softmax(nav_logits, 1) + self.args.fuse_dist_score_to_global * torch.softmax(dist_logits, 1)
+            nav_logits[logit_mask] = -float('inf')
+            nav_vpids = nav_inputs['gmap_vpids']
+        else:  # cur
+            nav_logits = nav_outs['fused_logits'] 
+            nav_vpids = nav_inputs['gmap_vpids']
+        return nav_logits, nav_vpids
+
+    def _update_stop_scores(self, gmaps, obs, ended, nav_probs, obj_logits, view_lens):
+        for i, gmap in enumerate(gmaps):
+            if not ended[i]:
+                i_vp = obs[i]['viewpoint']
+                # update i_vp: stop and object grounding scores
+                i_objids = obs[i]['obj_ids']
+                i_obj_logits = obj_logits[i, view_lens[i]+1: ]
+                gmap.node_stop_scores[i_vp] = {
+                    'stop': nav_probs[i, 0].data.item(),
+                    'og': i_objids[torch.argmax(i_obj_logits)] if len(i_objids) >0 else None,
+                    'og_details': {'objids': i_objids, 'logits': i_obj_logits[:len(i_objids)]},
+                }
+
+    def _cpu_actions(self, a_t, a_t_stop, ended, just_ended, nav_inputs, nav_vpids, t):
+        '''Next viewpoint of each episode, None (and just_ended set) for the ones that stop '''
+        cpu_a_t = []
+        for i in range(len(ended)):
+            if a_t_stop[i] or ended[i] or nav_inputs['no_vp_left'][i] or (t == self.args.max_action_len - 1):
+                cpu_a_t.append(None)
+                just_ended[i] = True 
+            else:
+                cpu_a_t.append(nav_vpids[i][a_t[i]])
+        return cpu_a_t
+
+    def _env_step(self, cpu_a_t, gmaps, obs, traj):
+        '''Moves the simulators and returns the new observations. Only touches the env, the
+        graph paths and traj['path'] of the moving episodes, so it can run in a worker thread '''
+        self.make_equiv_action(cpu_a_t, gmaps, obs, traj)
+        return self.env._get_obs()
+
+    def _finish_traj(self, gmap, ob, traj):
+        '''Ended episode: go to the node with the highest stop score, predict its object '''
+        stop_node, stop_score = None, {'stop': -float('inf'), 'og': None}
+        for k, v in gmap.node_stop_scores.items():
+            if v['stop'] > stop_score['stop']:
+                stop_score = v 
+                stop_node = k 
+
+        if stop_node is not None and ob['viewpoint'] != stop_node:
+            traj['path'].append(gmap.graph.path(ob['viewpoint'], stop_node))
+        traj['pred_objid'] = stop_score['og']
+
+        if self.args.detailed_output:
+            for k,v in gmap.node_stop_scores.items():
+                traj['details'][k] = {
+                    'stop_prob': float(v['stop']),
+                    'obj_ids': [str(x) for x in v['og_details']['objids']],
+                    'obj_logits': v['og_details']['logits'].tolist()
+                }
+
+    def _select_inputs(self, inputs, idxs, batch_keys):
+        '''Inputs of the episodes idxs only: the batch_keys entries are indexed, the others kept '''
+        return {
+            k: select_batch(v, idxs) if k in batch_keys and v is not None else v
+            for k, v in inputs.items()
+        }
+
+    def _vp_pos_fts(self, obs, gmaps, cand_vpids, num_vps):
+        batch_vp_pos_fts = []
         for i, gmap in enumerate(gmaps):
             cur_cand_pos_fts = gmap.get_pos_fts(
                 obs[i]['viewpoint'], cand_vpids[i],
@@ -281,28 +511,28 @@ class ReverieMapAgent(Seq2SeqAgent):
             )
 
             # add [stop] token at begining
-            vp_pos_fts = np.zeros((vp_img_embeds.size(1), 14), dtype=np.float32)
+            vp_pos_fts = np.zeros((num_vps, 14), dtype=np.float32)
             vp_pos_fts[:, :7] = cur_start_pos_fts
             vp_pos_fts[1: len(cur_cand_pos_fts)+1, 7:] = cur_cand_pos_fts
             batch_vp_pos_fts.append(torch.from_numpy(vp_pos_fts))
-        
-
-        batch_vp_pos_fts = pad_tensors(batch_vp_pos_fts).cuda()
-
-        vp_nav_masks = torch.cat([torch.ones(batch_size, 1).bool().cuda(), nav_types == 1], 1)  # candidate node
-        vp_obj_masks = torch.cat([torch.zeros(batch_size, 1).bool().cuda(), nav_types == 2], 1)  # object
-        
+        return pad_tensors(batch_vp_pos_fts)
+
+
+    def _nav_fusion_variable(self, gmaps, gmap_vpids, vp_cand_vpids, num_vps):
+        '''Indices for fusing the local logits into the global ones, built from the
+        graphs on cpu so the model does not read gmap_visited_masks back '''
+        gmap_visited_masks = [
+            [vp is not None and self.args.enc_full_graph and gmaps[i].graph.visited(vp) for vp in vpids]
+            for i, vpids in enumerate(gmap_vpids)
+        ]
+        gmap_cand_idxs, vp_bw_masks = get_local_fusion_idxs(
+            gmap_vpids, gmap_visited_masks, vp_cand_vpids, num_vps
+        )
         return {
-            'vp_img_embeds': vp_img_embeds,
-            'vp_rec_img_embeds': vp_rec_img_embeds,
-            'vp_pos_fts': batch_vp_pos_fts,
-            'vp_masks': gen_seq_masks(view_lens+obj_lens+1),
-            'vp_nav_masks': vp_nav_masks,
-            'vp_obj_masks': vp_obj_masks,
-            'vp_cand_vpids': [[None]+x for x in cand_vpids]
+            'gmap_cand_idxs': torch.from_numpy(gmap_cand_idxs).to(self.device),
+            'vp_bw_masks': torch.from_numpy(vp_bw_masks).to(self.device),
         }
 
-
     def _update_scanvp_cands(self, obs):
         for ob in obs:
             scan = ob['scan']
@@ -333,56 +563,60 @@ class ReverieMapAgent(Seq2SeqAgent):
                 self.env.env.sims[i].newEpisode([ob['scan']], [action], [heading], [elevation])
 
     
+    def _scan_node_idxs(self, obs, vpids):
+        ''' [B, max_len] node ids of the vpids in the distance matrix of their scan, -1 for [STOP] / padding '''
+        node_idxs = np.full((len(obs), max(len(x) for x in vpids)), -1, dtype=np.int64)
+        for i, ob in enumerate(obs):
+            vp2idx = self.env.scan_shortest_paths[ob['scan']].vp2idx
+            node_idxs[i, :len(vpids[i])] = [vp2idx.get(vp, -1) for vp in vpids[i]]
+        return node_idxs
+
     def _teacher_action(self, obs, vpids, ended, visited_masks=None):
         """
         Extract teacher actions into variable.
         """
-        a = np.zeros(len(obs), dtype=np.int64)
+        node_idxs = self._scan_node_idxs(obs, vpids)
+        # distance of the paths current vp -> candidate -> goal, inf for [STOP], visited and padding
+        dists = np.full(node_idxs.shape, np.inf, dtype=np.float64)
+        for i, ob in enumerate(obs):
+            sp = self.env.scan_shortest_paths[ob['scan']]
+            valid = node_idxs[i] >= 0
+            cand_idxs = node_idxs[i, valid]
+            dists[i, valid] = sp.distances[cand_idxs, sp.vp2idx[ob['gt_path'][-1]]].astype(np.float64) \
+                              + sp.distances[sp.vp2idx[ob['viewpoint']], cand_idxs].astype(np.float64)
+        if visited_masks is not None:
+            visited_masks = visited_masks.cpu().numpy()[:, :dists.shape[1]]
+            dists[:, :visited_masks.shape[1]][visited_masks] = np.inf
+        a = np.argmin(dists, 1)
+        all_searched = np.isinf(dists[np.arange(len(obs)), a])
+        a[all_searched] = self.args.ignoreid
         for i, ob in enumerate(obs):
             if ended[i]:
                 a[i] = self.args.ignoreid
-            else:
-                if ob['viewpoint'] == ob['gt_path'][-1]:
-                    a[i] = 0 # stop if arrived
-                else:
-                    scan = ob['scan']
-                    cur_vp = ob['viewpoint']
-                    min_idx, min_dist = self.args.ignoreid, float('inf')
-
-                    for j, vpid in enumerate(vpids[i]):
-                        # 0 for stop           vpoint is not masks -> unvisited 
-                        if j > 0 and ((visited_masks is None) or (not visited_masks[i][j])):
-                            dist = self.env.shortest_distances[scan][vpid][ob['gt_path'][-1]] \
-                                   + self.env.shortest_distances[scan][cur_vp][vpid]
-                            if dist < min_dist:
-                                min_dist = dist 
-                                min_idx = j 
-                            # which is more closer to the goal point 
-                    a[i] = min_idx 
-                    if min_idx == self.args.ignoreid:
-                        print('scan %s : all vps are searched ' % (scan))
-        return torch.from_numpy(a).cuda()
+            elif ob['viewpoint'] == ob['gt_path'][-1]:
+                a[i] = 0 # stop if arrived
+            elif all_searched[i]:
+                print('scan %s : all vps are searched ' % (ob['scan']))
+        return torch.from_numpy(a).to(self.device)
     
     
     def _teacher_object(self, obs, ended, view_lens):
         # not at right position or object not observaed -> target = -100
-        targets = np.zeros(len(obs), dtype=np.int64)
+        batch_size = len(obs)
+        max_objs = max([len(ob['obj_ids']) for ob in obs] + [1])
+        obj_ids = np.full((batch_size, max_objs), None, dtype=object)
         for i, ob in enumerate(obs):
-            if ended[i]:
-                targets[i] = self.args.ignoreid
-            else:
-                i_vp = ob['viewpoint']
-                if i_vp not in ob['gt_end_vps']:
-                    targets[i] = self.args.ignoreid
-                else:
-                    i_objids = ob['obj_ids']
-                    targets[i] = self.args.ignoreid
-                    for j, obj_id in enumerate(i_objids):
-                        if str(obj_id) == str(ob['gt_obj_id']):
-                            # TODO check 
-                            targets[i] = j + view_lens[i] + 1
-                            break 
-        return torch.from_numpy(targets).cuda()
+            obj_ids[i, :len(ob['obj_ids'])] = [str(x) for x in ob['obj_ids']]
+        gt_obj_ids = np.array([str(ob['gt_obj_id']) for ob in obs], dtype=object)
+        matches = obj_ids == gt_obj_ids[:, None]
+        at_goal = np.array([
+            not ended[i] and ob['viewpoint'] in ob['gt_end_vps'] for i, ob in enumerate(obs)
+        ], dtype=bool)
+        targets = np.where(
+            at_goal & matches.any(1),
+            matches.argmax(1) + view_lens.cpu().numpy() + 1, self.args.ignoreid
+        )
+        return torch.from_numpy(targets.astype(np.int64)).to(self.device)
     
 
     def _teacher_room_type(self, nav_inputs):
@@ -433,15 +667,21 @@ class ReverieMapAgent(Seq2SeqAgent):
 
         batch_size = len(obs)
         # build graph : keep the start viewpoint
-        if not self.args.use_room_type:
-            gmaps = [GraphMap(ob['viewpoint']) for ob in obs]
+        if self.args.batched_gmap:
+            gmaps = BatchedGraphMap([ob['viewpoint'] for ob in obs], use_room_type=self.args.use_room_type)
+            gmaps.update_graph(obs)
+        elif not self.args.use_room_type:
+            embed_buffer = NodeEmbedBuffer(batch_size)
+            gmaps = [GraphMap(ob['viewpoint'], embed_buffer, i) for i, ob in enumerate(obs)]
         else:
             # if self.args.use_gd:
             #     gmaps = [GraphRoomMapScore(ob['viewpoint'], ob['scan'], use_real_dist=self.args.use_real_dist_norm) for ob in obs ]
             # else:
-            gmaps = [GraphRoomMap(ob['viewpoint']) for ob in obs ]
-        for i, ob in enumerate(obs):
-            gmaps[i].update_graph(ob) 
+            embed_buffer = NodeEmbedBuffer(batch_size)
+            gmaps = [GraphRoomMap(ob['viewpoint'], embed_buffer, i) for i, ob in enumerate(obs)]
+        if not self.args.batched_gmap:
+            for i, ob in enumerate(obs):
+                gmaps[i].update_graph(ob) 
         
         # Record the navigation path
         traj = [{
@@ -455,10 +695,16 @@ class ReverieMapAgent(Seq2SeqAgent):
         # Language input: txt_ids , txt_masks
         language_inputs = self._language_variable(obs)
         txt_embeds = self.vln_bert('language', language_inputs)
+        # text side projections shared by all the steps
+        txt_ctx = TextContext(txt_embeds, language_inputs['txt_masks'])
         
         # Initialization the tracking state
         ended = np.array([False] * batch_size)
         just_ended = np.array([False] * batch_size)
+        # episodes fed to the model (--compact_batch), the rows of txt_ctx.
+        # evaluation only: in training the room type loss also covers the ended episodes
+        act_idxs = np.arange(batch_size)
+        compact_batch = self.args.compact_batch and not self.vln_bert.training
 
         # Init the logs
         masks = []
@@ -469,218 +715,168 @@ class ReverieMapAgent(Seq2SeqAgent):
         node_dist_loss = 0.
         nav_inputs = {'gmap_img_embeds': None,
                       'gmap_step_ids': None, 'gmap_pos_fts': None}
-
-        for t in range(self.args.max_action_len):
-            for i, gmap in enumerate(gmaps):
-                if not ended[i]:
-                    gmap.node_step_ids[obs[i]['viewpoint']] = t + 1
+        # teacher actions only need the graph, so the env steps in this thread during the policy forward
+        env_worker = ThreadPoolExecutor(max_workers=1) if self.args.async_env and self.feedback == 'teacher' else None
+
+        try:
+            for t in range(self.args.max_action_len):
+                if compact_batch and np.sum(~ended) < len(act_idxs):
+                    new_act_idxs = np.nonzero(~ended)[0]
+                    keep = torch.from_numpy(np.searchsorted(act_idxs, new_act_idxs)).to(self.device)
+                    txt_ctx = txt_ctx.select(keep)
+                    act_idxs = new_act_idxs
+                compact = len(act_idxs) < batch_size
+
+                if self.args.batched_gmap:
+                    gmaps.update_step_ids(~ended, t + 1)
+                else:
+                    for i, gmap in enumerate(gmaps):
+                        if not ended[i]:
+                            gmap.node_step_ids[obs[i]['viewpoint']] = t + 1
             
-            # graph representation
-            pano_inputs = self._panorama_feature_variable(obs)
-            #  view_img_fts, obj_img_fts, loc_fts, nav_types, view_lens, obj_lens, cand_vpids, obj_ids
-
-            # History features
-            pano_inputs.update({'instruction_fts': txt_embeds})
-            pano_inputs.update({'gmap_img_embeds': nav_inputs['gmap_img_embeds'],
-                                'gmap_step_ids': nav_inputs['gmap_step_ids'],
-                                'gmap_pos_fts': nav_inputs['gmap_pos_fts']})
-
-            # model get node embedding 
-            pano_embeds, rec_pano_embeds, pano_masks, rec_pano_masks = self.vln_bert('panorama', pano_inputs)
-            avg_pano_embeds = torch.sum(pano_embeds * pano_masks.unsqueeze(2), 1) / \
-                              torch.sum(pano_masks, 1, keepdim = True)
- 
-            for i, gmap in enumerate(gmaps):
-                if not ended[i]:
-                    # update visited node
-                    i_vp = obs[i]['viewpoint']
-                    gmap.update_node_embed(i_vp, avg_pano_embeds[i], rewrite=True)
-                    # update unvisited nodes
-                    for j, i_cand_vp in enumerate(pano_inputs['cand_vpids'][i]):
-                        if not gmap.graph.visited(i_cand_vp):
-                            gmap.update_node_embed(i_cand_vp, pano_embeds[i, j])
-                                                              # contains obj info 
-            # navigation policy 
-            nav_inputs = self._nav_gmap_variable(obs, gmaps) 
-            # -> get embed for global branch   -> node embeding, visited->avg_pano  unvisited->view feat
-        
-            nav_inputs.update(
-                self._nav_vp_variable(
-                    obs, gmaps, pano_embeds, rec_pano_embeds, pano_inputs['cand_vpids'],
-                    pano_inputs['view_lens'], pano_inputs['obj_lens'],
-                    pano_inputs['nav_types'],
+                # graph representation
+                pano_inputs = self._panorama_feature_variable(obs)
+                #  view_img_fts, obj_img_fts, loc_fts, nav_types, view_lens, obj_lens, cand_vpids, obj_ids
+
+                # History features
+                pano_inputs.update({'gmap_img_embeds': nav_inputs['gmap_img_embeds'],
+                                    'gmap_step_ids': nav_inputs['gmap_step_ids'],
+                                    'gmap_pos_fts': nav_inputs['gmap_pos_fts']})
+
+                # model get node embedding 
+                pano_embeds, rec_pano_embeds, avg_pano_embeds = self._panorama_forward(
+                    pano_inputs, txt_ctx, act_idxs if compact else None
                 )
-            )   # -> get embeding for local branch 
-    
-            nav_inputs.update({
-                'txt_embeds': txt_embeds,
-                'txt_masks': language_inputs['txt_masks'],
-                # 'ins2img': language_inputs['ins2img']
-            })
-
-            if not self.args.use_room_type:
-                nav_outs = self.vln_bert('navigation', nav_inputs)
-            elif self.args.h_graph:
-                nav_outs = self.vln_bert('navigation_with_layout_graph', nav_inputs)
-            elif self.args.use_gd:
-                if self.args.stable_gd:
-                    nav_outs = self.vln_bert('navigation_with_rt_gd', nav_inputs)  # cur
-                else:  # dynamic weight
-                    nav_outs = self.vln_bert('navigation_with_room_type_node_dist', nav_inputs)
-            else:
-                nav_outs = self.vln_bert('navigation_with_room_type', nav_inputs) 
-        
-            if self.args.fusion == 'local':
-                nav_logits = nav_outs['local_logits']
-                nav_vpids = nav_inputs['vp_cand_vpids']
-            elif self.args.fusion == 'global':
-                nav_logits = nav_outs['global_logits']
-                nav_vpids = nav_inputs['gmap_vpids']
-            elif self.args.fusion == 'fuse_ins_img':
-                nav_logits = nav_outs['fused_logits'] 
-                dist_logits = nav_outs['dist_logits']
-                logit_mask = dist_logits == -float('inf')
-                nav_logits = torch.softmax(nav_logits, 1) + self.args.fuse_dist_score_to_global * torch.softmax(dist_logits, 1)
-                nav_logits[logit_mask] = -float('inf')
-                nav_vpids = nav_inputs['gmap_vpids']
-            else:  # cur
-                nav_logits = nav_outs['fused_logits'] 
-                nav_vpids = nav_inputs['gmap_vpids']
-
-            nav_probs = torch.softmax(nav_logits, 1)
-            obj_logits = nav_outs['obj_logits']
-          
-            # update graph 
-            for i, gmap in enumerate(gmaps):
-                if not ended[i]:
-                    i_vp = obs[i]['viewpoint']
-                    # update i_vp: stop and object grounding scores
-                    i_objids = obs[i]['obj_ids']
-                    i_obj_logits = obj_logits[i, pano_inputs['view_lens'][i]+1: ]
-                    gmap.node_stop_scores[i_vp] = {
-                        'stop': nav_probs[i, 0].data.item(),
-                        'og': i_objids[torch.argmax(i_obj_logits)] if len(i_objids) >0 else None,
-                        'og_details': {'objids': i_objids, 'logits': i_obj_logits[:len(i_objids)]},
-                    }
-
-            # records room type
-            if self.args.record_rt:
-                target_room_type = self._teacher_room_type(nav_inputs)
-                pred_room, target_room = self._preprocess_room_loss(nav_outs['room_type_pred'][:,1:], target_room_type)
-                pred_room_label = torch.argmax(pred_room, dim=1)
-                pred_room_label = pred_room_label.reshape(target_room_type.size())
-                rt_records = (target_room_type.detach().cpu().numpy().astype(int).tolist(), pred_room_label.detach().cpu().numpy().astype(int).tolist(), nav_vpids, [gmap.curr_id for gmap in gmaps])
-
-
-            if train_ml is not None:
-                # supervised training
-                nav_targets = self._teacher_action(
-                    obs, nav_vpids, ended,
-                    visited_masks = nav_inputs['gmap_visited_masks'] if self.args.fusion != 'local' else None 
-                )
-
-                ml_loss += self.criterion(nav_logits, nav_targets)
-                if self.args.fusion in ['avg', 'dynamic', 'fuse_ins_img'] and self.args.loss_nav_3:
-                    ml_loss += self.criterion(nav_outs['global_logits'], nav_targets)
-                    local_nav_targets = self._teacher_action(
-                        obs, nav_inputs['vp_cand_vpids'], ended, visited_masks=None 
+                self._update_node_embeds(gmaps, obs, ended, pano_inputs, pano_embeds, avg_pano_embeds)
+
+                # navigation policy 
+                nav_inputs = self._nav_variable(obs, gmaps, pano_inputs, pano_embeds, rec_pano_embeds)
+                nav_targets, env_step = None, None
+                if env_worker is not None:
+                    nav_vpids = nav_inputs['vp_cand_vpids'] if self.args.fusion == 'local' else nav_inputs['gmap_vpids']
+                    nav_targets = self._teacher_action(
+                        obs, nav_vpids, ended,
+                        visited_masks = nav_inputs['gmap_visited_masks'] if self.args.fusion != 'local' else None 
                     )
-                    ml_loss += self.criterion(nav_outs['local_logits'], local_nav_targets)
+                    a_t_stop = [ob['viewpoint'] == ob['gt_path'][-1] for ob in obs]
+                    cpu_a_t = self._cpu_actions(nav_targets, a_t_stop, ended, just_ended, nav_inputs, nav_vpids, t)
+                    env_step = env_worker.submit(self._env_step, cpu_a_t, gmaps, obs, traj)
+                nav_outs = self._navigation_forward(nav_inputs, txt_ctx, act_idxs if compact else None)
+                nav_logits, nav_vpids = self._nav_logits(nav_outs, nav_inputs)
+
+                nav_probs = torch.softmax(nav_logits, 1)
+                obj_logits = nav_outs['obj_logits']
+          
+                # update graph 
+                self._update_stop_scores(gmaps, obs, ended, nav_probs, obj_logits, pano_inputs['view_lens'])
 
-                obj_targets = self._teacher_object(obs, ended, pano_inputs['view_lens'])
-                og_loss += self.criterion(obj_logits, obj_targets)
-  
-                if self.args.use_room_type or self.args.h_graph:
+                # records room type
+                if self.args.record_rt:
                     target_room_type = self._teacher_room_type(nav_inputs)
                     pred_room, target_room = self._preprocess_room_loss(nav_outs['room_type_pred'][:,1:], target_room_type)
-                    room_type_loss += self.criterion(pred_room, target_room)
+                    pred_room_label = torch.argmax(pred_room, dim=1)
+                    pred_room_label = pred_room_label.reshape(target_room_type.size())
+                    rt_records = (target_room_type.detach().cpu().numpy().astype(int).tolist(), pred_room_label.detach().cpu().numpy().astype(int).tolist(), nav_vpids, [gmap.curr_id for gmap in gmaps])
+
+
+                if train_ml is not None:
+                    # supervised training
+                    if nav_targets is None:
+                        nav_targets = self._teacher_action(
+                            obs, nav_vpids, ended,
+                            visited_masks = nav_inputs['gmap_visited_masks'] if self.args.fusion != 'local' else None 
+                        )
+
+                    ml_loss += self.criterion(nav_logits, nav_targets)
+                    if self.args.fusion in ['avg', 'dynamic', 'fuse_ins_img'] and self.args.loss_nav_3:
+                        ml_loss += self.criterion(nav_outs['global_logits'], nav_targets)
+                        local_nav_targets = self._teacher_action(
+                            obs, nav_inputs['vp_cand_vpids'], ended, visited_masks=None 
+                        )
+                        ml_loss += self.criterion(nav_outs['local_logits'], local_nav_targets)
+
+                    obj_targets = self._teacher_object(obs, ended, pano_inputs['view_lens'])
+                    og_loss += self.criterion(obj_logits, obj_targets)
+  
+                    if self.args.use_room_type or self.args.h_graph:
+                        target_room_type = self._teacher_room_type(nav_inputs)
+                        pred_room, target_room = self._preprocess_room_loss(nav_outs['room_type_pred'][:,1:], target_room_type)
+                        room_type_loss += self.criterion(pred_room, target_room)
                 
-                # if self.args.use_gd:
-                #     target_node_score, mask = self._teacher_node_dist(nav_inputs)
-                #     node_dist_loss += self._node_dist_loss(nav_outs['node_dist_pred'][:,1:].squeeze(2), target_node_score, mask)
-                if self.args.use_dist_logits_prediction and not self.args.stable_gd:
-                    ml_loss += self.criterion(nav_outs['dist_logits'], nav_targets)
-
-            # Determinate next navigation viewpoint 
-            if self.feedback == 'teacher':
-                a_t = nav_targets
-            elif self.feedback == 'argmax':
-                _, a_t = nav_logits.max(1)
-                a_t = a_t.detach()
-            elif self.feedback == 'sample':
-                c = torch.distributions.Categorical(nav_probs)
-                self.logs['entropy'].append(c.entropy().sum().item())
-                entropys.append(c.entropy())
-                a_t = c.sample().detach()
-            elif self.feedback == 'expl_sample':
-                _, a_t = nav_probs.max(1)
-                rand_explores = np.random.rand(batch_size, ) > self.args.expl_max_ratio
-                if self.args.fusion == 'local':
-                    cpu_nav_masks = nav_inputs['vp_nav_masks'].data.cpu().numpy()
+                    # if self.args.use_gd:
+                    #     target_node_score, mask = self._teacher_node_dist(nav_inputs)
+                    #     node_dist_loss += self._node_dist_loss(nav_outs['node_dist_pred'][:,1:].squeeze(2), target_node_score, mask)
+                    if self.args.use_dist_logits_prediction and not self.args.stable_gd:
+                        ml_loss += self.criterion(nav_outs['dist_logits'], nav_targets)
+
+                # Determinate next navigation viewpoint 
+                if env_step is not None:
+                    a_t = nav_targets
+                elif self.feedback == 'teacher':
+                    a_t = nav_targets
+                elif self.feedback == 'argmax':
+                    _, a_t = nav_logits.max(1)
+                    a_t = a_t.detach()
+                elif self.feedback == 'sample':
+                    c = torch.distributions.Categorical(nav_probs)
+                    self.logs['entropy'].append(c.entropy().sum().item())
+                    entropys.append(c.entropy())
+                    a_t = c.sample().detach()
+                elif self.feedback == 'expl_sample':
+                    _, a_t = nav_probs.max(1)
+                    rand_explores = np.random.rand(batch_size, ) > self.args.expl_max_ratio
+                    if self.args.fusion == 'local':
+                        cpu_nav_masks = nav_inputs['vp_nav_masks'].data.cpu().numpy()
+                    else:
+                        cpu_nav_masks = (nav_inputs['gmap_masks'] * nav_inputs['gmap_visited_masks'].logical_not()).data.cpu().numpy()
+                    for i in range(batch_size):
+                        if rand_explores[i]:
+                            cand_a_t = np.arange(len(cpu_nav_masks[i]))[cpu_nav_masks[i]]
+                            a_t[i] = np.random.choice(cand_a_t)
                 else:
-                    cpu_nav_masks = (nav_inputs['gmap_masks'] * nav_inputs['gmap_visited_masks'].logical_not()).data.cpu().numpy()
-                for i in range(batch_size):
-                    if rand_explores[i]:
-                        cand_a_t = np.arange(len(cpu_nav_masks[i]))[cpu_nav_masks[i]]
-                        a_t[i] = np.random.choice(cand_a_t)
-            else:
-                print(self.feedback)
-                sys.exit('Invalid feedback option')
+                    print(self.feedback)
+                    sys.exit('Invalid feedback option')
 
-            # Determine stop actions
-            if self.feedback == 'teacher' or self.feedback == 'sample':
-                a_t_stop = [ob['viewpoint'] == ob['gt_path'][-1] for ob in obs]
-            else:
-                a_t_stop = a_t == 0 
+                # Determine stop actions
+                if self.feedback == 'teacher' or self.feedback == 'sample':
+                    a_t_stop = [ob['viewpoint'] == ob['gt_path'][-1] for ob in obs]
+                else:
+                    a_t_stop = a_t == 0 
 
-            # Prepare environment action
-            cpu_a_t = []
-            for i in range(batch_size):
                 if self.args.record_rt:
-                    # currid, neighborvids, target_rt, pred_rt
-                    traj[i]['rt_records'].append((rt_records[3][i], list(zip(rt_records[2][i][1:], rt_records[0][i][:len(nav_vpids[i][1:])], rt_records[1][i][:len(nav_vpids[i][1:])]))))
-
-                if a_t_stop[i] or ended[i] or nav_inputs['no_vp_left'][i] or (t == self.args.max_action_len - 1):
-                    cpu_a_t.append(None)
-                    just_ended[i] = True 
+                    for i in range(batch_size):
+                        # currid, neighborvids, target_rt, pred_rt
+                        traj[i]['rt_records'].append((rt_records[3][i], list(zip(rt_records[2][i][1:], rt_records[0][i][:len(nav_vpids[i][1:])], rt_records[1][i][:len(nav_vpids[i][1:])]))))
+
+                # Prepare environment action, make action and got the new state
+                if env_step is None:
+                    cpu_a_t = self._cpu_actions(a_t, a_t_stop, ended, just_ended, nav_inputs, nav_vpids, t)
+                    new_obs = self._env_step(cpu_a_t, gmaps, obs, traj)
                 else:
-                    cpu_a_t.append(nav_vpids[i][a_t[i]])
-            
-            # Make action and got the new state
-            self.make_equiv_action(cpu_a_t, gmaps, obs, traj)
-            for i in range(batch_size):
-                if (not ended[i]) and just_ended[i] :
-                    stop_node, stop_score = None, {'stop': -float('inf'), 'og': None}
-                    for k, v in gmaps[i].node_stop_scores.items():
-                        if v['stop'] > stop_score['stop']:
-                            stop_score = v 
-                            stop_node = k 
-                    
-                    if stop_node is not None and obs[i]['viewpoint'] != stop_node:
-                        traj[i]['path'].append(gmaps[i].graph.path(obs[i]['viewpoint'], stop_node))
-                    traj[i]['pred_objid'] = stop_score['og']
-
-                    if self.args.detailed_output:
-                        for k,v in gmaps[i].node_stop_scores.items():
-                            traj[i]['details'][k] = {
-                                'stop_prob': float(v['stop']),
-                                'obj_ids': [str(x) for x in v['og_details']['objids']],
-                                'obj_logits': v['og_details']['logits'].tolist()
-                            }
+                    new_obs = env_step.result()
+                for i in range(batch_size):
+                    if (not ended[i]) and just_ended[i] :
+                        self._finish_traj(gmaps[i], obs[i], traj[i])
             
-            # new observation and update graph
-            obs = self.env._get_obs()
-            self._update_scanvp_cands(obs)
-            for i, ob in enumerate(obs):
-                if not ended[i]:
-                    gmaps[i].update_graph(ob)
+                # new observation and update graph
+                obs = new_obs
+                self._update_scanvp_cands(obs)
+                if self.args.batched_gmap:
+                    gmaps.update_graph(obs, ~ended)
+                else:
+                    for i, ob in enumerate(obs):
+                        if not ended[i]:
+                            gmaps[i].update_graph(ob)
             
-            ended[:] = np.logical_or(ended, np.array([x is None for x in cpu_a_t]))
-
-            # Early exit if all ended
-            if ended.all():
-                break
-
+                ended[:] = np.logical_or(ended, np.array([x is None for x in cpu_a_t]))
+
+                # Early exit if all ended
+                if ended.all():
+                    break
+        finally:
+            # also when a step raises, the worker may still be running the last env step
+            if env_worker is not None:
+                env_worker.shutdown(wait=True)
       
         if train_ml is not None:
             ml_loss = ml_loss * train_ml / batch_size
@@ -699,6 +895,7 @@ class ReverieMapAgent(Seq2SeqAgent):
             self.logs['IL_loss'].append(ml_loss.item()) 
             self.logs['OG_loss'].append(og_loss.item())
 
+
         # 转换格式才能在online test上运行？
         # if self.args.submit:
         #     for i, item in enumerate(traj):
@@ -710,6 +907,159 @@ class ReverieMapAgent(Seq2SeqAgent):
             
         return traj 
 
+    @torch.no_grad()
+    def rollout_continuous(self):
+        '''Evaluation with continuous batching, over every instruction of the env once: the
+        slot of an ended episode gets the next instruction at the next step, so the batch stays
+        full until the data runs out. Each episode takes the steps of rollout with argmax
+        feedback. Returns the trajectories in the order of the env data. '''
+        assert not self.args.record_rt, 'record_rt is not supported by the continuous evaluation'
+        data_idxs, obs = self.env.reset_continuous()
+        self._update_scanvp_cands(obs)
+        batch_size = len(obs)
+        results = [None] * self.env.size()
+
+        if self.args.batched_gmap:
+            gmaps = BatchedGraphMap([ob['viewpoint'] for ob in obs], use_room_type=self.args.use_room_type)
+        else:
+            embed_buffer = NodeEmbedBuffer(batch_size)
+            gmap_class = GraphRoomMap if self.args.use_room_type else GraphMap
+            gmaps = [gmap_class(ob['viewpoint'], embed_buffer, i) for i, ob in enumerate(obs)]
+        # every slot gets a graph, the fresh ones are reset below
+        if self.args.batched_gmap:
+            gmaps.update_graph(obs)
+        else:
+            for i, ob in enumerate(obs):
+                gmaps[i].update_graph(ob)
+
+        # ended: no episode left for the slot; fresh: a new episode starts in the slot
+        ended = data_idxs < 0
+        fresh = ~ended
+        steps = np.zeros(batch_size, dtype=np.int64)
+        traj = [None] * batch_size
+        txt_embeds, txt_masks, txt_ctx = None, None, None
+        # episodes fed to the model, the rows of txt_ctx
+        act_idxs = np.arange(batch_size)
+        nav_inputs = {'gmap_img_embeds': None,
+                      'gmap_step_ids': None, 'gmap_pos_fts': None}
+
+        while not ended.all():
+            # slots only get empty (ended) or refilled (fresh), the active episodes are a subset
+            new_act_idxs = np.nonzero(~ended)[0]
+            keep = torch.from_numpy(np.searchsorted(act_idxs, new_act_idxs)).to(self.device)
+            act_idxs = new_act_idxs
+            new_bs = np.nonzero(fresh)[0]
+            if len(new_bs) > 0:
+                language_inputs = self._language_variable([obs[i] for i in new_bs])
+                txt_embeds, txt_masks = self._txt_slots(
+                    txt_embeds, txt_masks, new_bs, self.vln_bert('language', language_inputs),
+                    language_inputs['txt_masks'], batch_size
+                )
+                rows = torch.from_numpy(act_idxs).to(self.device)
+                txt_ctx = TextContext(txt_embeds[rows], txt_masks[rows])
+
+                if self.args.batched_gmap:
+                    gmaps.reset(new_bs, [obs[i]['viewpoint'] for i in new_bs])
+                    gmaps.update_graph(obs, fresh)
+                else:
+                    embed_buffer.reset(new_bs)
+                    for i in new_bs:
+                        gmaps[i] = gmap_class(obs[i]['viewpoint'], embed_buffer, i)
+                        gmaps[i].update_graph(obs[i])
+                for i in new_bs:
+                    traj[i] = {
+                        'instr_id': obs[i]['instr_id'],
+                        'path': [[obs[i]['viewpoint']]],
+                        'rt_records': [],
+                        'pred_objid': None,
+                        'details': {},
+                    }
+                steps[new_bs] = 0
+            elif len(keep) < txt_ctx.txt_embeds.size(0):
+                txt_ctx = txt_ctx.select(keep)
+            compact = len(act_idxs) < batch_size
+
+            if self.args.batched_gmap:
+                gmaps.update_step_ids(~ended, steps + 1)
+            else:
+                for i in act_idxs:
+                    gmaps[i].node_step_ids[obs[i]['viewpoint']] = steps[i] + 1
+
+            pano_inputs = self._panorama_feature_variable(obs)
+            pano_inputs.update({'gmap_img_embeds': nav_inputs['gmap_img_embeds'],
+                                'gmap_step_ids': nav_inputs['gmap_step_ids'],
+                                'gmap_pos_fts': nav_inputs['gmap_pos_fts']})
+            # the first step of an episode has no history, as in rollout
+            pano_outs = None
+            has_history = steps[act_idxs] > 0
+            for with_history in [True, False]:
+                group = has_history if with_history else ~has_history
+                if not group.any():
+                    continue
+                if with_history:
+                    group_inputs = pano_inputs
+                else:
+                    group_inputs = dict(pano_inputs, gmap_img_embeds=None, gmap_step_ids=None, gmap_pos_fts=None)
+                if group.all():
+                    group_ctx = txt_ctx
+                else:
+                    group_ctx = txt_ctx.select(torch.from_numpy(np.nonzero(group)[0]).to(self.device))
+                outs = self._panorama_forward(
+                    group_inputs, group_ctx, act_idxs[group] if compact or not group.all() else None
+                )
+                pano_outs = outs if pano_outs is None else [x + y for x, y in zip(pano_outs, outs)]
+            pano_embeds, rec_pano_embeds, avg_pano_embeds = pano_outs
+            self._update_node_embeds(gmaps, obs, ended, pano_inputs, pano_embeds, avg_pano_embeds)
+
+            nav_inputs = self._nav_variable(obs, gmaps, pano_inputs, pano_embeds, rec_pano_embeds)
+            nav_outs = self._navigation_forward(nav_inputs, txt_ctx, act_idxs if compact else None)
+            nav_logits, nav_vpids = self._nav_logits(nav_outs, nav_inputs)
+            nav_probs = torch.softmax(nav_logits, 1)
+            self._update_stop_scores(gmaps, obs, ended, nav_probs, nav_outs['obj_logits'], pano_inputs['view_lens'])
+
+            a_t = nav_logits.max(1)[1].cpu().numpy()
+            cpu_a_t = []
+            for i in range(batch_size):
+                if ended[i] or a_t[i] == 0 or nav_inputs['no_vp_left'][i] or steps[i] == self.args.max_action_len - 1:
+                    cpu_a_t.append(None)
+                else:
+                    cpu_a_t.append(nav_vpids[i][a_t[i]])
+            self.make_equiv_action(cpu_a_t, gmaps, obs, traj)
+            done = np.array([i for i in act_idxs if cpu_a_t[i] is None], dtype=np.int64)
+            for i in done:
+                self._finish_traj(gmaps[i], obs[i], traj[i])
+                results[data_idxs[i]] = traj[i]
+            steps += 1
+
+            # the next instructions go to the slots of the ended episodes
+            fresh[:] = False
+            if len(done) > 0:
+                data_idxs[done] = self.env.reset_slots(done)
+                fresh[done] = data_idxs[done] >= 0
+                ended[done] = data_idxs[done] < 0
+            obs = self.env._get_obs()
+            self._update_scanvp_cands(obs)
+            if self.args.batched_gmap:
+                gmaps.update_graph(obs, ~ended & ~fresh)
+            else:
+                for i in np.nonzero(~ended & ~fresh)[0]:
+                    gmaps[i].update_graph(obs[i])
+
+        return [x for x in results if x is not None]
+
+    def _txt_slots(self, txt_embeds, txt_masks, bs, new_embeds, new_masks, batch_size):
+        '''txt_embeds / txt_masks of all the slots with the rows bs replaced, padded to the longest '''
+        max_len = new_embeds.size(1) if txt_embeds is None else max(txt_embeds.size(1), new_embeds.size(1))
+        embeds = new_embeds.new_zeros(batch_size, max_len, new_embeds.size(2))
+        masks = new_masks.new_zeros(batch_size, max_len)
+        if txt_embeds is not None:
+            embeds[:, :txt_embeds.size(1)] = txt_embeds
+            masks[:, :txt_masks.size(1)] = txt_masks
+        idxs = torch.from_numpy(bs).to(embeds.device)
+        embeds[idxs] = F.pad(new_embeds, (0, 0, 0, max_len - new_embeds.size(1)))
+        masks[idxs] = F.pad(new_masks, (0, max_len - new_masks.size(1)))
+        return embeds, masks
+
     def get_results(self, detailed_output=False):
         output = []
         for k, v in self.results.items():
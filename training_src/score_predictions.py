@@ -0,0 +1,129 @@
+''' Score submit_*.json prediction files offline, without the env, simulator or torch.
+
+The ground truth index (gt trajectories, goal viewpoints of the gt objects and
+the compact shortest paths of their scans) is built once from the annotation
+files, BBoxes.json and the connectivity graphs, and cached in --cache_dir; a
+cached run only needs numpy.
+
+    python score_predictions.py --splits val_seen val_unseen \
+        --cache_dir ../datasets/REVERIE/score_cache ../out/*/preds/submit_val_*.json
+'''
+import argparse
+import glob
+import json
+import os
+
+from env_bases.reverie.nav_metrics import score_predictions, average_metrics, metric_breakdowns
+from warmup_src.data.shortest_paths import ShortestPaths, load_shortest_paths, shortest_paths_file
+
+# annotation files of a split, the first existing one is used (only the paths are read)
+ANNO_FILES = ['REVERIE_%s.json', 'REVERIE_%s_enc.json', 'REVERIE_%s_enc_xlmr.json', 'REVERIE_%s_clip.json']
+
+
+def load_anno_file(anno_dir, split):
+    for name in ANNO_FILES:
+        anno_file = os.path.join(anno_dir, name % split)
+        if os.path.exists(anno_file):
+            with open(anno_file) as f:
+                return json.load(f)
+    raise FileNotFoundError('no annotation file of %s in %s' % (split, anno_dir))
+
+
+def build_gt_index(anno_dir, splits, bbox_file):
+    ''' {'gt_trajs': {instr_id: (scan, path, objId)}, 'obj2vps': {scan_objid: [vp]}}
+        with the instr_ids of construct_instrs '''
+    gt_trajs = {}
+    for split in splits:
+        for item in load_anno_file(anno_dir, split):
+            if 'objId' not in item:
+                continue
+            for j in range(len(item['instructions'])):
+                instr_id = '%s_%s_%d' % (str(item['path_id']), str(item['objId']), j)
+                gt_trajs[instr_id] = (item['scan'], item['path'], item['objId'])
+    from env_bases.reverie.data_utils import load_obj2vps
+    obj2vps = load_obj2vps(bbox_file)
+    gt_objs = set('%s_%s' % (scan, objid) for scan, _, objid in gt_trajs.values())
+    return {
+        'gt_trajs': gt_trajs,
+        'obj2vps': {k: v for k, v in obj2vps.items() if k in gt_objs},
+    }
+
+
+def load_gt_index(args):
+    index_file = os.path.join(args.cache_dir, 'gt_index_%s.json' % '+'.join(sorted(args.splits)))
+    if os.path.exists(index_file) and not args.rebuild:
+        with open(index_file) as f:
+            gt_index = json.load(f)
+    else:
+        gt_index = build_gt_index(args.anno_dir, args.splits, args.bbox_file)
+        os.makedirs(args.cache_dir, exist_ok=True)
+        tmp_file = '%s.%d' % (index_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(gt_index, f)
+        os.replace(tmp_file, index_file)
+
+    # the shortest paths are cached per scan, the graphs are only read for missing scans
+    scans = sorted(set(x[0] for x in gt_index['gt_trajs'].values()))
+    shortest_paths, missing = {}, []
+    for scan in scans:
+        if os.path.exists(shortest_paths_file(args.cache_dir, scan)) and not args.rebuild:
+            shortest_paths[scan] = ShortestPaths.load(shortest_paths_file(args.cache_dir, scan))
+        else:
+            missing.append(scan)
+    if len(missing) > 0:
+        from utils.data import load_nav_graphs
+        if args.rebuild:
+            for scan in missing:
+                if os.path.exists(shortest_paths_file(args.cache_dir, scan)):
+                    os.remove(shortest_paths_file(args.cache_dir, scan))
+        shortest_paths.update(load_shortest_paths(
+            load_nav_graphs(args.connectivity_dir, missing), cache_dir=args.cache_dir
+        ))
+    return gt_index['gt_trajs'], gt_index['obj2vps'], shortest_paths
+
+
+def score_file(pred_file, gt_trajs, obj2vps, shortest_paths, breakdown=False):
+    with open(pred_file) as f:
+        preds = json.load(f)
+    scored = [item for item in preds if item['instr_id'] in gt_trajs]
+    if len(scored) < len(preds):
+        print('%s: %d / %d predictions without ground truth are skipped' % (
+            pred_file, len(preds) - len(scored), len(preds)))
+    metrics = score_predictions(scored, gt_trajs, shortest_paths, obj2vps)
+    result = {'num': len(scored), 'summary': average_metrics(metrics)}
+    if breakdown:
+        result['breakdown'] = metric_breakdowns(metrics)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='score REVERIE prediction files offline')
+    parser.add_argument('pred_files', nargs='+', help='prediction files or glob patterns')
+    parser.add_argument('--splits', nargs='+', default=['val_seen', 'val_unseen'])
+    parser.add_argument('--anno_dir', default='../datasets/REVERIE/annotations')
+    parser.add_argument('--bbox_file', default='../datasets/REVERIE/annotations/BBoxes.json')
+    parser.add_argument('--connectivity_dir', default='../datasets/R2R/connectivity')
+    parser.add_argument('--cache_dir', required=True, help='gt index and shortest path cache')
+    parser.add_argument('--rebuild', action='store_true', default=False, help='rebuild the cached gt index')
+    parser.add_argument('--breakdown', action='store_true', default=False,
+                        help='also report the metrics per scan and gt path length')
+    parser.add_argument('--output_file', default=None, help='json file of {pred_file: result}')
+    args = parser.parse_args()
+
+    gt_trajs, obj2vps, shortest_paths = load_gt_index(args)
+    pred_files = []
+    for pattern in args.pred_files:
+        pred_files.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    results = {}
+    for pred_file in pred_files:
+        results[pred_file] = score_file(pred_file, gt_trajs, obj2vps, shortest_paths, breakdown=args.breakdown)
+        print(pred_file, ', '.join('%s: %.2f' % (k, v) for k, v in results[pred_file]['summary'].items()))
+
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            json.dump(results, f, sort_keys=True, indent=4, separators=(',', ': '))
+
+
+if __name__ == '__main__':
+    main()
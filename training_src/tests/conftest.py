@@ -0,0 +1,57 @@
+''' The tests run from training_src (python -m pytest -q tests) with
+--sim_backend graph on the small synthetic scan in tests/fixtures/connectivity.
+It is named ZMojNkEp431 and holds the (isolated) viewpoint that
+get_point_angle_feature sweeps, so the envs build their angle features on it. '''
+import argparse
+import os
+import sys
+
+import numpy as np
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+sys.path.insert(0, os.path.dirname(os.path.dirname(TESTS_DIR)))
+
+FIXTURE_DIR = os.path.join(TESTS_DIR, 'fixtures')
+CONNECTIVITY_DIR = os.path.join(FIXTURE_DIR, 'connectivity')
+SCAN = 'ZMojNkEp431'
+
+
+@pytest.fixture
+def connectivity_dir():
+    return CONNECTIVITY_DIR
+
+
+@pytest.fixture
+def make_env(tmp_path):
+    ''' ReverNavBatchEnv on the fixture scan, without features or object annotations:
+        make_env(episodes) with episodes [(path, objId)] '''
+    from env import ReverNavBatchEnv
+    from env_bases.reverie.scene_registry import SceneRegistry
+
+    registry = SceneRegistry(CONNECTIVITY_DIR, sim_backend='graph', shortest_path_dir=str(tmp_path))
+
+    def _make_env(episodes, cand_table=None, **kwargs):
+        args = argparse.Namespace(sim_backend='graph', use_real_dist_norm=False, batch_obs=False)
+        vars(args).update(kwargs)
+        viewpoints = sorted(registry.get_graphs([SCAN])[SCAN].nodes())
+        data = [{
+            'scan': SCAN, 'path': list(path), 'objId': objid, 'heading': 0.,
+            'instr_id': '%d_%s_0' % (i, objid), 'path_id': i,
+            'instruction': '', 'instr_encoding': [],
+        } for i, (path, objid) in enumerate(episodes)]
+        obj2vps = {'%s_%s' % (SCAN, objid): [path[-1]] for path, objid in episodes}
+        vp2room = {'vp2room': {'%s_%s' % (SCAN, vp): {'id': k % 4} for k, vp in enumerate(viewpoints)}}
+        return ReverNavBatchEnv(
+            None, None, None, data, CONNECTIVITY_DIR, obj2vps, vp2room, batch_size=1, args=args,
+            feat_bundle=object(), cand_table=cand_table, scene_registry=registry
+        )
+    return _make_env
+
+
+@pytest.fixture
+def view_features():
+    ''' random (36, 8) view and rec features '''
+    rng = np.random.RandomState(0)
+    return rng.randn(36, 8).astype(np.float32), rng.randn(36, 8).astype(np.float32)
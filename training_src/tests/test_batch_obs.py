@@ -0,0 +1,63 @@
+import argparse
+
+import numpy as np
+import torch
+
+from env import BatchObs
+from rever_agent import ReverieMapAgent, CROP_SIZE
+from conftest import SCAN
+
+IMAGE_FEAT_SIZE = 8
+
+
+def make_obs(env, rng, episodes):
+    ''' obs of ReverNavBatchEnv._get_obs at the starts of episodes, with random features '''
+    obs, features, rec_features = [], [], []
+    for k, (path, _) in enumerate(episodes):
+        view_index = int(rng.randint(36))
+        feature = rng.randn(36, IMAGE_FEAT_SIZE).astype(np.float32)
+        rec_feature = rng.randn(36, IMAGE_FEAT_SIZE).astype(np.float32)
+        num_objs = k % 3    # including items without objects
+        obs.append({
+            'viewpoint': path[0], 'viewIndex': view_index,
+            'candidate': env.make_candidate(feature, rec_feature, SCAN, path[0], view_index, path),
+            'feature': np.concatenate((feature, env.angle_feature[view_index]), -1),
+            'rec_feature': np.concatenate((rec_feature, env.angle_feature[view_index]), -1),
+            'obj_img_fts': rng.randn(num_objs, IMAGE_FEAT_SIZE).astype(np.float32),
+            'obj_ang_fts': rng.randn(num_objs, 4).astype(np.float32),
+            'obj_box_fts': rng.randn(num_objs, 3).astype(np.float32),
+            'obj_ids': [str(x) for x in range(num_objs)],
+            'knowledge_feature': rng.randn(36, 1, 512).astype(np.float32),
+            'crop_feature': rng.randn(36, CROP_SIZE, 512).astype(np.float32),
+        })
+        features.append(feature)
+        rec_features.append(rec_feature)
+    return obs, features, rec_features
+
+
+def make_agent(batch_obs):
+    agent = ReverieMapAgent.__new__(ReverieMapAgent)
+    agent.args = argparse.Namespace(batch_obs=batch_obs, image_feat_size=IMAGE_FEAT_SIZE)
+    agent.device = torch.device('cpu')
+    return agent
+
+
+def test_batch_and_per_item_panorama_inputs_match(make_env):
+    episodes = [
+        (['vp00', 'vp04', 'vp08'], 'obj0'), (['vp06', 'vp07'], 'obj1'),
+        (['vp04', 'vp05'], 'obj2'), (['vp02', 'vp01'], 'obj3'),
+    ]
+    env = make_env(episodes)
+    obs, features, rec_features = make_obs(env, np.random.RandomState(0), episodes)
+
+    ref = make_agent(batch_obs=False)._panorama_feature_variable(obs)
+    out = make_agent(batch_obs=True)._panorama_feature_variable(
+        BatchObs(obs, env._get_batch_fts(obs, features, rec_features))
+    )
+    assert sorted(ref.keys()) == sorted(out.keys())
+    for k, v in ref.items():
+        if isinstance(v, torch.Tensor):
+            assert v.dtype == out[k].dtype and v.shape == out[k].shape, k
+            assert torch.equal(v, out[k]), k
+        else:
+            assert v == out[k], k
@@ -0,0 +1,51 @@
+import networkx as nx
+import numpy as np
+
+from utils.data import load_nav_graphs
+from conftest import CONNECTIVITY_DIR, SCAN
+
+
+def expected_score(vp, gt_path, power=5):
+    ''' step_score_to_goal in steps, from the graph '''
+    G = load_nav_graphs(CONNECTIVITY_DIR, [SCAN])[SCAN]
+    full_len = len(gt_path) - 1
+    to_goal = nx.shortest_path_length(G, vp, gt_path[-1])
+    return max(((full_len - to_goal) / full_len) ** power, 0)
+
+
+def test_buffered_candidates_score_their_own_episode(make_env, view_features):
+    # same start viewpoint, different goals: the second sweep is served from the buffer
+    episodes = [(['vp00', 'vp04', 'vp08'], 'obj0'), (['vp00', 'vp01', 'vp02'], 'obj1')]
+    env = make_env(episodes)
+    features, rec_features = view_features
+    for path, _ in episodes + episodes:
+        candidate = env.make_candidate(features, rec_features, SCAN, path[0], 0, path)
+        assert len(candidate) > 0
+        for c in candidate:
+            np.testing.assert_allclose(c['step_score_to_goal'], expected_score(c['viewpointId'], path))
+
+
+def test_table_and_simulator_candidates_match(make_env, view_features, tmp_path):
+    from env_bases.reverie.candidate_table import build_scan_candidate_table, candidate_table_file, CandidateTable
+
+    episodes = [
+        (['vp00', 'vp04', 'vp08'], 'obj0'), (['vp00', 'vp01', 'vp02'], 'obj1'),
+        (['vp06', 'vp07', 'vp04', 'vp05'], 'obj2'), (['vp08'], 'obj3'),
+    ]
+    sim_env = make_env(episodes)
+    viewpoints = sorted(sim_env.graphs[SCAN].nodes())
+    # a table without room ids, the env fills them in
+    np.savez(candidate_table_file(str(tmp_path), SCAN), **build_scan_candidate_table(sim_env.sim, SCAN, viewpoints))
+    table_env = make_env(episodes, cand_table=CandidateTable(str(tmp_path)))
+
+    features, rec_features = view_features
+    for k, (path, _) in enumerate(episodes + episodes[::-1]):
+        for t, vp in enumerate(path):
+            view_id = (7 * k + 5 * t) % 36
+            sim_cands = sim_env.make_candidate(features, rec_features, SCAN, vp, view_id, path)
+            table_cands = table_env.make_candidate(features, rec_features, SCAN, vp, view_id, path)
+            assert len(sim_cands) == len(table_cands) > 0
+            for c_sim, c_table in zip(sim_cands, table_cands):
+                assert sorted(c_sim.keys()) == sorted(c_table.keys())
+                for key, value in c_sim.items():
+                    np.testing.assert_array_equal(np.asarray(c_table[key]), np.asarray(value), err_msg=key)
@@ -0,0 +1,44 @@
+import json
+import math
+import os
+
+import pytest
+
+from env_bases.reverie.graph_sim import new_graph_simulator, _lround
+from validate_graph_sim import check_walks
+from conftest import CONNECTIVITY_DIR, FIXTURE_DIR, SCAN
+
+INC = math.radians(30)
+
+
+@pytest.mark.parametrize('x, rounded', [
+    (0.5, 1), (-0.5, -1), (1.5, 2), (-1.5, -2), (2.5, 3), (0.49999999999999994, 0), (-0.3, 0), (-0.7, -1),
+])
+def test_lround_rounds_half_away_from_zero(x, rounded):
+    assert _lround(x) == rounded
+
+
+@pytest.mark.parametrize('heading, elevation, view_index, snapped_heading, snapped_elevation', [
+    (0., 0., 12, 0., 0.),
+    (-0.3, 0., 23, -INC, 0.),               # signed: not wrapped to 330 degrees
+    (-INC / 2, 0., 23, -INC, 0.),           # halfway, away from zero
+    (INC / 2, -INC / 2, 1, INC, -INC),
+    (6.5, 0.2, 12, 0., 0.),                 # a full turn wraps to 0
+    (7.0, 0.9, 25, 13 * INC, INC),          # beyond a full turn it does not
+    (-3.5, -0.9, 5, -7 * INC, -INC),
+])
+def test_new_episode_snaps_like_mattersim(heading, elevation, view_index, snapped_heading, snapped_elevation):
+    sim = new_graph_simulator(CONNECTIVITY_DIR)
+    sim.newEpisode([SCAN], ['vp04'], [heading], [elevation])
+    state = sim.getState()[0]
+    assert state.viewIndex == view_index
+    assert state.heading == pytest.approx(snapped_heading)
+    assert state.elevation == pytest.approx(snapped_elevation)
+
+
+def test_recorded_walks():
+    ''' tests/fixtures/sim_states.json: walks in validate_graph_sim.py --record format,
+        starting from halfway, negative and over a full turn headings '''
+    with open(os.path.join(FIXTURE_DIR, 'sim_states.json')) as f:
+        episodes = json.load(f)
+    assert check_walks(new_graph_simulator(CONNECTIVITY_DIR), episodes, atol=1e-6)
@@ -0,0 +1,162 @@
+import numpy as np
+import pytest
+import torch
+
+from models.graph_utils import GraphMap, BatchedGraphMap, NodeEmbedBuffer
+
+HIDDEN = 6
+
+
+class RandomEpisodes(object):
+    ''' random walks on random graphs, one new episode whenever a slot ends '''
+    def __init__(self, seed, num_vps=30):
+        self.rng = np.random.RandomState(seed)
+        self.num_vps = num_vps
+
+    def new_episode(self):
+        rng = self.rng
+        positions = {'v%d' % i: tuple(rng.uniform(0, 10, 3)) for i in range(self.num_vps)}
+        vps = sorted(positions)
+        # undirected, every viewpoint has a neighbour as in the connectivity graphs
+        nbrs = {vp: set() for vp in vps}
+        for i, vp in enumerate(vps):
+            for x in rng.choice(vps[:i] + vps[i + 1:], rng.randint(1, 4), replace=False):
+                nbrs[vp].add(x)
+                nbrs[x].add(vp)
+        nbrs = {vp: sorted(x) for vp, x in nbrs.items()}
+        for vp in vps:
+            rng.shuffle(nbrs[vp])
+        return {'positions': positions, 'nbrs': nbrs, 'cur': vps[rng.randint(len(vps))], 'len': rng.randint(2, 9)}
+
+    def ob(self, episode):
+        rng = self.rng
+        cur = episode['cur']
+        return {
+            'viewpoint': cur, 'position': episode['positions'][cur],
+            'heading': rng.uniform(0, 2 * np.pi), 'elevation': rng.uniform(-0.5, 0.5),
+            'candidate': [
+                {'viewpointId': vp, 'position': episode['positions'][vp]} for vp in episode['nbrs'][cur]
+            ],
+        }
+
+    def move(self, episode, ob):
+        episode['cur'] = ob['candidate'][self.rng.randint(len(ob['candidate']))]['viewpointId']
+        episode['len'] -= 1
+
+
+def reference_vp_pos_fts(gmap, ob, num_vps):
+    ''' ReverieMapAgent._vp_pos_fts of one episode '''
+    cand_vpids = [c['viewpointId'] for c in ob['candidate']]
+    vp_pos_fts = np.zeros((num_vps, 14), dtype=np.float32)
+    vp_pos_fts[:, :7] = gmap.get_pos_fts(ob['viewpoint'], [gmap.start_vp], ob['heading'], ob['elevation'])
+    vp_pos_fts[1: len(cand_vpids) + 1, 7:] = gmap.get_pos_fts(
+        ob['viewpoint'], cand_vpids, ob['heading'], ob['elevation']
+    )
+    return vp_pos_fts
+
+
+def check_same_maps(gmaps, bgmap, obs, active):
+    headings = np.array([ob['heading'] for ob in obs])
+    elevations = np.array([ob['elevation'] for ob in obs])
+    for b, gmap in enumerate(gmaps):
+        assert bgmap.vpids[b] == list(gmap.node_positions)
+        assert bgmap.start_vps[b] == gmap.start_vp
+
+    # positions features of all nodes, from the current node
+    node_idxs, lens = bgmap.get_gmap_nodes(enc_full_graph=True)
+    pos_fts = bgmap.get_pos_fts(node_idxs, headings, elevations)
+    for b, (gmap, vpids) in enumerate(zip(gmaps, bgmap.get_vpids(node_idxs, lens))):
+        np.testing.assert_allclose(
+            pos_fts[b, :lens[b]],
+            gmap.get_pos_fts(obs[b]['viewpoint'], vpids, headings[b], elevations[b]), rtol=1e-6, atol=1e-6
+        )
+
+    num_vps = max(len(ob['candidate']) for ob in obs) + 4
+    vp_pos_fts = bgmap.get_vp_pos_fts(num_vps, headings, elevations)
+    for b, gmap in enumerate(gmaps):
+        np.testing.assert_allclose(
+            vp_pos_fts[b], reference_vp_pos_fts(gmap, obs[b], num_vps), rtol=1e-6, atol=1e-6
+        )
+
+    # paths, distances and embeddings
+    for b, gmap in enumerate(gmaps):
+        view = bgmap[b]
+        vpids = list(gmap.node_positions)
+        for x in vpids:
+            assert view.graph.visited(x) == gmap.graph.visited(x)
+            for y in vpids:
+                assert view.graph.path(x, y) == gmap.graph.path(x, y)
+                assert view.graph.distance(x, y) == gmap.graph.distance(x, y)
+        if active[b]:
+            slots = np.array([[bgmap.vp2idx[b][vp] for vp in vpids]])
+            embeds = bgmap.node_embeds.get_slots(np.array([[b]]), slots)[0]
+            for k, vp in enumerate(vpids):
+                if vp in gmap.embed_buffer.slots[b]:
+                    torch.testing.assert_close(embeds[k], gmap.get_node_embed(vp))
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_graph_map_and_batched_graph_map_match(seed):
+    batch_size, num_steps = 5, 40
+    episodes = RandomEpisodes(seed)
+    slots = [episodes.new_episode() for _ in range(batch_size)]
+    obs = [episodes.ob(ep) for ep in slots]
+
+    embed_buffer = NodeEmbedBuffer(batch_size)
+    gmaps = [GraphMap(ob['viewpoint'], embed_buffer, b) for b, ob in enumerate(obs)]
+    bgmap = BatchedGraphMap([ob['viewpoint'] for ob in obs])
+    for gmap, ob in zip(gmaps, obs):
+        gmap.update_graph(ob)
+    bgmap.update_graph(obs)
+
+    num_resets = 0
+    for t in range(num_steps):
+        active = np.ones(batch_size, dtype=bool)
+        for b, gmap in enumerate(gmaps):
+            gmap.node_step_ids[obs[b]['viewpoint']] = t + 1
+        bgmap.update_step_ids(active, t + 1)
+
+        # the current node gets the average view embedding, the unvisited candidates the views
+        num_views = max(len(ob['candidate']) for ob in obs) + 1
+        cur_embeds = torch.randn(batch_size, HIDDEN, dtype=torch.float64)
+        cand_embeds = torch.randn(batch_size, num_views, HIDDEN, dtype=torch.float64)
+        for b, gmap in enumerate(gmaps):
+            gmap.update_node_embed(obs[b]['viewpoint'], cur_embeds[b], rewrite=True)
+            for j, c in enumerate(obs[b]['candidate']):
+                if not gmap.graph.visited(c['viewpointId']):
+                    gmap.update_node_embed(c['viewpointId'], cand_embeds[b, j])
+        bgmap.update_node_embeds(active, cur_embeds, cand_embeds)
+        check_same_maps(gmaps, bgmap, obs, active)
+
+        # ended episodes are replaced in their slots, the others move on
+        new_bs = []
+        for b, ep in enumerate(slots):
+            episodes.move(ep, obs[b])
+            if ep['len'] == 0:
+                slots[b] = episodes.new_episode()
+                new_bs.append(b)
+            obs[b] = episodes.ob(slots[b])
+        if len(new_bs) > 0:
+            num_resets += len(new_bs)
+            embed_buffer.reset(new_bs)
+            for b in new_bs:
+                gmaps[b] = GraphMap(obs[b]['viewpoint'], embed_buffer, b)
+            bgmap.reset(new_bs, [obs[b]['viewpoint'] for b in new_bs])
+        for gmap, ob in zip(gmaps, obs):
+            gmap.update_graph(ob)
+        bgmap.update_graph(obs)
+        check_same_maps(gmaps, bgmap, obs, np.zeros(batch_size, dtype=bool))
+    assert num_resets > batch_size
+
+
+def test_node_embed_buffer_get_survives_later_updates():
+    ''' get() must not return views of the buffers, the next update writes them in place '''
+    buffer = NodeEmbedBuffer(2, max_nodes=4)
+    embeds = torch.randn(2, HIDDEN, requires_grad=True)
+    buffer.update([0, 1], ['a', 'b'], embeds)
+    node_embed = buffer.get(0, 'a')
+    buffer.update([0, 1], ['a', 'c'], embeds * 2)
+    buffer.update([1], ['b'], embeds[:1], rewrite=True)
+    node_embed.sum().backward()
+    torch.testing.assert_close(embeds.grad, torch.tensor([[1.] * HIDDEN, [0.] * HIDDEN]))
+    torch.testing.assert_close(buffer.get(0, 'a'), embeds[0] * 1.5)
@@ -0,0 +1,59 @@
+import networkx as nx
+import numpy as np
+
+from env_bases.reverie.nav_metrics import score_predictions, average_metrics
+from utils.data import load_nav_graphs
+from warmup_src.data.shortest_paths import ShortestPaths
+from conftest import CONNECTIVITY_DIR, SCAN
+
+
+def per_item_metrics(preds, gt_trajs, distances, obj2vps):
+    ''' the per prediction loop of the original ReverNavBatchEnv._eval_item, on float64 distances '''
+    metrics = {k: [] for k in ['trajectory_lengths', 'success', 'oracle_success', 'spl', 'rgs', 'rgspl']}
+    for item in preds:
+        scan, gt_path, gt_objid = gt_trajs[item['instr_id']]
+        path = sum(item['trajectory'], [])
+        traj_length = np.sum([distances[a][b] for a, b in zip(path[:-1], path[1:])])
+        gt_length = np.sum([distances[a][b] for a, b in zip(gt_path[:-1], gt_path[1:])])
+        goal_vps = set(obj2vps['%s_%s' % (scan, str(gt_objid))])
+        success = float(path[-1] in goal_vps)
+        rgs = float(str(item.get('predObjId', None)) == str(gt_objid))
+        metrics['trajectory_lengths'].append(traj_length)
+        metrics['success'].append(success)
+        metrics['oracle_success'].append(float(any(x in goal_vps for x in path)))
+        metrics['spl'].append(success * gt_length / max(traj_length, gt_length, 0.01))
+        metrics['rgs'].append(rgs)
+        metrics['rgspl'].append(rgs * gt_length / max(traj_length, gt_length, 0.01))
+    return {k: np.array(v) for k, v in metrics.items()}
+
+
+def test_scores_match_the_per_item_computation():
+    G = load_nav_graphs(CONNECTIVITY_DIR, [SCAN])[SCAN]
+    distances = dict(nx.all_pairs_dijkstra_path_length(G))
+    paths = dict(nx.all_pairs_dijkstra_path(G))
+    vps = sorted(G.nodes())
+    rng = np.random.RandomState(0)
+
+    preds, gt_trajs, obj2vps = [], {}, {}
+    for i in range(300):
+        start, goal = rng.choice(vps, 2, replace=False)
+        objid = str(i % 7)
+        obj2vps['%s_%s' % (SCAN, objid)] = list(rng.choice(vps, rng.randint(1, 3), replace=False))
+        gt_trajs['%d_%s_0' % (i, objid)] = (SCAN, paths[start][goal], objid)
+        # random walk on the graph, each step a list of one or more viewpoints
+        path = [start]
+        for _ in range(rng.randint(0, 8)):
+            path.append(rng.choice(sorted(G[path[-1]])))
+        traj = [[start]] + [path[k: k + 2] if rng.rand() < 0.3 else [path[k]] for k in range(1, len(path))]
+        preds.append({
+            'instr_id': '%d_%s_0' % (i, objid), 'trajectory': traj,
+            'predObjId': objid if rng.rand() < 0.5 else 'other',
+        })
+
+    metrics = score_predictions(preds, gt_trajs, {SCAN: ShortestPaths.from_graph(G)}, obj2vps)
+    ref = per_item_metrics(preds, gt_trajs, distances, obj2vps)
+    for k in ['success', 'oracle_success', 'rgs']:
+        np.testing.assert_array_equal(metrics[k], ref[k], err_msg=k)
+    for k in ['trajectory_lengths', 'spl', 'rgspl']:
+        np.testing.assert_allclose(metrics[k], ref[k], rtol=1e-6, atol=1e-6, err_msg=k)
+    assert 0 < average_metrics(metrics)['sr'] < 100
@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+
+from utils.data import load_nav_graphs
+from warmup_src.data.shortest_paths import ShortestPaths, load_shortest_paths, shortest_paths_file
+from conftest import CONNECTIVITY_DIR, SCAN
+
+
+def test_stale_cache_file_is_rebuilt(tmp_path):
+    G = load_nav_graphs(CONNECTIVITY_DIR, [SCAN])[SCAN]
+    # a cache file written for another version of the graph (one edge shorter)
+    stale_G = G.copy()
+    a, b = next(iter(stale_G.edges()))
+    stale_G[a][b]['weight'] *= 0.5
+    ShortestPaths.from_graph(stale_G).save(shortest_paths_file(str(tmp_path), SCAN))
+
+    sp = load_shortest_paths({SCAN: G}, cache_dir=str(tmp_path))[SCAN]
+    assert sp.matches_graph(G)
+    np.testing.assert_array_equal(sp.distances, ShortestPaths.from_graph(G).distances)
+    # the file is overwritten with the valid one
+    assert ShortestPaths.load(shortest_paths_file(str(tmp_path), SCAN)).matches_graph(G)
+    assert sorted(os.listdir(str(tmp_path))) == [os.path.basename(shortest_paths_file(str(tmp_path), SCAN))]
+
+
+def test_valid_cache_file_is_loaded(tmp_path):
+    G = load_nav_graphs(CONNECTIVITY_DIR, [SCAN])[SCAN]
+    sp = ShortestPaths.from_graph(G)
+    sp.save(shortest_paths_file(str(tmp_path), SCAN))
+    mtime = os.path.getmtime(shortest_paths_file(str(tmp_path), SCAN))
+
+    loaded = load_shortest_paths({SCAN: G}, cache_dir=str(tmp_path))[SCAN]
+    np.testing.assert_array_equal(loaded.predecessors, sp.predecessors)
+    assert os.path.getmtime(shortest_paths_file(str(tmp_path), SCAN)) == mtime
@@ -12,18 +12,100 @@ class ImageFeaturesDB(object):
         self.image_feat_size = image_feat_size
         self.img_ft_file = img_ft_file
         self._feature_store = {}
+        self._file = None
+        self._file_pid = None
+
+    def _get_file(self):
+        # keep one open handle per process (h5py handles must not be shared across forks)
+        pid = os.getpid()
+        if self._file is None or self._file_pid != pid:
+            self._file = h5py.File(self.img_ft_file, 'r')
+            self._file_pid = pid
+        return self._file
+
+    def close(self):
+        if self._file is not None and self._file_pid == os.getpid():
+            self._file.close()
+        self._file = None
+        self._file_pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_file_pid'] = None
+        return state
 
     def get_image_feature(self, scan, viewpoint):
         key = '%s_%s' % (scan, viewpoint)
         if key in self._feature_store:
             ft = self._feature_store[key]
         else:
-            with h5py.File(self.img_ft_file, 'r') as f:
-                ft = f[key][...][:, :self.image_feat_size].astype(np.float32)
-                self._feature_store[key] = ft
+            ft = self._get_file()[key][:, :self.image_feat_size].astype(np.float32)
+            self._feature_store[key] = ft
         return ft
 
 
+class MmapImageFeaturesDB(object):
+    ''' Image features packed by pack_features.py into one contiguous
+        [num_vps, 36, D] array (float32 or float16) plus a key -> row index.
+        Lookups return a view into the memory map, nothing is copied or cached.
+    '''
+    def __init__(self, packed_ft_file, image_feat_size):
+        self.image_feat_size = image_feat_size
+        self.packed_ft_file = packed_ft_file
+        self._data = np.load(packed_ft_file, mmap_mode='r')
+        with open(packed_index_file(packed_ft_file)) as f:
+            keys = json.load(f)
+        self._key2row = {key: row for row, key in enumerate(keys)}
+        if self._data.shape[-1] < image_feat_size:
+            raise ValueError('%s stores %d dims, %d requested' % (
+                packed_ft_file, self._data.shape[-1], image_feat_size))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._data = np.load(self.packed_ft_file, mmap_mode='r')
+
+    def get_image_feature(self, scan, viewpoint):
+        row = self._key2row['%s_%s' % (scan, viewpoint)]
+        if self._data.shape[-1] == self.image_feat_size:
+            return self._data[row]
+        return self._data[row, :, :self.image_feat_size]
+
+
+def packed_index_file(packed_ft_file):
+    return os.path.splitext(packed_ft_file)[0] + '_keys.json'
+
+
+def pack_image_features(img_ft_file, packed_ft_file, image_feat_size=None, dtype=np.float32):
+    ''' Convert an hdf5 image feature file ({scan_vp: (36, D)}) into the
+        layout read by MmapImageFeaturesDB. '''
+    with h5py.File(img_ft_file, 'r') as f:
+        keys = sorted(f.keys())
+        num_views, ft_dim = f[keys[0]].shape[:2]
+        if image_feat_size is not None:
+            ft_dim = min(ft_dim, image_feat_size)
+        data = np.lib.format.open_memmap(
+            packed_ft_file, mode='w+', dtype=dtype, shape=(len(keys), num_views, ft_dim)
+        )
+        for row, key in enumerate(keys):
+            data[row] = f[key][:, :ft_dim]
+        data.flush()
+    with open(packed_index_file(packed_ft_file), 'w') as f:
+        json.dump(keys, f)
+    return len(keys)
+
+
+def get_image_features_db(img_ft_file, image_feat_size, backend='hdf5'):
+    if backend == 'mmap':
+        return MmapImageFeaturesDB(img_ft_file, image_feat_size)
+    return ImageFeaturesDB(img_ft_file, image_feat_size)
+
+
 class Ins2ImageFeaturesDB(object):
     def __init__(self, ins2img_ft_file, image_feat_size):
         self.image_feat_size = image_feat_size
@@ -96,6 +178,12 @@ def angle_feature(heading, elevation, angle_feat_size):
         [math.sin(heading), math.cos(heading), math.sin(elevation), math.cos(elevation)] * (angle_feat_size // 4),
         dtype=np.float32)
 
+def batch_angle_feature(headings, elevations, angle_feat_size):
+    ''' angle_feature over arrays of headings and elevations: [...] -> [..., angle_feat_size] '''
+    headings, elevations = np.asarray(headings), np.asarray(elevations)
+    ft = np.stack([np.sin(headings), np.cos(headings), np.sin(elevations), np.cos(elevations)], -1)
+    return np.tile(ft, angle_feat_size // 4).astype(np.float32)
+
 def get_point_angle_feature(sim, angle_feat_size, baseViewId=0):
     feature = np.empty((36, angle_feat_size), np.float32)
     base_heading = (baseViewId % 12) * math.radians(30)
@@ -130,3 +218,11 @@ def get_point_angle_feature(sim, angle_feat_size, baseViewId=0):
 def get_all_point_angle_feature(sim, angle_feat_size):
     return [get_point_angle_feature(sim, angle_feat_size, baseViewId) for baseViewId in range(36)]
 
+
+def get_view_perm_idxs(used_cand_ids):
+    ''' (B, 36) view ids in the order the panorama fusion walks them: the used
+        candidate views in the iteration order of each set, then the others '''
+    view_perm_idxs = np.zeros((len(used_cand_ids), 36), dtype=np.int64)
+    for i, used_viewidxs in enumerate(used_cand_ids):
+        view_perm_idxs[i] = list(used_viewidxs) + [k for k in range(36) if k not in used_viewidxs]
+    return view_perm_idxs
@@ -162,3 +162,11 @@ def merge_dist_results(results):
     for res in results:
         outs.extend(res)
     return outs
+
+
+def merge_shard_results(results):
+    ''' results: [(minibatch index, pred)] of each worker of a sharded full round
+        (BaseAgent.test with shard). Returns the preds in the order of the same round in
+        a single process '''
+    outs = sorted((x for res in results for x in res), key=lambda x: x[0])
+    return [pred for _, pred in outs]
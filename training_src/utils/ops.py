@@ -19,6 +19,21 @@ def pad_tensors(tensors, lens=None, pad=0):
         output.data[i, :l, ...] = t.data
     return output
 
+def select_batch(x, idxs):
+    """items idxs (np.ndarray) of a batch: tensor, np.ndarray or list"""
+    if isinstance(x, torch.Tensor):
+        return x[torch.from_numpy(idxs).to(x.device)]
+    if isinstance(x, np.ndarray):
+        return x[idxs]
+    return [x[i] for i in idxs]
+
+def scatter_batch(x, idxs, batch_size, size=None):
+    """zeros of batch_size x size (default x.size()[1:]) with the items idxs set to x"""
+    size = list(x.size()[1:]) if size is None else list(size)
+    output = x.new_zeros([batch_size] + size)
+    output[(torch.from_numpy(idxs).to(x.device), ) + tuple(slice(0, s) for s in x.size()[1:])] = x
+    return output
+
 def gen_seq_masks(seq_lens, max_len=None):
     if max_len is None:
         max_len = max(seq_lens)
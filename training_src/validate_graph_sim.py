@@ -0,0 +1,129 @@
+''' Check --sim_backend graph against MatterSim.
+
+    Record random walks with MatterSim (needs MatterSim):
+    python validate_graph_sim.py --record ../datasets/R2R/sim_states.json --num_walks 20
+    Replay them on GraphSimulator and compare every state (no MatterSim needed):
+    python validate_graph_sim.py --check ../datasets/R2R/sim_states.json
+'''
+import argparse
+import json
+import math
+import os
+import random
+
+from utils.data import new_simulator
+from env_bases.reverie.graph_sim import new_graph_simulator
+
+
+def dump_state(state):
+    return {
+        'scanId': state.scanId,
+        'viewpointId': state.location.viewpointId,
+        'viewIndex': state.viewIndex,
+        'heading': state.heading,
+        'elevation': state.elevation,
+        'navigableLocations': [
+            [loc.viewpointId, loc.rel_heading, loc.rel_elevation, loc.rel_distance]
+            for loc in state.navigableLocations
+        ],
+    }
+
+
+def record_walks(sim, scans, connectivity_dir, num_walks, walk_len):
+    episodes = []
+    for scan in scans:
+        with open(os.path.join(connectivity_dir, '%s_connectivity.json' % scan)) as f:
+            viewpoints = [x['image_id'] for x in json.load(f) if x['included']]
+        for _ in range(num_walks):
+            episode = {
+                'scan': scan, 'viewpoint': random.choice(viewpoints),
+                'heading': random.uniform(0, 2 * math.pi), 'elevation': random.uniform(-0.6, 0.6),
+                'actions': [], 'states': [],
+            }
+            sim.newEpisode([scan], [episode['viewpoint']], [episode['heading']], [episode['elevation']])
+            episode['states'].append(dump_state(sim.getState()[0]))
+            for _ in range(walk_len):
+                state = sim.getState()[0]
+                if len(state.navigableLocations) > 1 and random.random() < 0.3:
+                    action = [random.randint(1, len(state.navigableLocations) - 1), 0, 0]
+                else:
+                    action = [0, random.choice([-1, 0, 1]), random.choice([-1, 0, 1])]
+                sim.makeAction([action[0]], [action[1]], [action[2]])
+                episode['actions'].append(action)
+                episode['states'].append(dump_state(sim.getState()[0]))
+            episodes.append(episode)
+    return episodes
+
+
+def compare_states(ref, out, atol):
+    errors = []
+    for key in ['scanId', 'viewpointId', 'viewIndex']:
+        if ref[key] != out[key]:
+            errors.append('%s %s != %s' % (key, ref[key], out[key]))
+    for key in ['heading', 'elevation']:
+        if abs(ref[key] - out[key]) > atol:
+            errors.append('%s %.6f != %.6f' % (key, ref[key], out[key]))
+    ref_ids = [x[0] for x in ref['navigableLocations']]
+    out_ids = [x[0] for x in out['navigableLocations']]
+    if ref_ids != out_ids:
+        errors.append('navigableLocations %s != %s' % (ref_ids, out_ids))
+    else:
+        for x, y in zip(ref['navigableLocations'], out['navigableLocations']):
+            if max(abs(a - b) for a, b in zip(x[1:], y[1:])) > atol:
+                errors.append('%s rel angles/distance %s != %s' % (x[0], x[1:], y[1:]))
+    return errors
+
+
+def check_walks(sim, episodes, atol):
+    num_states, num_failed = 0, 0
+    for i, episode in enumerate(episodes):
+        sim.newEpisode([episode['scan']], [episode['viewpoint']], [episode['heading']], [episode['elevation']])
+        states = [dump_state(sim.getState()[0])]
+        for action in episode['actions']:
+            sim.makeAction([action[0]], [action[1]], [action[2]])
+            states.append(dump_state(sim.getState()[0]))
+        for t, (ref, out) in enumerate(zip(episode['states'], states)):
+            num_states += 1
+            errors = compare_states(ref, out, atol)
+            if len(errors) > 0:
+                num_failed += 1
+                print('episode %d step %d: %s' % (i, t, '; '.join(errors)))
+                break   # later states diverge anyway
+    print('%d / %d states match' % (num_states - num_failed, num_states))
+    return num_failed == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='validate the graph simulator against MatterSim')
+    parser.add_argument('--connectivity_dir', default='../datasets/R2R/connectivity')
+    parser.add_argument('--record', default=None, help='record MatterSim walks to this file')
+    parser.add_argument('--check', default=None, help='replay recorded walks on GraphSimulator')
+    parser.add_argument('--scans', nargs='+', default=None, help='defaults to all scans in scans.txt')
+    parser.add_argument('--num_walks', type=int, default=10, help='walks per scan')
+    parser.add_argument('--walk_len', type=int, default=20)
+    parser.add_argument('--atol', type=float, default=1e-4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    assert (args.record is None) != (args.check is None), 'use one of --record / --check'
+
+    if args.record is not None:
+        if args.scans is None:
+            with open(os.path.join(args.connectivity_dir, 'scans.txt')) as f:
+                args.scans = [x.strip() for x in f if x.strip()]
+        random.seed(args.seed)
+        episodes = record_walks(
+            new_simulator(args.connectivity_dir), args.scans, args.connectivity_dir,
+            args.num_walks, args.walk_len
+        )
+        with open(args.record, 'w') as f:
+            json.dump(episodes, f)
+        print('Recorded %d walks into %s' % (len(episodes), args.record))
+    else:
+        with open(args.check) as f:
+            episodes = json.load(f)
+        if not check_walks(new_graph_simulator(args.connectivity_dir), episodes, args.atol):
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ import numpy as np
 import networkx as nx 
 import torch 
 import quaternion
+from .shortest_paths import load_shortest_paths
 import os
 import networkx as nx
 
@@ -72,7 +73,7 @@ def get_view_rel_angles(baseViewId=0):
     return rel_angles
 
 
-def load_nav_graphs(connectivity_dir):
+def load_nav_graphs(connectivity_dir, cache_dir=None):
     ''' Load connectivity graph for each scan '''
 
     def distance(pose1, pose2):
@@ -99,11 +100,10 @@ def load_nav_graphs(connectivity_dir):
             nx.set_node_attributes(G, values=positions, name='position')
             graphs[scan] = G
 
-    shortest_distances = {}
-    shortest_paths = {}
-    for scan, G in graphs.items():  # compute all shortest paths
-        shortest_distances[scan] = dict(nx.all_pairs_dijkstra_path_length(G))
-        shortest_paths[scan] = dict(nx.all_pairs_dijkstra_path(G))
+    # compact all-pairs shortest paths with the nested-dict interface
+    all_shortest_paths = load_shortest_paths(graphs, cache_dir=cache_dir)
+    shortest_distances = {scan: sp.distance_map for scan, sp in all_shortest_paths.items()}
+    shortest_paths = {scan: sp.path_map for scan, sp in all_shortest_paths.items()}
     return graphs, shortest_distances, shortest_paths
 
 
@@ -77,7 +77,10 @@ class ReverieTextPathData(object):
         #{scan_vp: {vp: [viweidx, rel_angel_dist, rel_heading, rel_elevation]}}
         self.scanvp_cands = json.load(open(scanvp_cands_file))
 
-        self.graphs, self.shortest_distances, self.shortest_paths = load_nav_graphs(connectivity_dir)
+        # same shortest path cache as training_src (R2R/shortest_paths)
+        self.graphs, self.shortest_distances, self.shortest_paths = load_nav_graphs(
+            connectivity_dir, cache_dir=os.path.join(os.path.dirname(connectivity_dir.rstrip('/')), 'shortest_paths')
+        )
         self.all_point_rel_angles = [get_view_rel_angles(baseViewId=i) for i in range(36)]
         self.all_point_angle_fts = [get_angle_fts(x[:, 0], x[:, 1], self.angle_feat_size) for x in self.all_point_rel_angles]
 
@@ -0,0 +1,252 @@
+''' Compact all-pairs shortest paths of the navigation graphs.
+
+Each scan keeps integer viewpoint ids, a dense float32 distance matrix and a
+predecessor matrix (paths are rebuilt on demand), cached on disk as .npz and
+shared by every env / dataset of the process. The mapping views keep the
+nested-dict interface of networkx: shortest_distances[scan][a][b] and
+shortest_paths[scan][a][b] (a list of viewpoints).
+'''
+import os
+import time
+import numpy as np
+from collections.abc import Mapping
+
+_SHORTEST_PATHS = {}
+
+
+class ShortestPaths(object):
+    def __init__(self, vp_ids, distances, predecessors):
+        self.vp_ids = list(vp_ids)
+        self.vp2idx = {vp: i for i, vp in enumerate(self.vp_ids)}
+        self.distances = distances          # (N, N) float32, inf if unreachable
+        self.predecessors = predecessors    # (N, N) int32, the node before j on the path i -> j
+        self.distances.flags.writeable = False
+        self.predecessors.flags.writeable = False
+        self._hops = None
+        self.distance_map = _DistanceMap(self)
+        self.path_map = _PathMap(self)
+
+    @classmethod
+    def from_graph(cls, G):
+        ''' Floyd-Warshall on the weighted networkx graph '''
+        vp_ids = sorted(G.nodes())
+        vp2idx = {vp: i for i, vp in enumerate(vp_ids)}
+        n = len(vp_ids)
+        dists = np.full((n, n), np.inf, dtype=np.float64)
+        preds = np.full((n, n), -1, dtype=np.int32)
+        np.fill_diagonal(dists, 0)
+        preds[np.arange(n), np.arange(n)] = np.arange(n)
+        for a, b, w in G.edges(data='weight'):
+            i, j = vp2idx[a], vp2idx[b]
+            dists[i, j] = dists[j, i] = w
+            preds[i, j], preds[j, i] = i, j
+        for k in range(n):
+            new_dists = dists[:, k: k + 1] + dists[k: k + 1, :]
+            shorter = new_dists < dists
+            dists = np.where(shorter, new_dists, dists)
+            preds = np.where(shorter, preds[k: k + 1, :], preds)
+        return cls(vp_ids, dists.astype(np.float32), preds)
+
+    @classmethod
+    def load(cls, npz_file):
+        with np.load(npz_file) as f:
+            return cls(f['vp_ids'].tolist(), f['distances'], f['predecessors'])
+
+    def save(self, npz_file):
+        np.savez(npz_file, vp_ids=np.array(self.vp_ids), distances=self.distances, predecessors=self.predecessors)
+
+    @classmethod
+    def load_shared(cls, shared_dir, scan):
+        ''' memory-mapped, processes loading the same files share the pages '''
+        prefix = os.path.join(shared_dir, scan)
+        return cls(
+            np.load(prefix + '_vp_ids.npy').tolist(),
+            np.load(prefix + '_distances.npy', mmap_mode='r'),
+            np.load(prefix + '_predecessors.npy', mmap_mode='r'),
+        )
+
+    def save_shared(self, shared_dir, scan):
+        ''' the vp_ids file is renamed last and marks the files as complete '''
+        prefix = os.path.join(shared_dir, scan)
+        pid = os.getpid()
+        if os.path.exists(prefix + '_vp_ids.npy'):
+            os.remove(prefix + '_vp_ids.npy')
+        for name, value in [
+            ('distances', self.distances), ('predecessors', self.predecessors), ('vp_ids', np.array(self.vp_ids))
+        ]:
+            tmp_file = '%s_%s.%d.npy' % (prefix, name, pid)
+            np.save(tmp_file, value)
+            os.replace(tmp_file, '%s_%s.npy' % (prefix, name))
+
+    def matches_graph(self, G, tol=1e-3):
+        ''' whether these are the shortest paths of G (shared files may be stale): same viewpoints,
+            no edge of G shortens a distance and each distance is reached over its predecessor '''
+        n = len(self.vp_ids)
+        if self.vp_ids != sorted(G.nodes()) or self.distances.shape != (n, n) \
+                or self.predecessors.shape != (n, n):
+            return False
+        dists = np.asarray(self.distances, dtype=np.float64)
+        weights = np.full((n, n), np.inf)
+        np.fill_diagonal(weights, 0)
+        for a, b, w in G.edges(data='weight'):
+            weights[self.vp2idx[a], self.vp2idx[b]] = weights[self.vp2idx[b], self.vp2idx[a]] = w
+        src, dst = np.nonzero(np.isfinite(weights) & ~np.eye(n, dtype=bool))
+        if np.any(dists[:, dst] > dists[:, src] + weights[src, dst] + tol) or np.any(np.diag(dists) != 0):
+            return False
+        rows, cols = np.nonzero(np.isfinite(dists) & ~np.eye(n, dtype=bool))
+        preds = np.asarray(self.predecessors)[rows, cols]
+        if np.any(preds < 0):
+            return False
+        return bool(np.all(np.abs(dists[rows, preds] + weights[preds, cols] - dists[rows, cols]) <= tol))
+
+    @property
+    def hops(self):
+        ''' (N, N) int32 number of edges of the shortest paths, -1 if unreachable (built on first use) '''
+        if self._hops is None:
+            n = len(self.vp_ids)
+            rows = np.arange(n)[:, None]
+            # walk all paths i -> j back from j at once
+            cur = np.tile(np.arange(n), (n, 1))
+            hops = np.zeros((n, n), dtype=np.int32)
+            active = (cur != rows) & (self.predecessors >= 0)
+            while active.any():
+                hops += active
+                cur = np.where(active, self.predecessors[rows, cur], cur)
+                active &= cur != rows
+            hops[self.predecessors < 0] = -1
+            hops.flags.writeable = False
+            self._hops = hops
+        return self._hops
+
+    def distance(self, a, b):
+        return float(self.distances[self.vp2idx[a], self.vp2idx[b]])
+
+    def path(self, a, b):
+        i, j = self.vp2idx[a], self.vp2idx[b]
+        if self.predecessors[i, j] < 0:
+            raise KeyError(b)
+        path = [j]
+        while j != i:
+            j = self.predecessors[i, j]
+            path.append(j)
+        return [self.vp_ids[x] for x in path[::-1]]
+
+
+class _SourceRow(Mapping):
+    ''' {target_vp: value} for one source viewpoint, reachable targets only '''
+    def __init__(self, sp, source, getter):
+        self.sp = sp
+        self.source = source
+        self.getter = getter
+
+    def __getitem__(self, target):
+        if target not in self.sp.vp2idx or not np.isfinite(
+            self.sp.distances[self.sp.vp2idx[self.source], self.sp.vp2idx[target]]
+        ):
+            raise KeyError(target)
+        return self.getter(self.source, target)
+
+    def __iter__(self):
+        row = self.sp.distances[self.sp.vp2idx[self.source]]
+        return (self.sp.vp_ids[j] for j in np.nonzero(np.isfinite(row))[0])
+
+    def __len__(self):
+        return int(np.isfinite(self.sp.distances[self.sp.vp2idx[self.source]]).sum())
+
+
+class _DistanceMap(Mapping):
+    def __init__(self, sp):
+        self.sp = sp
+
+    def __getitem__(self, source):
+        if source not in self.sp.vp2idx:
+            raise KeyError(source)
+        return _SourceRow(self.sp, source, self.sp.distance)
+
+    def __iter__(self):
+        return iter(self.sp.vp_ids)
+
+    def __len__(self):
+        return len(self.sp.vp_ids)
+
+
+class _PathMap(_DistanceMap):
+    def __getitem__(self, source):
+        if source not in self.sp.vp2idx:
+            raise KeyError(source)
+        return _SourceRow(self.sp, source, self.sp.path)
+
+
+def shortest_paths_file(cache_dir, scan):
+    return os.path.join(cache_dir, '%s_shortest_paths.npz' % scan)
+
+
+def _build_shortest_paths(G, scan, cache_dir):
+    ''' from the cache_dir file if it matches G, else computed (and the file rewritten) '''
+    npz_file = shortest_paths_file(cache_dir, scan) if cache_dir is not None else None
+    if npz_file is not None and os.path.exists(npz_file):
+        try:
+            sp = ShortestPaths.load(npz_file)
+        except (OSError, ValueError, KeyError):
+            sp = None
+        if sp is not None and sp.matches_graph(G):
+            return sp
+        print('Rebuilding the stale shortest paths of %s in %s' % (scan, cache_dir))
+    sp = ShortestPaths.from_graph(G)
+    if npz_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = '%s.%d.npz' % (npz_file[:-len('.npz')], os.getpid())
+        sp.save(tmp_file)
+        os.replace(tmp_file, npz_file)
+    return sp
+
+
+def _load_valid_shared(G, scan, shared_dir):
+    ''' the shared files of the scan if they are complete and match G, else None '''
+    if not os.path.exists(os.path.join(shared_dir, scan + '_vp_ids.npy')):
+        return None
+    try:
+        sp = ShortestPaths.load_shared(shared_dir, scan)
+    except (OSError, ValueError):
+        return None
+    return sp if sp.matches_graph(G) else None
+
+
+def _get_shared_shortest_paths(G, scan, cache_dir, shared_dir, shared_writer, timeout):
+    ''' only the writer (local rank 0) builds and writes the files of a node, the
+        other processes wait for them, so all map the same pages '''
+    sp = _load_valid_shared(G, scan, shared_dir)
+    if sp is not None:
+        return sp
+    if shared_writer:
+        os.makedirs(shared_dir, exist_ok=True)
+        _build_shortest_paths(G, scan, cache_dir).save_shared(shared_dir, scan)
+        return ShortestPaths.load_shared(shared_dir, scan)
+    start = time.time()
+    while sp is None:
+        if time.time() - start > timeout:
+            raise RuntimeError('no valid shortest paths of %s in %s after %ds' % (scan, shared_dir, timeout))
+        time.sleep(0.5)
+        sp = _load_valid_shared(G, scan, shared_dir)
+    return sp
+
+
+def load_shortest_paths(graphs, cache_dir=None, shared_dir=None, shared_writer=True, timeout=1800):
+    ''' {scan: ShortestPaths} for the given {scan: networkx graph}. A scan is
+        computed once per process, and once overall when cache_dir is set.
+        With shared_dir (e.g. under /dev/shm) the matrices are memory-mapped
+        from there, so all processes of a node hold a single copy: only the
+        shared_writer process of the node writes them, existing files are
+        checked against the graph first. '''
+    outs = {}
+    for scan, G in graphs.items():
+        key = (cache_dir, shared_dir, scan)
+        if key not in _SHORTEST_PATHS:
+            if shared_dir is not None:
+                _SHORTEST_PATHS[key] = _get_shared_shortest_paths(
+                    G, scan, cache_dir, shared_dir, shared_writer, timeout
+                )
+            else:
+                _SHORTEST_PATHS[key] = _build_shortest_paths(G, scan, cache_dir)
+        outs[scan] = _SHORTEST_PATHS[key]
+    return outs
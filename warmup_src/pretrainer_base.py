@@ -147,6 +147,7 @@ class PretrainerBase(object):
         n_in_units = defaultdict(int)
         n_loss_units = defaultdict(int)
         grad_norm = 0
+        scaler = torch.amp.GradScaler('cuda', enabled=self.opts.fp16)
 
         start_time = time.time()
         # quick hack for amp delay_unscale bug
@@ -172,7 +173,8 @@ class PretrainerBase(object):
             n_in_units[name] += batch['txt_lens'].sum().item()
             task = name.split('_')[0]
             # print(f"*********{task}**********")
-            loss = self.model(batch, task=task, compute_loss=True)
+            with torch.autocast('cuda', dtype=torch.float16, enabled=self.opts.fp16):
+                loss = self.model(batch, task=task, compute_loss=True)
                 
             n_loss_units[name] += loss.size(0)
             loss = loss.mean()  # loss is not normalized in model
@@ -182,7 +184,7 @@ class PretrainerBase(object):
                 loss = loss / self.opts.gradient_accumulation_steps
             
             delay_unscale = (step+1) % self.opts.gradient_accumulation_steps != 0
-            loss.backward()
+            scaler.scale(loss).backward()
 
             task2loss[name](loss.item())
 
@@ -204,12 +206,13 @@ class PretrainerBase(object):
 
                 # update model params
                 if self.opts.grad_norm != -1:
-
+                    scaler.unscale_(optimizer)
                     grad_norm = torch.nn.utils.clip_grad_norm_(
                         self.model.parameters(), self.opts.grad_norm
                     )
                     TB_LOGGER.add_scalar('grad_norm', grad_norm, global_step)
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
                 optimizer.zero_grad()
                 self.pbar.update(1)
 